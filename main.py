@@ -2,16 +2,33 @@ import os
 import asyncio
 import yt_dlp
 import aiohttp
+from aiohttp import web
 import json
-from pyrogram import Client, filters, enums
+from pyrogram import Client, filters, enums, idle
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup
-from pyrogram.errors import MessageNotModified, FloodWait
+from pyrogram.errors import MessageNotModified, MessageIdInvalid, FloodWait, FilePartMissing
+from pyrogram import raw, utils
+from pyrogram.session import Session, Auth
+from pyrogram.file_id import FileType
 import logging
 import time
-from functools import wraps
+from contextlib import contextmanager
 import subprocess
 import re
-import os
+import math
+import hashlib
+import copy
+import struct
+import inspect
+import contextvars
+import shutil
+import errno
+import sqlite3
+import threading
+import resource
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
 from dotenv import load_dotenv
 
 load_dotenv()  # Carrega as variáveis do .env
@@ -40,28 +57,1048 @@ class Config:
     DONO_ID = 940793418
     PASTA_DOWNLOAD = "./downloads"
     PASTA_THUMB = "./thumb_cache"
+    LIMITE_CACHE_THUMB = 50 * 1024 * 1024  # Bytes de thumbnails mantidos em PASTA_THUMB
     TAMANHO_MAXIMO = 2000 * 1024 * 1024  # 2GB
     INTERVALO_ATUALIZACAO = 5  # Segundos entre atualizações de progresso
+    INTERVALO_COLETA_PROGRESSO = 1  # Segundos entre leituras de progresso repassadas ao editor de status
+    EDICOES_POR_MINUTO_CHAT = 20  # Limite do Telegram para grupos/canais
+    RAJADA_EDICOES_CHAT = 3
+    # Controle de FloodWait por chamada da API
+    ESPERA_MAXIMA_FLOOD = 300  # Acima disso o erro sobe em vez de esperar
+    TENTATIVAS_FLOOD = 3
+    ESPACAMENTO_MAXIMO_FLOOD = 5  # Segundos entre chamadas de uma chave que recebeu FloodWait
+    TIMEOUT_FFPROBE = 60  # Segundos
+    TIMEOUT_THUMBNAIL = 60  # Segundos
+    INTERVALO_MONITOR_LOOP = 0.5  # Segundos entre medições do event loop
+    LIMITE_BLOQUEIO_LOOP = 0.25  # Atraso (s) a partir do qual o bloqueio é registrado
+    MAX_TENTATIVAS_REDUCAO = 2  # Recodificações extras quando a conversão passa do limite
+    # Modo de conversão do /conv: "dois_passos", "crf" (CRF com VBV limitado), "unico" ou "segmentado"
+    MODO_CONVERSAO = os.environ.get("MODO_CONVERSAO", "dois_passos")
+    PRESET_CONVERSAO = "medium"
+    CRF_CONVERSAO = 23
+    SEGMENTOS_PARALELOS = int(os.environ.get("SEGMENTOS_PARALELOS", os.cpu_count() or 1))
+    DURACAO_MINIMA_SEGMENTO = 120  # Segundos; vídeos mais curtos não são divididos
+    LINHAS_ERRO_FFMPEG = 50  # Últimas linhas do stderr do ffmpeg guardadas para o relatório de erro
+    # Limites de concorrência por etapa do pipeline
+    LIMITE_DOWNLOADS = int(os.environ.get("LIMITE_DOWNLOADS", 4))
+    LIMITE_TRANSCODIFICACOES = int(os.environ.get("LIMITE_TRANSCODIFICACOES", 1))
+    LIMITE_PREPAROS = int(os.environ.get("LIMITE_PREPAROS", 2))  # Remux e conversão só do áudio (cópia rápida)
+    LIMITE_UPLOADS = int(os.environ.get("LIMITE_UPLOADS", 2))
+    # Download direto em intervalos de bytes simultâneos
+    CONEXOES_POR_DOWNLOAD = int(os.environ.get("CONEXOES_POR_DOWNLOAD", 4))
+    TAMANHO_MINIMO_SEGMENTO_HTTP = 4 * 1024 * 1024  # Segmentos menores não compensam a conexão extra
+    TENTATIVAS_SEGMENTO_HTTP = 3
+    # Conexões HTTP compartilhadas (keep-alive) entre todas as tarefas
+    LIMITE_CONEXOES_HTTP = 64
+    LIMITE_CONEXOES_POR_HOST = 16
+    # Streaming: download e upload simultâneos para fontes MP4 progressivas
+    STREAMING_ATIVO = os.environ.get("STREAMING_ATIVO", "1") == "1"
+    TAMANHO_MINIMO_STREAMING = 10 * 1024 * 1024  # Abaixo disso o envio normal é mais simples
+    BUFFER_STREAMING_PARTES = 16  # Partes de 512KB mantidas em memória (~8MB por tarefa)
+    # Envio em partes ao DC de mídia
+    WORKERS_UPLOAD = int(os.environ.get("WORKERS_UPLOAD", 4))  # Partes enviadas em paralelo por arquivo
+    TAMANHO_PARTE_UPLOAD_KB = int(os.environ.get("TAMANHO_PARTE_UPLOAD_KB", 512))  # Divisor de 512 (máximo do Telegram)
+    TENTATIVAS_PARTE_UPLOAD = 3
+    # Sessões do DC de mídia mantidas abertas entre transferências
+    SESSOES_MIDIA_POR_DC = int(os.environ.get("SESSOES_MIDIA_POR_DC", 2))
+    SESSOES_MIDIA_AQUECIDAS = 1  # Sessões do DC principal abertas já na inicialização
+    OCIOSIDADE_SESSAO_MIDIA = 600  # Segundos sem uso até fechar uma sessão excedente
+    TTL_CACHE_INFO = 300  # Segundos que um info dict do yt-dlp é reaproveitado
+    # Cache de file_id para reenviar links repetidos sem baixar de novo
+    ARQUIVO_CACHE_FILE_ID = "./file_id_cache.json"
+    LIMITE_CACHE_FILE_ID = 5000  # Número máximo de chaves (LRU)
+    # Diário dos downloads em andamento, usado para retomar após reinício
+    ARQUIVO_DIARIO_DOWNLOADS = "./diario_downloads.json"
+    INTERVALO_SALVAR_DIARIO = 2  # Segundos entre gravações do progresso dos segmentos
+    # Reserva de espaço em disco por tarefa em PASTA_DOWNLOAD
+    ESPACO_LIVRE_MINIMO = 1024 * 1024 * 1024  # Margem que nunca é reservada (1GB)
+    RESERVA_TAMANHO_DESCONHECIDO = 500 * 1024 * 1024  # Reserva quando a fonte não informa o tamanho
+    # Decisão antes do download pelo tamanho estimado
+    TAMANHO_MAXIMO_CONVERSAO = 8 * 1024 * 1024 * 1024  # Acima disso o link é recusado sem baixar (8GB)
+    MARGEM_ESTIMATIVA_TAMANHO = 0.95  # Estimativas do yt-dlp (filesize_approx, bitrate x duração) são imprecisas
+    INTERVALO_VERIFICAR_ESPACO = 30  # Segundos entre novas verificações de quem aguarda espaço
+    # Fila persistente de tarefas (retomadas após reinício)
+    ARQUIVO_FILA = "./fila_tarefas.db"
+    MAX_TENTATIVAS_TAREFA = 3  # Retomadas por tarefa antes de desistir
+    LIMITE_LISTAGEM_FILA = 20  # Tarefas mostradas pelo /fila
+    # /lote: várias URLs ou playlists numa única mensagem de status
+    LIMITE_LOTE = int(os.environ.get("LIMITE_LOTE", 3))  # Itens de um lote baixados/preparados ao mesmo tempo
+    LIMITE_ITENS_LOTE = 200  # Entradas processadas por lote (playlists longas são cortadas)
+    # Métricas no formato do Prometheus em http://HOST_METRICAS:PORTA_METRICAS/metrics (0 desliga)
+    HOST_METRICAS = os.environ.get("HOST_METRICAS", "127.0.0.1")
+    PORTA_METRICAS = int(os.environ.get("PORTA_METRICAS", 9108))
     USER_AGENT = "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36"
 
-app = Client(
+TAMANHO_PARTE_UPLOAD = Config.TAMANHO_PARTE_UPLOAD_KB * 1024  # Tamanho de parte do upload.saveBigFilePart
+if TAMANHO_PARTE_UPLOAD <= 0 or (512 * 1024) % TAMANHO_PARTE_UPLOAD:
+    raise ValueError("TAMANHO_PARTE_UPLOAD_KB deve dividir 512 (ex.: 128, 256, 512)")
+TAMANHO_MINIMO_ARQUIVO_GRANDE = 10 * 1024 * 1024  # Acima disso o Telegram exige saveBigFilePart
+MAXIMO_PARTES_UPLOAD = 4000  # O Telegram recusa arquivos com mais partes
+
+def tamanho_parte_upload(tamanho):
+    """Parte configurada, dobrada (até 512KB) enquanto o arquivo passar de MAXIMO_PARTES_UPLOAD partes"""
+    parte = TAMANHO_PARTE_UPLOAD
+    while parte < 512 * 1024 and math.ceil(tamanho / parte) > MAXIMO_PARTES_UPLOAD:
+        parte *= 2
+    return parte
+
+class Metricas:
+    """
+    Métricas em memória expostas no formato texto do Prometheus
+    - Contadores e histogramas são atualizados nas bordas das funções (inclusive das threads do yt-dlp)
+    - Medidores são calculados na hora da coleta
+    """
+    def __init__(self):
+        self.trava = threading.Lock()
+        self.tipos = {}  # nome -> (tipo, ajuda, buckets)
+        self.valores = {}  # nome -> {rótulos: valor} ou {rótulos: [contagens acumuladas, soma, total]}
+        self.medidores = []  # (nome, tipo, ajuda, função que retorna um valor ou {rótulos: valor})
+
+    def contador(self, nome, ajuda):
+        self.tipos[nome] = ('counter', ajuda, None)
+        self.valores[nome] = {}
+
+    def histograma(self, nome, ajuda, buckets):
+        self.tipos[nome] = ('histogram', ajuda, tuple(buckets))
+        self.valores[nome] = {}
+
+    def medidor(self, nome, ajuda, funcao, tipo='gauge'):
+        self.medidores.append((nome, tipo, ajuda, funcao))
+
+    @staticmethod
+    def _rotulos(rotulos):
+        if not rotulos:
+            return ""
+        pares = []
+        for chave, valor in rotulos:
+            valor = str(valor).replace('\\', '\\\\').replace('"', '\\"')
+            pares.append(f'{chave}="{valor}"')
+        return "{" + ",".join(pares) + "}"
+
+    def incrementar(self, nome, valor=1, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        with self.trava:
+            serie = self.valores[nome]
+            serie[chave] = serie.get(chave, 0) + valor
+
+    def observar(self, nome, valor, **rotulos):
+        chave = tuple(sorted(rotulos.items()))
+        buckets = self.tipos[nome][2]
+        with self.trava:
+            serie = self.valores[nome].setdefault(chave, [[0] * len(buckets), 0.0, 0])
+            for indice, limite in enumerate(buckets):
+                if valor <= limite:
+                    serie[0][indice] += 1
+            serie[1] += valor
+            serie[2] += 1
+
+    @contextmanager
+    def cronometrar(self, nome, **rotulos):
+        """Observa a duração do bloco no histograma (também quando ele levanta exceção)"""
+        inicio = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observar(nome, time.perf_counter() - inicio, **rotulos)
+
+    def texto(self):
+        """Todas as séries no formato de exposição do Prometheus (text/plain 0.0.4)"""
+        linhas = []
+        with self.trava:
+            valores = copy.deepcopy(self.valores)
+        for nome, (tipo, ajuda, buckets) in self.tipos.items():
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            for chave, valor in valores[nome].items():
+                if tipo != 'histogram':
+                    linhas.append(f"{nome}{self._rotulos(chave)} {valor}")
+                    continue
+                contagens, soma, total = valor
+                for limite, contagem in zip(buckets, contagens):
+                    linhas.append(f"{nome}_bucket{self._rotulos(chave + (('le', limite),))} {contagem}")
+                linhas.append(f"{nome}_bucket{self._rotulos(chave + (('le', '+Inf'),))} {total}")
+                linhas.append(f"{nome}_sum{self._rotulos(chave)} {soma}")
+                linhas.append(f"{nome}_count{self._rotulos(chave)} {total}")
+
+        for nome, tipo, ajuda, funcao in self.medidores:
+            try:
+                resultado = funcao()
+            except Exception as e:
+                logger.warning(f"Falha ao calcular a métrica {nome}: {str(e)}")
+                continue
+            linhas += [f"# HELP {nome} {ajuda}", f"# TYPE {nome} {tipo}"]
+            if not isinstance(resultado, dict):
+                resultado = {(): resultado}
+            for chave, valor in resultado.items():
+                linhas.append(f"{nome}{self._rotulos(chave)} {valor}")
+        return "\n".join(linhas) + "\n"
+
+METRICAS = Metricas()
+BUCKETS_DURACAO = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800, 3600)
+METRICAS.histograma('bot_etapa_segundos', "Duração de cada etapa do pipeline (download, transcodificação, upload)", BUCKETS_DURACAO)
+METRICAS.histograma('bot_operacao_segundos', "Duração de extração do yt-dlp, ffprobe e ffmpeg", BUCKETS_DURACAO)
+METRICAS.contador('bot_bytes_transferidos_total', "Bytes baixados e enviados (bytes/s com rate())")
+METRICAS.contador('bot_floodwait_total', "FloodWaits recebidos por método da API")
+METRICAS.contador('bot_floodwait_segundos_total', "Segundos de FloodWait recebidos por método da API")
+
+# Chamadas feitas com esta flag recebem o FloodWait na hora em vez de esperar (editor de status)
+SEM_ESPERA_FLOOD = contextvars.ContextVar("sem_espera_flood", default=False)
+
+class ControleFlood:
+    """
+    Estado compartilhado de FloodWait por método da API e por chat
+    - Um FloodWait pausa só as chamadas com a mesma chave (método, chat)
+    - O espaçamento entre chamadas da chave dobra a cada FloodWait e diminui a cada sucesso
+    """
+    def __init__(self, espacamento_maximo):
+        self.espacamento_maximo = espacamento_maximo
+        self.estados = {}  # (método, chat) -> {'bloqueado_ate', 'espacamento', 'ultima'}
+
+    @staticmethod
+    def chave(query):
+        consulta = getattr(query, 'query', query)  # InvokeWithoutUpdates/InvokeWithTakeout
+        peer = getattr(consulta, 'peer', None)
+        chat = (
+            getattr(peer, 'channel_id', None) or getattr(peer, 'chat_id', None)
+            or getattr(peer, 'user_id', None)
+        )
+        return (type(consulta).__name__, chat)
+
+    def espera(self, chave):
+        """Segundos até a próxima chamada permitida para a chave"""
+        estado = self.estados.get(chave)
+        if not estado:
+            return 0
+        return max(estado['bloqueado_ate'], estado['ultima'] + estado['espacamento']) - time.time()
+
+    def marcar_chamada(self, chave):
+        if chave in self.estados:
+            self.estados[chave]['ultima'] = time.time()
+
+    def registrar_flood(self, chave, segundos):
+        estado = self.estados.setdefault(chave, {'bloqueado_ate': 0, 'espacamento': 0, 'ultima': 0})
+        estado['bloqueado_ate'] = max(estado['bloqueado_ate'], time.time() + segundos)
+        estado['espacamento'] = min(max(estado['espacamento'] * 2, 0.5), self.espacamento_maximo)
+
+    def registrar_sucesso(self, chave):
+        estado = self.estados.get(chave)
+        if not estado:
+            return
+        estado['espacamento'] *= 0.8
+        if estado['espacamento'] < 0.05 and estado['bloqueado_ate'] < time.time():
+            del self.estados[chave]
+
+CONTROLE_FLOOD = ControleFlood(Config.ESPACAMENTO_MAXIMO_FLOOD)
+
+class ClienteControlado(Client):
+    """Client cujo invoke espera e repete só a chamada que recebeu FloodWait"""
+    async def invoke(self, query, retries=Session.MAX_RETRIES, timeout=Session.WAIT_TIMEOUT, sleep_threshold=None):
+        chave = CONTROLE_FLOOD.chave(query)
+        for tentativa in range(Config.TENTATIVAS_FLOOD + 1):
+            espera = CONTROLE_FLOOD.espera(chave)
+            if espera > 0:
+                if SEM_ESPERA_FLOOD.get():
+                    raise FloodWait(value=math.ceil(espera))
+                await asyncio.sleep(espera)
+            CONTROLE_FLOOD.marcar_chamada(chave)
+
+            try:
+                # sleep_threshold=0: o FloodWait sempre chega aqui, onde o estado é compartilhado
+                resultado = await super().invoke(query, retries, timeout, 0)
+            except FloodWait as e:
+                CONTROLE_FLOOD.registrar_flood(chave, e.value)
+                METRICAS.incrementar('bot_floodwait_total', metodo=chave[0])
+                METRICAS.incrementar('bot_floodwait_segundos_total', e.value, metodo=chave[0])
+                if SEM_ESPERA_FLOOD.get() or e.value > Config.ESPERA_MAXIMA_FLOOD or tentativa == Config.TENTATIVAS_FLOOD:
+                    raise
+                logger.warning(f"FloodWait de {e.value}s em {chave[0]} (chat {chave[1]}); repetindo só esta chamada")
+                continue
+
+            CONTROLE_FLOOD.registrar_sucesso(chave)
+            return resultado
+
+    async def save_file(self, path, file_id=None, file_part=0, progress=None, progress_args=()):
+        """Envia arquivos pelo motor de partes (sessão de mídia reaproveitada, workers e métricas)"""
+        if path is None:
+            return None
+        if file_id is not None:
+            # Parte faltante (FilePartMissing): reenviada pelo mesmo motor, com o mesmo tamanho de parte
+            await reenviar_parte_do_arquivo(self, path, file_id, file_part)
+            return None
+        return await enviar_arquivo_em_partes(self, path, progress, progress_args)
+
+    async def get_file(self, file_id, file_size=0, limit=0, offset=0, progress=None, progress_args=()):
+        """Downloads pelas sessões de mídia do pool (fotos de perfil ficam com o Pyrogram)"""
+        if file_id.file_type == FileType.CHAT_PHOTO:
+            origem = super().get_file(file_id, file_size, limit, offset, progress, progress_args)
+        else:
+            origem = baixar_arquivo_telegram(self, file_id, file_size, limit, offset, progress, progress_args)
+        async for bloco in origem:
+            yield bloco
+
+app = ClienteControlado(
     "bot_upload_video",
     api_id=Config.API_ID,
     api_hash=Config.API_HASH,
     bot_token=Config.BOT_TOKEN
 )
 
-# Variáveis globais
-ULTIMO_TEMPO_ATUALIZACAO = 0
-TEMPO_INICIO = 0
-DOWNLOAD_CANCELADO = False
-UPLOAD_CANCELADO = False
-TAMANHO_TOTAL_ARQUIVO = 0
-LOOP = None  # Para armazenar o event loop principal
-
 # Dicionário para armazenar o status de cada download/upload
+# Chave: (chat_id, id da mensagem de status) -> Tarefa
 STATUS_PROCESSOS = {}
 
+class Tarefa:
+    """Estado de um único download/upload, isolado das demais tarefas"""
+    def __init__(self, mensagem_status: Message):
+        self.mensagem_status = mensagem_status
+        self.chave = (mensagem_status.chat.id, mensagem_status.id)
+        self.tempo_inicio = time.time()
+        self.ultimo_tempo_atualizacao = 0
+        self.download_cancelado = False
+        self.upload_cancelado = False
+        self.tamanho_total_arquivo = 0
+        self.id_fila = None  # Linha na fila persistente
+        self.bytes_ytdlp = {}  # Arquivo do yt-dlp -> bytes já contados nas métricas
+        self.loop = asyncio.get_running_loop()  # Loop principal, usado pelos hooks do yt-dlp
+
+    def reiniciar_cronometro(self):
+        """Reinicia a contagem de tempo usada no cálculo de velocidade/ETA"""
+        self.tempo_inicio = time.time()
+        self.ultimo_tempo_atualizacao = 0
+
+def registrar_tarefa(mensagem_status: Message) -> Tarefa:
+    """Cria e registra uma nova tarefa para a mensagem de status"""
+    tarefa = Tarefa(mensagem_status)
+    STATUS_PROCESSOS[tarefa.chave] = tarefa
+    return tarefa
+
+def obter_tarefa(mensagem: Message):
+    """Retorna a tarefa associada a uma mensagem de status, se existir"""
+    return STATUS_PROCESSOS.get((mensagem.chat.id, mensagem.id))
+
+def remover_tarefa(tarefa):
+    """Remove a tarefa do registro"""
+    if tarefa:
+        STATUS_PROCESSOS.pop(tarefa.chave, None)
+        EDITOR_STATUS.descartar(tarefa.mensagem_status)
+
+class EditorStatus:
+    """
+    Atualizador central das mensagens de status
+    - Guarda só o último texto de cada mensagem e envia no ritmo do balde de fichas do chat
+    - Texto igual ao último enviado não gera edição
+    - FloodWait só adia as edições daquele chat; quem atualiza nunca espera nem repete trabalho
+    - Mensagem descartada com edição pendente só é esquecida depois que essa edição sai
+    """
+    def __init__(self, edicoes_por_minuto, rajada, intervalo_mensagem):
+        self.taxa = edicoes_por_minuto / 60
+        self.rajada = rajada
+        self.intervalo_mensagem = intervalo_mensagem
+        self.pendentes = {}  # (chat_id, id) -> (mensagem, texto, reply_markup)
+        self.enviados = {}  # (chat_id, id) -> (texto, reply_markup) da última edição aceita
+        self.ultima_edicao = {}  # (chat_id, id) -> momento da última edição
+        self.em_envio = set()
+        self.encerradas = set()  # Descartadas que ainda têm edição pendente ou em andamento
+        self.baldes = {}  # chat_id -> [fichas, momento]
+        self.bloqueado_ate = {}  # chat_id -> fim do FloodWait
+        self.sinal = None
+        self.tarefa = None
+
+    @staticmethod
+    def _chave(mensagem):
+        return (mensagem.chat.id, mensagem.id)
+
+    def _fichas(self, chat_id, agora):
+        fichas, momento = self.baldes.get(chat_id, (self.rajada, agora))
+        fichas = min(self.rajada, fichas + (agora - momento) * self.taxa)
+        self.baldes[chat_id] = [fichas, agora]
+        return fichas
+
+    def _liberado_em(self, chave, agora):
+        """Momento em que a mensagem pode ser editada de novo"""
+        chat_id = chave[0]
+        espera_chat = (1 - self._fichas(chat_id, agora)) / self.taxa
+        return max(
+            agora + max(0, espera_chat),
+            self.ultima_edicao.get(chave, 0) + self.intervalo_mensagem,
+            self.bloqueado_ate.get(chat_id, 0)
+        )
+
+    def atualizar(self, mensagem, texto, reply_markup=None):
+        """Registra o estado mais recente da mensagem; não bloqueia"""
+        if isinstance(mensagem, LinhaLote):
+            mensagem.atualizar(texto)  # Item de /lote: vira uma linha da mensagem agregada
+            return
+        chave = self._chave(mensagem)
+        if self.enviados.get(chave) == (texto, str(reply_markup)) and chave not in self.em_envio:
+            self.pendentes.pop(chave, None)
+            return
+        self.pendentes[chave] = (mensagem, texto, reply_markup)
+        if self.tarefa is None:
+            self.sinal = asyncio.Event()
+            self.tarefa = asyncio.create_task(self._executar())
+        self.sinal.set()
+
+    async def editar(self, mensagem, texto, reply_markup=None):
+        """Edição imediata (mudança de etapa, erro); substitui o progresso pendente"""
+        if isinstance(mensagem, LinhaLote):
+            mensagem.atualizar(texto)
+            return
+        chave = self._chave(mensagem)
+        self.pendentes.pop(chave, None)
+        if chave in self.em_envio or time.time() < self.bloqueado_ate.get(mensagem.chat.id, 0):
+            # Sai logo depois da edição em andamento ou do fim do FloodWait
+            self.atualizar(mensagem, texto, reply_markup)
+            return
+        self._fichas(mensagem.chat.id, time.time())
+        self.baldes[mensagem.chat.id][0] -= 1
+        self.em_envio.add(chave)
+        await self._enviar(chave, mensagem, texto, reply_markup)
+
+    async def apagar(self, mensagem):
+        """Apaga a mensagem de status sem deixar edições pendentes para trás"""
+        if isinstance(mensagem, LinhaLote):
+            mensagem.atualizar(None)
+            return
+        self.pendentes.pop(self._chave(mensagem), None)
+        self.descartar(mensagem)
+        await mensagem.delete()
+
+    def descartar(self, mensagem):
+        """
+        Esquece o estado da mensagem (tarefa encerrada)
+        - Edição ainda pendente (em andamento ou adiada por FloodWait) sai antes: costuma ser o erro final
+        """
+        chave = self._chave(mensagem)
+        if chave in self.pendentes or chave in self.em_envio:
+            self.encerradas.add(chave)
+            return
+        self._esquecer(chave)
+
+    def _esquecer(self, chave):
+        self.pendentes.pop(chave, None)
+        self.enviados.pop(chave, None)
+        self.ultima_edicao.pop(chave, None)
+        self.encerradas.discard(chave)
+
+    def _podar(self, agora):
+        """Remove baldes já cheios de novo e FloodWaits vencidos (uma entrada por chat, senão cresceriam sempre)"""
+        for chat_id, (fichas, momento) in list(self.baldes.items()):
+            if fichas + (agora - momento) * self.taxa >= self.rajada:
+                del self.baldes[chat_id]
+        for chat_id, fim in list(self.bloqueado_ate.items()):
+            if fim <= agora:
+                del self.bloqueado_ate[chat_id]
+
+    async def _enviar(self, chave, mensagem, texto, reply_markup):
+        sem_espera = SEM_ESPERA_FLOOD.set(True)
+        try:
+            await mensagem.edit(texto, reply_markup=reply_markup)
+            self.enviados[chave] = (texto, str(reply_markup))
+        except MessageNotModified:
+            self.enviados[chave] = (texto, str(reply_markup))
+        except FloodWait as e:
+            self.bloqueado_ate[chave[0]] = time.time() + e.value
+            self.pendentes.setdefault(chave, (mensagem, texto, reply_markup))
+            logger.warning(f"FloodWait de {e.value}s nas edições do chat {chave[0]}")
+        except MessageIdInvalid:
+            self.pendentes.pop(chave, None)
+            self.encerradas.add(chave)
+        except Exception as e:
+            logger.warning(f"Falha ao atualizar mensagem de status: {e}")
+        finally:
+            SEM_ESPERA_FLOOD.reset(sem_espera)
+            self.ultima_edicao[chave] = time.time()
+            self.em_envio.discard(chave)
+            if chave in self.encerradas and chave not in self.pendentes:
+                self._esquecer(chave)
+            if self.sinal:
+                self.sinal.set()
+
+    async def _executar(self):
+        while True:
+            agora = time.time()
+            self._podar(agora)
+            proximo = None
+            for chave in list(self.pendentes):
+                if chave in self.em_envio:
+                    continue
+                liberado = self._liberado_em(chave, agora)
+                if liberado > agora:
+                    proximo = liberado if proximo is None else min(proximo, liberado)
+                    continue
+                mensagem, texto, reply_markup = self.pendentes.pop(chave)
+                self.baldes[chave[0]][0] -= 1
+                self.em_envio.add(chave)
+                asyncio.create_task(self._enviar(chave, mensagem, texto, reply_markup))
+
+            self.sinal.clear()
+            try:
+                await asyncio.wait_for(self.sinal.wait(), None if proximo is None else proximo - agora)
+            except asyncio.TimeoutError:
+                pass
+
+    async def parar(self):
+        if self.tarefa:
+            self.tarefa.cancel()
+            await asyncio.gather(self.tarefa, return_exceptions=True)
+            self.tarefa = None
+
+EDITOR_STATUS = EditorStatus(
+    Config.EDICOES_POR_MINUTO_CHAT, Config.RAJADA_EDICOES_CHAT, Config.INTERVALO_ATUALIZACAO
+)
+
+TECLADO_CANCELAR_DOWNLOAD = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data="cancelar_download")]])
+TECLADO_CANCELAR_UPLOAD = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data="cancelar_upload")]])
+
+class Agendador:
+    """
+    Pipeline de tarefas com uma fila e um limite de concorrência por etapa
+    - Cada tarefa percorre suas etapas em ordem (download -> preparo/transcodificação -> upload)
+    - O download da tarefa N+1 pode rodar enquanto a tarefa N está no upload
+    - Uma etapa que retorna False encerra a tarefa sem erro
+    """
+    def __init__(self, limites):
+        self.limites = limites
+        self.filas = {}
+        self.ocupados = {etapa: 0 for etapa in limites}
+        self.workers = []
+
+    def iniciar(self):
+        """Cria as filas e os workers de cada etapa no loop atual"""
+        for etapa, limite in self.limites.items():
+            self.filas[etapa] = asyncio.Queue()
+            for _ in range(limite):
+                self.workers.append(asyncio.create_task(self._worker(etapa)))
+        logger.info(f"Agendador iniciado: {self.limites}")
+
+    async def parar(self):
+        """Cancela os workers de todas as etapas"""
+        for worker in self.workers:
+            worker.cancel()
+        await asyncio.gather(*self.workers, return_exceptions=True)
+        self.workers = []
+
+    async def submeter(self, tarefa, etapas, ao_erro, ao_finalizar, origem=None):
+        """
+        Enfileira a tarefa na primeira etapa e retorna imediatamente
+        - origem: (mensagem, comando[, dados]) para registrar a tarefa na fila persistente
+          (dados: url/legenda guardados para a retomada)
+        """
+        if not self.workers:
+            self.iniciar()
+        tarefa.etapas = list(etapas)
+        tarefa.ao_erro = ao_erro
+        tarefa.ao_finalizar = ao_finalizar
+        if origem:
+            mensagem, comando, *dados = origem
+            tarefa.id_fila = await FILA_PERSISTENTE.registrar(
+                mensagem.chat.id, mensagem.id, tarefa.mensagem_status.id, comando, **(dados[0] if dados else {})
+            )
+        await self._encaminhar(tarefa)
+
+    def direcionar_proxima_etapa(self, tarefa, etapa):
+        """
+        Troca a fila da próxima etapa da tarefa, decidida durante a etapa atual
+        - etapa None remove a próxima etapa (nada a fazer nela)
+        """
+        _, funcao = tarefa.etapas.pop(0)
+        if etapa is not None:
+            tarefa.etapas.insert(0, (etapa, funcao))
+
+    async def _encaminhar(self, tarefa):
+        """Coloca a tarefa na fila da próxima etapa ou a finaliza"""
+        if not tarefa.etapas:
+            await self._finalizar(tarefa)
+            return
+
+        etapa = tarefa.etapas[0][0]
+        if self.ocupados[etapa] >= self.limites[etapa]:
+            EDITOR_STATUS.atualizar(
+                tarefa.mensagem_status,
+                f"⏳ Aguardando na fila de {etapa} ({self.filas[etapa].qsize()} na frente)..."
+            )
+        await self.filas[etapa].put(tarefa)
+
+    async def _finalizar(self, tarefa):
+        try:
+            await tarefa.ao_finalizar()
+        except Exception as e:
+            logger.error(f"Erro ao finalizar tarefa {tarefa.chave}: {str(e)}")
+        if tarefa.id_fila:
+            await FILA_PERSISTENTE.remover(tarefa.id_fila)
+
+    async def _worker(self, etapa):
+        fila = self.filas[etapa]
+        while True:
+            tarefa = await fila.get()
+            self.ocupados[etapa] += 1
+            continuar = True
+            try:
+                nome_etapa, funcao = tarefa.etapas.pop(0)
+                if tarefa.id_fila:
+                    await FILA_PERSISTENTE.atualizar_etapa(tarefa.id_fila, nome_etapa)
+                with METRICAS.cronometrar('bot_etapa_segundos', etapa=etapa):
+                    continuar = await funcao() is not False
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                continuar = False
+                try:
+                    await tarefa.ao_erro(e)
+                except Exception as e2:
+                    logger.error(f"Erro ao reportar falha da tarefa {tarefa.chave}: {str(e2)}")
+            finally:
+                self.ocupados[etapa] -= 1
+                fila.task_done()
+
+            if continuar:
+                await self._encaminhar(tarefa)
+            else:
+                await self._finalizar(tarefa)
+
+AGENDADOR = Agendador({
+    "download": Config.LIMITE_DOWNLOADS,
+    "preparo": Config.LIMITE_PREPAROS,
+    "transcodificacao": Config.LIMITE_TRANSCODIFICACOES,
+    "upload": Config.LIMITE_UPLOADS,
+})
+
+class FilaPersistente:
+    """
+    Registro durável das tarefas submetidas (SQLite em modo WAL)
+    - Uma linha por tarefa, da submissão até o fim; o que sobra no boot é retomado
+    - Todo acesso ao banco roda numa thread dedicada, fora do event loop
+    """
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="fila")
+        self.conexao = None
+
+    def _conectar(self):
+        if self.conexao is None:
+            self.conexao = sqlite3.connect(self.caminho, check_same_thread=False)
+            self.conexao.row_factory = sqlite3.Row
+            self.conexao.execute("PRAGMA journal_mode=WAL")
+            self.conexao.execute("PRAGMA synchronous=NORMAL")
+            self.conexao.execute("""
+                CREATE TABLE IF NOT EXISTS tarefas (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    chat_id INTEGER NOT NULL,
+                    mensagem_id INTEGER NOT NULL,
+                    status_id INTEGER,
+                    comando TEXT NOT NULL,
+                    etapa TEXT NOT NULL,
+                    tentativas INTEGER NOT NULL DEFAULT 0,
+                    criada_em REAL NOT NULL,
+                    atualizada_em REAL NOT NULL,
+                    url TEXT,
+                    legenda TEXT,
+                    UNIQUE (chat_id, mensagem_id)
+                )
+            """)
+            # Bancos criados antes das colunas url/legenda
+            colunas = {linha['name'] for linha in self.conexao.execute("PRAGMA table_info(tarefas)")}
+            for coluna in ('url', 'legenda'):
+                if coluna not in colunas:
+                    self.conexao.execute(f"ALTER TABLE tarefas ADD COLUMN {coluna} TEXT")
+        return self.conexao
+
+    def _executar_sql(self, *comandos):
+        """Executa (consulta, parâmetros) numa única transação e retorna as linhas do último"""
+        conexao = self._conectar()
+        with conexao:
+            for consulta, parametros in comandos:
+                linhas = conexao.execute(consulta, parametros).fetchall()
+        return linhas
+
+    async def _executar(self, consulta, parametros=()):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._executar_sql, (consulta, parametros))
+
+    async def registrar(self, chat_id, mensagem_id, status_id, comando, url=None, legenda=None):
+        """
+        Insere a tarefa (ou reaproveita a linha de uma retomada, mantendo as tentativas)
+        - url/legenda: usados na retomada quando não saem do texto da mensagem (link redirecionado ao /conv)
+        """
+        agora = time.time()
+        loop = asyncio.get_running_loop()
+        linhas = await loop.run_in_executor(
+            self.executor, self._executar_sql,
+            (
+                """
+                INSERT INTO tarefas (chat_id, mensagem_id, status_id, comando, etapa, criada_em, atualizada_em, url, legenda)
+                VALUES (?, ?, ?, ?, 'fila', ?, ?, ?, ?)
+                ON CONFLICT (chat_id, mensagem_id) DO UPDATE SET
+                    status_id = excluded.status_id, comando = excluded.comando, etapa = 'fila',
+                    atualizada_em = excluded.atualizada_em, url = excluded.url, legenda = excluded.legenda
+                """,
+                (chat_id, mensagem_id, status_id, comando, agora, agora, url, legenda)
+            ),
+            ("SELECT id FROM tarefas WHERE chat_id = ? AND mensagem_id = ?", (chat_id, mensagem_id))
+        )
+        return linhas[0]['id']
+
+    async def atualizar_etapa(self, id_fila, etapa):
+        await self._executar(
+            "UPDATE tarefas SET etapa = ?, atualizada_em = ? WHERE id = ?",
+            (etapa, time.time(), id_fila)
+        )
+
+    async def contar_tentativa(self, id_fila):
+        await self._executar("UPDATE tarefas SET tentativas = tentativas + 1 WHERE id = ?", (id_fila,))
+
+    async def remover(self, id_fila):
+        await self._executar("DELETE FROM tarefas WHERE id = ?", (id_fila,))
+
+    async def listar(self, chat_id=None, limite=-1):
+        """Tarefas em ordem de chegada (todas ou só de um chat)"""
+        if chat_id is None:
+            linhas = await self._executar("SELECT * FROM tarefas ORDER BY id LIMIT ?", (limite,))
+        else:
+            linhas = await self._executar(
+                "SELECT * FROM tarefas WHERE chat_id = ? ORDER BY id LIMIT ?", (chat_id, limite)
+            )
+        return [dict(linha) for linha in linhas]
+
+    async def resumo(self, chat_id=None):
+        """Quantidade de tarefas por etapa"""
+        filtro, parametros = ("WHERE chat_id = ?", (chat_id,)) if chat_id is not None else ("", ())
+        linhas = await self._executar(
+            f"SELECT etapa, COUNT(*) AS total FROM tarefas {filtro} GROUP BY etapa", parametros
+        )
+        return {linha['etapa']: linha['total'] for linha in linhas}
+
+    def fechar(self):
+        def _fechar():
+            if self.conexao is not None:
+                self.conexao.close()
+                self.conexao = None
+        self.executor.submit(_fechar).result()
+        self.executor.shutdown()
+
+FILA_PERSISTENTE = FilaPersistente(Config.ARQUIVO_FILA)
+
+# Parâmetros de rastreamento que não mudam o conteúdo do link (nome exato; utm_* por prefixo)
+PARAMETROS_IGNORADOS = {'fbclid', 'gclid', 'si', 'feature', 'ref'}
+PREFIXO_PARAMETROS_IGNORADOS = 'utm_'
+
+def normalizar_url(url):
+    """Normaliza a URL para uso como chave de cache"""
+    partes = urlsplit(url.strip())
+    host = partes.netloc.lower()
+    if host.startswith('www.'):
+        host = host[4:]
+    query = sorted(
+        (chave, valor) for chave, valor in parse_qsl(partes.query, keep_blank_values=True)
+        if chave.lower() not in PARAMETROS_IGNORADOS and not chave.lower().startswith(PREFIXO_PARAMETROS_IGNORADOS)
+    )
+    return urlunsplit((partes.scheme.lower(), host, partes.path.rstrip('/'), urlencode(query), ''))
+
+def chave_url(url):
+    return f"url:{normalizar_url(url)}"
+
+def chave_extrator(info):
+    """Chave por extrator + ID do vídeo a partir do info dict do yt-dlp"""
+    if info and info.get('extractor_key') and info.get('id'):
+        return f"ie:{info['extractor_key']}:{info['id']}"
+    return None
+
+def calcular_hash_arquivo(caminho):
+    """Calcula o SHA-256 do arquivo em blocos (sem carregar tudo na memória)"""
+    sha = hashlib.sha256()
+    with open(caminho, 'rb') as f:
+        for bloco in iter(lambda: f.read(1024 * 1024), b''):
+            sha.update(bloco)
+    return f"sha256:{sha.hexdigest()}"
+
+class CacheFileId:
+    """Cache persistente (LRU) de file_id do Telegram por URL, extrator e hash do conteúdo"""
+    def __init__(self, caminho, limite):
+        self.caminho = caminho
+        self.limite = limite
+        self.entradas = OrderedDict()
+        self._carregar()
+
+    def _carregar(self):
+        try:
+            with open(self.caminho, 'r') as f:
+                self.entradas = OrderedDict(json.load(f))
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Cache de file_id ignorado (arquivo inválido): {str(e)}")
+
+    def _salvar(self):
+        try:
+            temporario = self.caminho + ".tmp"
+            with open(temporario, 'w') as f:
+                json.dump(list(self.entradas.items()), f)
+            os.replace(temporario, self.caminho)
+        except Exception as e:
+            logger.warning(f"Falha ao salvar cache de file_id: {str(e)}")
+
+    def obter(self, *chaves):
+        """Retorna a primeira entrada encontrada entre as chaves"""
+        for chave in chaves:
+            if chave and chave in self.entradas:
+                self.entradas.move_to_end(chave)
+                return self.entradas[chave]
+        return None
+
+    def registrar(self, chaves, tipo, file_id):
+        """Associa todas as chaves ao file_id enviado"""
+        for chave in chaves:
+            if chave:
+                self.entradas[chave] = {'tipo': tipo, 'file_id': file_id}
+                self.entradas.move_to_end(chave)
+        while len(self.entradas) > self.limite:
+            self.entradas.popitem(last=False)
+        self._salvar()
+
+    def invalidar(self, *chaves):
+        """Remove as chaves informadas (ou tudo, sem chaves) e retorna quantas foram removidas"""
+        if not chaves:
+            removidas = len(self.entradas)
+            self.entradas.clear()
+        else:
+            alvos = {
+                entrada['file_id'] for chave in chaves
+                if chave and (entrada := self.entradas.get(chave))
+            }
+            antes = len(self.entradas)
+            self.entradas = OrderedDict(
+                (chave, entrada) for chave, entrada in self.entradas.items()
+                if entrada['file_id'] not in alvos
+            )
+            removidas = antes - len(self.entradas)
+        self._salvar()
+        return removidas
+
+CACHE_FILE_ID = CacheFileId(Config.ARQUIVO_CACHE_FILE_ID, Config.LIMITE_CACHE_FILE_ID)
+
+class DiarioDownloads:
+    """
+    Diário persistente dos downloads em andamento, indexado pelo caminho de destino
+    - Guarda URL, etapa, intervalos de bytes pendentes e a mensagem de origem
+    - Sobrevive a reinícios: o bot retoma as entradas em vez de apagar os arquivos parciais
+    """
+    def __init__(self, caminho):
+        self.caminho = caminho
+        self.entradas = {}
+        self.ultimo_salvamento = 0
+        self._carregar()
+
+    def _carregar(self):
+        try:
+            with open(self.caminho, 'r') as f:
+                self.entradas = json.load(f)
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Diário de downloads ignorado (arquivo inválido): {str(e)}")
+
+    def salvar(self, forcar=True):
+        """Grava o diário; sem forcar, respeita o intervalo mínimo entre gravações"""
+        agora = time.time()
+        if not forcar and agora - self.ultimo_salvamento < Config.INTERVALO_SALVAR_DIARIO:
+            return
+        self.ultimo_salvamento = agora
+        try:
+            temporario = self.caminho + ".tmp"
+            with open(temporario, 'w') as f:
+                json.dump(self.entradas, f)
+            os.replace(temporario, self.caminho)
+        except Exception as e:
+            logger.warning(f"Falha ao salvar diário de downloads: {str(e)}")
+
+    def obter(self, caminho_arquivo):
+        return self.entradas.get(caminho_arquivo)
+
+    def registrar(self, caminho_arquivo, **dados):
+        """Cria ou atualiza a entrada do arquivo"""
+        self.entradas.setdefault(caminho_arquivo, {}).update(dados)
+        self.salvar()
+
+    def remover(self, caminho_arquivo):
+        if self.entradas.pop(caminho_arquivo, None) is not None:
+            self.salvar()
+
+DIARIO_DOWNLOADS = DiarioDownloads(Config.ARQUIVO_DIARIO_DOWNLOADS)
+
+def arquivos_do_download(caminho_arquivo):
+    """Arquivo final e parciais (.part, faixas separadas do yt-dlp) de um download"""
+    pasta, nome = os.path.split(caminho_arquivo)
+    prefixo = os.path.splitext(nome)[0] + '.'
+    try:
+        return [os.path.join(pasta, arquivo) for arquivo in os.listdir(pasta) if arquivo.startswith(prefixo)]
+    except FileNotFoundError:
+        return []
+
+def descartar_download(caminho_arquivo):
+    """Apaga o arquivo, seus parciais e a entrada no diário"""
+    for arquivo in arquivos_do_download(caminho_arquivo):
+        try:
+            os.remove(arquivo)
+        except OSError:
+            pass
+    DIARIO_DOWNLOADS.remover(caminho_arquivo)
+
+def iniciar_no_diario(caminho_arquivo, **dados):
+    """
+    Registra o download no diário e retorna a entrada anterior, se for uma retomada
+    - Sem entrada anterior, restos de arquivo com o mesmo nome são descartados
+    - Download já concluído (etapa 'upload' com o arquivo presente) mantém a etapa,
+      para o atalho até o envio valer em reinícios seguidos
+    """
+    anterior = DIARIO_DOWNLOADS.obter(caminho_arquivo)
+    if anterior:
+        anterior = dict(anterior)
+        if anterior.get('etapa') == 'upload' and os.path.exists(caminho_arquivo):
+            dados['etapa'] = 'upload'
+    else:
+        descartar_download(caminho_arquivo)
+    DIARIO_DOWNLOADS.registrar(caminho_arquivo, **dados)
+    return anterior
+
+# Prefixos dos arquivos de trabalho do /conv, que não passam pelo diário e recomeçam do zero
+PREFIXOS_TEMPORARIOS_CONVERSAO = ('orig_', 'conv_', 'tmp_')
+
+def limpar_downloads_orfaos():
+    """
+    Limpeza na inicialização da PASTA_DOWNLOAD
+    - Apaga arquivos dl_* que não pertencem a nenhuma entrada do diário
+    - Apaga os restos do /conv (original, saída, passlog e pastas *_segmentos)
+    """
+    preservados = {
+        os.path.abspath(arquivo)
+        for caminho in DIARIO_DOWNLOADS.entradas for arquivo in arquivos_do_download(caminho)
+    }
+    for arquivo in os.listdir(Config.PASTA_DOWNLOAD):
+        caminho = os.path.join(Config.PASTA_DOWNLOAD, arquivo)
+        if arquivo.startswith(PREFIXOS_TEMPORARIOS_CONVERSAO):
+            if os.path.isdir(caminho):
+                shutil.rmtree(caminho, ignore_errors=True)
+            else:
+                descartar_download(caminho)
+        elif arquivo.startswith('dl_') and os.path.abspath(caminho) not in preservados:
+            try:
+                os.remove(caminho)
+            except OSError:
+                pass
+
+class EspacoTrabalho:
+    """
+    Reserva de espaço em PASTA_DOWNLOAD antes de cada tarefa começar a gravar
+    - O disponível é o livre no disco menos o que as reservas ainda vão gravar
+    - Tarefas que não cabem aguardam até outra liberar espaço
+    - Sem nenhuma outra reserva ativa, uma tarefa que não cabe falha na hora
+    """
+    def __init__(self, pasta, margem):
+        self.pasta = pasta
+        self.margem = margem
+        self.reservas = {}  # chave da tarefa -> {'bytes', 'arquivos'}
+        self.condicao = None
+
+    @staticmethod
+    def _em_disco(reserva):
+        total = 0
+        for caminho in reserva['arquivos']:
+            for arquivo in arquivos_do_download(caminho):
+                try:
+                    total += os.path.getsize(arquivo)
+                except OSError:
+                    pass
+        return total
+
+    def disponivel(self):
+        """Bytes que ainda podem ser reservados"""
+        livre = shutil.disk_usage(self.pasta).free - self.margem
+        return livre - sum(max(0, reserva['bytes'] - self._em_disco(reserva)) for reserva in self.reservas.values())
+
+    async def reservar(self, tarefa, tamanho, arquivos):
+        """
+        Reserva tamanho bytes para os arquivos da tarefa (e seus parciais), aguardando se preciso
+        - Uma nova reserva da mesma tarefa substitui a anterior
+        """
+        if self.condicao is None:
+            self.condicao = asyncio.Condition()
+        async with self.condicao:
+            self.reservas.pop(tarefa.chave, None)
+            avisado = False
+            while tamanho > self.disponivel():
+                if not self.reservas:
+                    raise Exception(
+                        f"Espaço em disco insuficiente ({converter_bytes(tamanho)} necessários, "
+                        f"{converter_bytes(max(0, self.disponivel()))} livres)"
+                    )
+                if not avisado:
+                    EDITOR_STATUS.atualizar(
+                        tarefa.mensagem_status,
+                        f"⏳ Aguardando espaço em disco ({converter_bytes(tamanho)})...",
+                        TECLADO_CANCELAR_DOWNLOAD
+                    )
+                    avisado = True
+                try:
+                    await asyncio.wait_for(self.condicao.wait(), Config.INTERVALO_VERIFICAR_ESPACO)
+                except asyncio.TimeoutError:
+                    pass  # Outros processos também liberam espaço: verifica de novo
+                if tarefa.download_cancelado:
+                    raise Exception("Download cancelado pelo usuário")
+            self.reservas[tarefa.chave] = {'bytes': tamanho, 'arquivos': list(arquivos)}
+        logger.info(f"Reservados {converter_bytes(tamanho)} para a tarefa {tarefa.chave}")
+
+    async def liberar(self, tarefa):
+        """Desfaz a reserva da tarefa (os arquivos já devem ter sido apagados) e acorda quem aguarda"""
+        if self.reservas.pop(tarefa.chave, None) is None or self.condicao is None:
+            return
+        async with self.condicao:
+            self.condicao.notify_all()
+
+ESPACO_TRABALHO = EspacoTrabalho(Config.PASTA_DOWNLOAD, Config.ESPACO_LIVRE_MINIMO)
+
+def preallocar(fd, tamanho):
+    """Aloca os blocos do arquivo de uma vez: falta de espaço aparece antes do download, não no meio"""
+    if hasattr(os, 'posix_fallocate'):
+        try:
+            os.posix_fallocate(fd, 0, tamanho)
+            return
+        except OSError as e:
+            if e.errno == errno.ENOSPC:
+                raise
+    os.ftruncate(fd, tamanho)  # Sistema de arquivos sem suporte: arquivo esparso
+
+async def responder_do_cache(client, mensagem, chaves, legenda=None, reply_to_message_id=None):
+    """Reenvia a mídia pelo file_id em cache; retorna True se conseguiu"""
+    entrada = CACHE_FILE_ID.obter(*chaves)
+    if not entrada:
+        return False
+
+    envio = getattr(client, f"send_{entrada['tipo']}")
+    try:
+        await envio(
+            mensagem.chat.id,
+            entrada['file_id'],
+            caption=legenda,
+            reply_to_message_id=reply_to_message_id
+        )
+    except Exception as e:
+        logger.warning(f"file_id em cache inválido, baixando novamente: {str(e)}")
+        CACHE_FILE_ID.invalidar(*chaves)
+        return False
+
+    logger.info(f"Link respondido pelo cache de file_id ({entrada['tipo']})")
+    return True
+
+def registrar_no_cache(chaves, enviada):
+    """Guarda o file_id da mensagem enviada para todas as chaves"""
+    if not enviada:
+        return
+    for tipo in ('video', 'document', 'photo'):
+        midia = getattr(enviada, tipo, None)
+        if midia:
+            CACHE_FILE_ID.registrar(chaves, tipo, midia.file_id)
+            return
+
 def eh_comentario_canal(mensagem: Message) -> bool:
     """Verifica se a mensagem é um comentário em um canal"""
     return (mensagem.chat.type == enums.ChatType.CHANNEL and 
@@ -96,7 +1133,214 @@ def criar_barra_progresso(percentual):
     preenchido = int(percentual/10)
     return f"[{'■' * preenchido}{'□' * (10 - preenchido)}]"
 
-def extrair_metadados_video(caminho_arquivo):
+# Estatísticas de bloqueio do event loop (atualizadas por monitorar_bloqueio_loop, exportadas no /metrics)
+ESTATISTICAS_LOOP = {'ultimo_atraso': 0.0, 'maior_atraso': 0.0, 'bloqueios': 0}
+
+async def monitorar_bloqueio_loop():
+    """Mede quanto tempo o event loop fica travado e registra quando passa do limite"""
+    while True:
+        inicio = time.perf_counter()
+        await asyncio.sleep(Config.INTERVALO_MONITOR_LOOP)
+        atraso = time.perf_counter() - inicio - Config.INTERVALO_MONITOR_LOOP
+        ESTATISTICAS_LOOP['ultimo_atraso'] = atraso
+        ESTATISTICAS_LOOP['maior_atraso'] = max(ESTATISTICAS_LOOP['maior_atraso'], atraso)
+        if atraso > Config.LIMITE_BLOQUEIO_LOOP:
+            ESTATISTICAS_LOOP['bloqueios'] += 1
+            logger.warning(f"Event loop bloqueado por {atraso:.2f}s")
+
+async def executar_processo(cmd, timeout=None):
+    """
+    Executa um subprocesso sem bloquear o event loop
+    - Mata o processo em caso de timeout ou cancelamento da tarefa
+    - Levanta CalledProcessError se o código de saída for diferente de zero
+    """
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        with METRICAS.cronometrar('bot_operacao_segundos', operacao=os.path.basename(cmd[0])):
+            stdout, stderr = await asyncio.wait_for(process.communicate(), timeout)
+    except (asyncio.TimeoutError, asyncio.CancelledError):
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+
+    if process.returncode != 0:
+        raise subprocess.CalledProcessError(process.returncode, cmd, stdout, stderr)
+    return stdout
+
+TAMANHO_ALVO_CONVERSAO = 1.90 * 1024 * 1024 * 1024  # ~1.90GB, margem abaixo do TAMANHO_MAXIMO
+
+# Cache em memória das sondagens do ffprobe: (caminho, tamanho, mtime) -> metadados
+CACHE_METADADOS = OrderedDict()
+LIMITE_CACHE_METADADOS = 256
+JANELA_KEYFRAMES = 30  # Segundos iniciais lidos para estimar o intervalo entre keyframes
+
+def _interpretar_ffprobe(data, tamanho):
+    """Converte a saída JSON do ffprobe no dicionário de metadados usado pelo bot"""
+    formato = data.get('format', {})
+    streams = data.get('streams', [])
+    video = next((s for s in streams if s.get('codec_type') == 'video'), None)
+    audio = next((s for s in streams if s.get('codec_type') == 'audio'), None)
+
+    keyframes = []
+    if video is not None:
+        keyframes = sorted(
+            float(p['pts_time']) for p in data.get('packets', [])
+            if p.get('stream_index') == video['index'] and 'K' in p.get('flags', '') and p.get('pts_time') not in (None, 'N/A')
+        )
+    intervalos = [b - a for a, b in zip(keyframes, keyframes[1:])]
+
+    def _int(valor):
+        try:
+            return int(valor)
+        except (TypeError, ValueError):
+            return None
+
+    return {
+        'duracao': float(formato.get('duration') or 0),
+        'tamanho': tamanho,
+        'formato': formato.get('format_name'),
+        'bitrate_total': _int(formato.get('bit_rate')),
+        'largura': _int(video.get('width')) if video else None,
+        'altura': _int(video.get('height')) if video else None,
+        'codec_video': video.get('codec_name') if video else None,
+        'perfil_video': video.get('profile') if video else None,
+        'pix_fmt': video.get('pix_fmt') if video else None,
+        'bitrate_video': _int(video.get('bit_rate')) if video else None,
+        'codec_audio': audio.get('codec_name') if audio else None,
+        'bitrate_audio': _int(audio.get('bit_rate')) if audio else None,
+        'canais_audio': _int(audio.get('channels')) if audio else None,
+        'keyframes': keyframes,
+        'intervalo_keyframes': sum(intervalos) / len(intervalos) if intervalos else None,
+        'streams': streams,
+    }
+
+async def sondar_midia(caminho_arquivo):
+    """
+    Sonda o arquivo com uma única chamada JSON ao ffprobe
+    - Formato, streams, codecs, bitrates e keyframes dos primeiros segundos
+    - Resultado memorizado por (caminho, tamanho, mtime) e compartilhado entre chamadas
+    """
+    stat = os.stat(caminho_arquivo)
+    chave = (os.path.abspath(caminho_arquivo), stat.st_size, stat.st_mtime_ns)
+    if chave in CACHE_METADADOS:
+        CACHE_METADADOS.move_to_end(chave)
+        return CACHE_METADADOS[chave]
+
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-show_format', '-show_streams',
+        '-show_entries', 'packet=stream_index,pts_time,flags',
+        '-read_intervals', f'%+{JANELA_KEYFRAMES}',
+        '-of', 'json',
+        caminho_arquivo
+    ]
+    stdout = await executar_processo(cmd, timeout=Config.TIMEOUT_FFPROBE)
+    metadados = _interpretar_ffprobe(json.loads(stdout), stat.st_size)
+
+    CACHE_METADADOS[chave] = metadados
+    while len(CACHE_METADADOS) > LIMITE_CACHE_METADADOS:
+        CACHE_METADADOS.popitem(last=False)
+    return metadados
+
+def impressao_digital_midia(caminho_arquivo):
+    """Endereço de conteúdo barato: tamanho + amostras de 1MB do início, meio e fim"""
+    tamanho = os.path.getsize(caminho_arquivo)
+    bloco = 1024 * 1024
+    h = hashlib.sha256(str(tamanho).encode())
+    with open(caminho_arquivo, 'rb') as f:
+        for posicao in (0, max(0, tamanho // 2 - bloco // 2), max(0, tamanho - bloco)):
+            f.seek(posicao)
+            h.update(f.read(bloco))
+    return h.hexdigest()[:32]
+
+def limpar_cache_thumbnails():
+    """Remove as thumbnails usadas há mais tempo até o cache caber em LIMITE_CACHE_THUMB"""
+    arquivos = []
+    for nome in os.listdir(Config.PASTA_THUMB):
+        caminho = os.path.join(Config.PASTA_THUMB, nome)
+        try:
+            stat = os.stat(caminho)
+        except FileNotFoundError:
+            continue
+        arquivos.append((stat.st_mtime, stat.st_size, caminho))
+
+    total = sum(tamanho for _, tamanho, _ in arquivos)
+    for _, tamanho, caminho in sorted(arquivos):
+        if total <= Config.LIMITE_CACHE_THUMB:
+            break
+        try:
+            os.remove(caminho)
+        except FileNotFoundError:
+            pass
+        total -= tamanho
+
+async def obter_thumbnail(caminho_arquivo, metadados=None, origem_path=None):
+    """
+    Thumbnail JPEG (até 320px) com cache endereçado pelo conteúdo em PASTA_THUMB
+    - Seek na entrada e só keyframes decodificados; quadros quase pretos são descartados
+    - origem_path: arquivo de onde o vídeo foi convertido, cuja thumbnail é reaproveitada
+    """
+    fonte = origem_path if origem_path and os.path.exists(origem_path) else caminho_arquivo
+    chave = await asyncio.to_thread(impressao_digital_midia, fonte)
+    caminho_thumbnail = os.path.join(Config.PASTA_THUMB, f"{chave}.jpg")
+    if os.path.exists(caminho_thumbnail):
+        os.utime(caminho_thumbnail)
+        return caminho_thumbnail
+
+    if metadados is None or fonte != caminho_arquivo:
+        metadados = await sondar_midia(fonte)
+    return await _gerar_thumbnail(fonte, metadados['duracao'], caminho_thumbnail)
+
+async def obter_thumbnail_url(fonte):
+    """Thumbnail de uma fonte de streaming, lida direto da URL (só o trecho do keyframe é baixado)"""
+    endereco = f"{fonte['url'].split('?')[0]}:{fonte['tamanho']}"
+    chave = hashlib.sha256(endereco.encode()).hexdigest()[:32]
+    caminho_thumbnail = os.path.join(Config.PASTA_THUMB, f"{chave}.jpg")
+    if os.path.exists(caminho_thumbnail):
+        os.utime(caminho_thumbnail)
+        return caminho_thumbnail
+    cabecalhos = "".join(f"{nome}: {valor}\r\n" for nome, valor in fonte['headers'].items())
+    return await _gerar_thumbnail(fonte['url'], fonte['duracao'], caminho_thumbnail, ['-headers', cabecalhos])
+
+async def _gerar_thumbnail(entrada, duracao, caminho_thumbnail, opcoes_entrada=()):
+    """Extrai a thumbnail de entrada (arquivo ou URL) para caminho_thumbnail; None se falhar"""
+    duracao = duracao or 0
+    tempo_busca = min(duracao * 0.1, 30) if duracao > 2 else 0
+
+    escala = "scale=320:320:force_original_aspect_ratio=decrease"
+    sem_pretos = (
+        "blackframe=amount=0:threshold=32,"
+        "metadata=mode=select:key=lavfi.blackframe.pblack:value=90:function=less"
+    )
+    temporario = f"{caminho_thumbnail}.{time.time_ns()}.tmp.jpg"
+    try:
+        # Primeiro entre os keyframes que não são pretos; se todos forem, aceita qualquer um
+        for filtros in (f"{sem_pretos},thumbnail=5,{escala}", f"thumbnail=5,{escala}"):
+            try:
+                await executar_processo([
+                    'ffmpeg', '-y', '-v', 'error',
+                    '-skip_frame', 'nokey', '-ss', f'{tempo_busca:.2f}', *opcoes_entrada, '-i', entrada,
+                    '-an', '-sn', '-vf', filtros,
+                    '-frames:v', '1', '-q:v', '5', temporario
+                ], timeout=Config.TIMEOUT_THUMBNAIL)
+            except Exception as e:
+                logger.warning(f"Falha ao gerar thumbnail: {str(e)[:200]}")
+                continue
+            if os.path.exists(temporario) and os.path.getsize(temporario) > 0:
+                os.replace(temporario, caminho_thumbnail)
+                limpar_cache_thumbnails()
+                return caminho_thumbnail
+        return None
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+async def extrair_metadados_video(caminho_arquivo):
     """Extrai metadados do vídeo (duração, dimensões, thumbnail)"""
     try:
         if not os.path.exists(caminho_arquivo):
@@ -105,131 +1349,587 @@ def extrair_metadados_video(caminho_arquivo):
         if os.path.getsize(caminho_arquivo) == 0:
             raise Exception("Arquivo vazio")
 
-        # Comandos para extrair duração e dimensões
-        comando_duracao = [
-            'ffprobe', '-v', 'error',
-            '-show_entries', 'format=duration',
-            '-of', 'default=noprint_wrappers=1:nokey=1',
-            caminho_arquivo
+        metadados = await sondar_midia(caminho_arquivo)
+        if metadados['largura'] is None:
+            raise Exception("Nenhum stream de vídeo encontrado")
+
+        return {
+            'duracao': int(metadados['duracao']),
+            'largura': metadados['largura'],
+            'altura': metadados['altura'],
+            'caminho_thumbnail': await obter_thumbnail(caminho_arquivo, metadados)
+        }
+
+    except Exception as e:
+        logger.error(f"Erro ao extrair metadados: {str(e)}")
+        return None
+
+async def extrair_metadados_detalhados(video_path):
+    """Extrai metadados detalhados usando FFprobe"""
+    try:
+        metadados = await sondar_midia(video_path)
+        if metadados['largura'] is None:
+            raise Exception("Nenhum stream de vídeo encontrado")
+
+        bitrate = metadados['bitrate_video']
+        return {
+            'duration': metadados['duracao'],
+            'width': metadados['largura'],
+            'height': metadados['altura'],
+            'bitrate': bitrate // 1000 if bitrate else None
+        }
+    except Exception as e:
+        logger.error(f"Erro ao extrair metadados detalhados: {str(e)}")
+        return None
+
+async def reduzir_video_adicional(input_path, duration, msg_status, bitrate_anterior=None, origem_path=None):
+    """
+    Reduz o vídeo convertido até caber no limite
+    - Usa o tamanho do os.stat e os metadados em cache (nunca lê o arquivo)
+    - Cada tentativa corrige o bitrate pelo erro de tamanho medido na anterior
+    - Recodifica a partir da origem, se disponível, para não acumular perdas
+    """
+    BITRATE_AUDIO = 64  # kbps - reduzir áudio também
+    origem = origem_path if origem_path and os.path.exists(origem_path) else input_path
+    bitrate_pedido = bitrate_anterior
+
+    for tentativa in range(1, Config.MAX_TENTATIVAS_REDUCAO + 1):
+        tamanho_atual = os.stat(input_path).st_size
+        if tamanho_atual <= Config.TAMANHO_MAXIMO:
+            return
+
+        metadados = await sondar_midia(input_path)
+        bitrate_audio_atual = (metadados['bitrate_audio'] or 96000) / 1000  # kbps
+        bitrate_video_medido = (tamanho_atual * 8 / (duration * 1000)) - bitrate_audio_atual
+        if not bitrate_pedido:
+            bitrate_pedido = bitrate_video_medido
+
+        # Quanto o encoder gerou a mais em relação ao bitrate pedido
+        fator_erro = bitrate_video_medido / bitrate_pedido
+        espaco_video = TAMANHO_ALVO_CONVERSAO - (BITRATE_AUDIO * 1000 / 8) * duration
+        new_bitrate = int((espaco_video * 8 / (duration * 1000)) / fator_erro * 0.97)
+        new_bitrate = min(new_bitrate, int(bitrate_pedido * 0.95))  # Sempre reduzir
+        if new_bitrate < 100:
+            raise Exception("Vídeo muito longo para o tamanho alvo")
+
+        new_maxrate = int(new_bitrate * 1.4)
+        new_bufsize = int(new_bitrate * 2)
+
+        await EDITOR_STATUS.editar(msg_status, 
+            f"⚠️ Ajustando bitrate para {new_bitrate}kbps "
+            f"(tentativa {tentativa}/{Config.MAX_TENTATIVAS_REDUCAO})..."
+        )
+
+        output_path = input_path + ".reduced.mp4"
+
+        cmd = [
+            'ffmpeg', '-y', '-i', origem,
+            '-c:v', 'libx264',
+            '-b:v', f'{new_bitrate}k',
+            '-maxrate', f'{new_maxrate}k',
+            '-bufsize', f'{new_bufsize}k',
+            '-preset', 'fast',
+            '-profile:v', 'main',
+            '-pix_fmt', 'yuv420p',
+            '-movflags', '+faststart',
+            '-c:a', 'aac',
+            '-b:a', f'{BITRATE_AUDIO}k',
+            '-ac', '2',
+            output_path
+        ]
+
+        try:
+            await executar_ffmpeg_monitorado(
+                cmd, duration, msg_status,
+                f"Reduzindo vídeo ({new_bitrate}kbps, tentativa {tentativa}/{Config.MAX_TENTATIVAS_REDUCAO})"
+            )
+        except Exception as e:
+            if os.path.exists(output_path):
+                os.remove(output_path)
+            raise Exception(f"Falha ao reduzir adicionalmente: {str(e)[:200]}")
+
+        os.replace(output_path, input_path)
+        bitrate_pedido = new_bitrate
+
+    if os.stat(input_path).st_size > Config.TAMANHO_MAXIMO:
+        raise Exception(f"Vídeo ainda acima do limite após {Config.MAX_TENTATIVAS_REDUCAO} tentativas")
+
+def interpretar_progresso_ffmpeg(estado, duracao):
+    """Converte o bloco chave=valor do -progress do ffmpeg em tempo, percentual, fps, velocidade e ETA"""
+    tempo = 0.0
+    if estado.get('out_time_us', 'N/A').isdigit():
+        tempo = int(estado['out_time_us']) / 1_000_000
+    elif estado.get('out_time_ms', 'N/A').isdigit():
+        tempo = int(estado['out_time_ms']) / 1_000_000  # Apesar do nome, o ffmpeg informa microssegundos
+
+    try:
+        velocidade = float(estado.get('speed', '').rstrip('x'))
+    except ValueError:
+        velocidade = 0.0
+    try:
+        fps = float(estado.get('fps', 0))
+    except ValueError:
+        fps = 0.0
+
+    percentual = min(100.0, (tempo / duracao) * 100) if duracao > 0 else 0.0
+    eta = (duracao - tempo) / velocidade if velocidade > 0 and duracao > tempo else 0.0
+    return {
+        'tempo': tempo,
+        'percentual': percentual,
+        'fps': fps,
+        'velocidade': velocidade,
+        'eta': eta,
+    }
+
+async def executar_ffmpeg_monitorado(cmd, duracao, msg_status, descricao):
+    """
+    Executa o ffmpeg lendo o fluxo -progress para atualizar a mensagem de status
+    - Progresso real: tempo processado vs. duração, fps, velocidade e ETA
+    - O stderr é drenado continuamente para um buffer circular (evita travar o pipe)
+    """
+    cmd = [cmd[0], '-hide_banner', '-progress', 'pipe:1', '-nostats', *cmd[1:]]
+    inicio = time.perf_counter()
+    process = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+
+    linhas_erro = deque(maxlen=Config.LINHAS_ERRO_FFMPEG)
+
+    async def drenar_stderr():
+        async for linha in process.stderr:
+            linhas_erro.append(linha.decode(errors='replace').rstrip())
+
+    leitor_erro = asyncio.create_task(drenar_stderr())
+    estado = {}
+    ultimo_envio = 0
+
+    try:
+        async for linha in process.stdout:
+            chave, _, valor = linha.decode(errors='replace').strip().partition('=')
+            estado[chave] = valor
+            if chave != 'progress':
+                continue
+
+            agora = time.time()
+            if agora - ultimo_envio < Config.INTERVALO_COLETA_PROGRESSO:
+                continue
+            ultimo_envio = agora
+
+            progresso = interpretar_progresso_ffmpeg(estado, duracao)
+            EDITOR_STATUS.atualizar(
+                msg_status,
+                f"🔄 {descricao}\n"
+                f"{criar_barra_progresso(progresso['percentual'])} {progresso['percentual']:.1f}%\n"
+                f"🎞️ {progresso['fps']:.0f} fps | ⚡ {progresso['velocidade']:.2f}x\n"
+                f"⏱️ {progresso['eta']:.0f}s restantes"
+            )
+
+        await process.wait()
+        await leitor_erro
+        METRICAS.observar('bot_operacao_segundos', time.perf_counter() - inicio, operacao='ffmpeg')
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        leitor_erro.cancel()
+        raise
+
+    # Verificar resultado
+    if process.returncode != 0:
+        erro = " | ".join(list(linhas_erro)[-5:])
+        raise Exception(f"Falha na conversão: {erro[-200:]}")
+
+async def tentar_remux(origem, destino, metadados):
+    """
+    Tenta reduzir o arquivo só trocando o container (-c copy)
+    - Mantém apenas o primeiro vídeo e o primeiro áudio, descartando faixas extras
+    - Só roda quando a estimativa pelos bitrates dos streams já cabe no limite
+    """
+    if metadados['codec_video'] != 'h264' or metadados['codec_audio'] not in ('aac', 'mp3', None):
+        return False
+    if not metadados['bitrate_video']:
+        return False
+
+    bitrate_total = metadados['bitrate_video'] + (metadados['bitrate_audio'] or 0)
+    estimativa = bitrate_total / 8 * metadados['duracao']
+    if estimativa > Config.TAMANHO_MAXIMO * 0.98:
+        return False
+
+    cmd = [
+        'ffmpeg', '-y', '-i', origem,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        '-c', 'copy',
+        '-movflags', '+faststart',
+        '-f', 'mp4',
+        destino
+    ]
+    try:
+        await executar_processo(cmd)
+    except Exception as e:
+        logger.info(f"Remux falhou, seguindo para recodificação: {str(e)[:200]}")
+        return False
+
+    if os.path.getsize(destino) <= Config.TAMANHO_MAXIMO:
+        return True
+    os.remove(destino)
+    return False
+
+# Codecs de áudio que o Telegram reproduz em streaming sem conversão (None: vídeo sem áudio)
+CODECS_AUDIO_STREAMING = ('aac', 'mp3', None)
+
+MAXIMO_ATOMOS_FASTSTART = 16  # Átomos de topo examinados antes de desistir de achar moov/mdat
+
+def _cabecalho_atomo(dados):
+    """(tamanho, tipo) de um átomo MP4 a partir dos seus primeiros 16 bytes; tamanho None se inválido"""
+    if len(dados) < 8:
+        return None, None
+    tamanho, tipo = struct.unpack('>I4s', dados[:8])
+    if tamanho == 1:
+        tamanho = struct.unpack('>Q', dados[8:16])[0] if len(dados) >= 16 else 0
+    return (tamanho if tamanho >= 8 else None), tipo
+
+def moov_no_inicio(caminho_arquivo):
+    """Verifica se o átomo moov vem antes do mdat (MP4 com +faststart)"""
+    with open(caminho_arquivo, 'rb') as f:
+        while True:
+            posicao = f.tell()
+            tamanho, tipo = _cabecalho_atomo(f.read(16))
+            if tipo == b'moov':
+                return True
+            if tipo == b'mdat' or tamanho is None:
+                return False
+            f.seek(posicao + tamanho)
+
+async def moov_no_inicio_url(url_midia, headers, tamanho_arquivo):
+    """Mesma verificação do moov_no_inicio, lendo só os cabeçalhos dos átomos por requisições Range"""
+    posicao = 0
+    for _ in range(MAXIMO_ATOMOS_FASTSTART):
+        if posicao + 8 > tamanho_arquivo:
+            return False
+        cabecalhos = {**headers, 'Range': f'bytes={posicao}-{posicao + 15}'}
+        async with obter_sessao_http().get(url_midia, headers=cabecalhos) as response:
+            if response.status != 206:
+                return False
+            tamanho, tipo = _cabecalho_atomo(await response.content.read(16))
+        if tipo == b'moov':
+            return True
+        if tipo == b'mdat' or tamanho is None:
+            return False
+        posicao += tamanho
+    return False
+
+def escolher_preparo(metadados, faststart):
+    """
+    Decide o mínimo de trabalho para o vídeo tocar em streaming no Telegram
+    - original: MP4 H.264 8 bits, áudio AAC/MP3 e moov no início
+    - remux: mesmos codecs, só falta o container MP4 ou o +faststart
+    - audio: vídeo compatível, apenas o áudio vira AAC
+    - completo: vídeo incompatível, recodificação inteira
+    """
+    if metadados['codec_video'] is None:
+        return 'original'
+    if metadados['codec_video'] != 'h264' or metadados['pix_fmt'] not in ('yuv420p', 'yuvj420p', None):
+        return 'completo'
+    if metadados['codec_audio'] not in CODECS_AUDIO_STREAMING:
+        return 'audio'
+    if 'mp4' not in (metadados['formato'] or '').split(',') or not faststart:
+        return 'remux'
+    return 'original'
+
+# Fila do Agendador de cada modo de preparo (None: nada a fazer, a etapa é pulada)
+# Só a recodificação do vídeo disputa a fila de transcodificação com o /conv
+FILAS_PREPARO = {'original': None, 'remux': 'preparo', 'audio': 'preparo', 'completo': 'transcodificacao'}
+
+async def rotear_preparo(tarefa, caminho_arquivo):
+    """
+    Decide o preparo ainda na etapa de download (uma sondagem + moov_no_inicio)
+    - Coloca a próxima etapa da tarefa na fila do modo (FILAS_PREPARO)
+    - Retorna (modo, metadados) para o preparar_para_telegram, ou None se não há preparo
+    """
+    try:
+        metadados = await sondar_midia(caminho_arquivo)
+        modo = escolher_preparo(metadados, await asyncio.to_thread(moov_no_inicio, caminho_arquivo))
+    except Exception as e:
+        logger.warning(f"Sondagem para o preparo falhou, enviando como foi baixado: {str(e)[:200]}")
+        modo, metadados = 'original', None
+    AGENDADOR.direcionar_proxima_etapa(tarefa, FILAS_PREPARO[modo])
+    return (modo, metadados) if FILAS_PREPARO[modo] else None
+
+async def preparar_para_telegram(caminho_arquivo, msg_status, modo, metadados):
+    """
+    Etapa pós-download: deixa o vídeo pronto para streaming com o mínimo de trabalho
+    - modo/metadados vêm do rotear_preparo: remux, converter só o áudio ou recodificar
+    - O arquivo é substituído no lugar
+    """
+
+    audio_compativel = metadados['codec_audio'] in CODECS_AUDIO_STREAMING
+    if modo == 'remux':
+        codecs = ['-c', 'copy']
+    elif modo == 'audio':
+        codecs = ['-c:v', 'copy', '-c:a', 'aac', '-b:a', '128k']
+    else:
+        codecs = [
+            '-c:v', 'libx264', '-preset', Config.PRESET_CONVERSAO,
+            '-crf', str(Config.CRF_CONVERSAO), '-pix_fmt', 'yuv420p',
+            *(['-c:a', 'copy'] if audio_compativel else ['-c:a', 'aac', '-b:a', '128k'])
         ]
-        comando_dimensoes = [
-            'ffprobe', '-v', 'error',
-            '-select_streams', 'v:0',
-            '-show_entries', 'stream=width,height',
-            '-of', 'csv=p=0',
-            caminho_arquivo
+
+    temporario = caminho_arquivo + ".preparo.mp4"
+    cmd = [
+        'ffmpeg', '-y', '-i', caminho_arquivo,
+        '-map', '0:v:0', '-map', '0:a:0?',
+        *codecs,
+        '-movflags', '+faststart',
+        '-f', 'mp4',
+        temporario
+    ]
+    inicio = time.time()
+    try:
+        if modo == 'remux':
+            await EDITOR_STATUS.editar(msg_status, "📦 Ajustando o container para streaming...")
+            await executar_processo(cmd)
+        else:
+            descricao = "Convertendo o áudio para AAC" if modo == 'audio' else "Convertendo vídeo para H.264"
+            await EDITOR_STATUS.editar(msg_status, f"🔄 {descricao}...")
+            await executar_ffmpeg_monitorado(cmd, metadados['duracao'], msg_status, descricao)
+        os.replace(temporario, caminho_arquivo)
+    finally:
+        if os.path.exists(temporario):
+            os.remove(temporario)
+
+    logger.info(
+        f"Preparo de {caminho_arquivo}: {modo} ({metadados['codec_video']}/{metadados['codec_audio']}) "
+        f"em {time.time() - inicio:.1f}s"
+    )
+
+def montar_comandos_conversao(modo, origem, destino, bitrate_video_kbps, maxrate, bufsize, bitrate_audio, passlog):
+    """Monta a lista de comandos FFmpeg para o modo de conversão escolhido"""
+    comum_video = ['-c:v', 'libx264', '-profile:v', 'main', '-pix_fmt', 'yuv420p']
+    comum_audio = ['-c:a', 'aac', '-b:a', f'{bitrate_audio}k', '-ac', '2']
+    saida = ['-movflags', '+faststart', '-f', 'mp4', destino]
+
+    if modo == "dois_passos":
+        # 1º passo rápido só para análise (x264 usa primeiro passo turbo), 2º passo com o bitrate exato
+        return [
+            ['ffmpeg', '-y', '-i', origem, *comum_video,
+             '-b:v', f'{bitrate_video_kbps}k', '-preset', Config.PRESET_CONVERSAO,
+             '-pass', '1', '-passlogfile', passlog,
+             '-an', '-f', 'null', os.devnull],
+            ['ffmpeg', '-y', '-i', origem, *comum_video,
+             '-b:v', f'{bitrate_video_kbps}k', '-maxrate', f'{maxrate}k', '-bufsize', f'{bufsize}k',
+             '-preset', Config.PRESET_CONVERSAO,
+             '-pass', '2', '-passlogfile', passlog,
+             *comum_audio, *saida],
         ]
 
-        duracao = float(subprocess.check_output(comando_duracao).decode('utf-8').strip())
-        dimensoes = subprocess.check_output(comando_dimensoes).decode('utf-8').strip().split(',')
+    if modo == "crf":
+        # Qualidade constante, com o VBV limitando a média ao bitrate que cabe no alvo
+        return [
+            ['ffmpeg', '-y', '-i', origem, *comum_video,
+             '-crf', str(Config.CRF_CONVERSAO),
+             '-maxrate', f'{bitrate_video_kbps}k', '-bufsize', f'{bitrate_video_kbps * 2}k',
+             '-preset', Config.PRESET_CONVERSAO,
+             *comum_audio, *saida],
+        ]
+
+    # Passo único com bitrate médio
+    return [
+        ['ffmpeg', '-y', '-i', origem, *comum_video,
+         '-b:v', f'{bitrate_video_kbps}k', '-maxrate', f'{maxrate}k', '-bufsize', f'{bufsize}k',
+         '-preset', 'slow',
+         *comum_audio, *saida],
+    ]
+
+async def converter_em_segmentos(origem, destino, duracao, bitrate_video_kbps, maxrate, bufsize,
+                                 bitrate_audio, msg_status, pasta_temp):
+    """
+    Conversão paralela por segmentos para vídeos longos
+    - Corta a origem nos keyframes (-c copy) em vários pedaços só de vídeo
+    - Codifica os pedaços em paralelo, com orçamento de bitrate proporcional à complexidade
+      (tamanho original do pedaço) e maxrate/bufsize iguais para manter o mesmo SPS
+    - O áudio é codificado uma vez em paralelo e tudo é concatenado com -c copy
+    - Se um pedaço falhar, os demais são cancelados antes de a pasta ser apagada
+    """
+    workers = Config.SEGMENTOS_PARALELOS
+    quantidade = max(1, min(int(duracao // Config.DURACAO_MINIMA_SEGMENTO), workers * 2))
+    if quantidade < 2:
+        return False
+
+    os.makedirs(pasta_temp, exist_ok=True)
+    duracao_segmento = duracao / quantidade
+    tempos = ",".join(f"{duracao_segmento * i:.3f}" for i in range(1, quantidade))
+
+    await EDITOR_STATUS.editar(msg_status, f"✂️ Dividindo vídeo em {quantidade} segmentos...")
+    await executar_processo([
+        'ffmpeg', '-y', '-v', 'error', '-i', origem,
+        '-map', '0:v:0', '-c', 'copy',
+        '-f', 'segment', '-segment_times', tempos, '-reset_timestamps', '1',
+        os.path.join(pasta_temp, 'orig_%03d.mp4')
+    ])
+    pedacos = sorted(f for f in os.listdir(pasta_temp) if f.startswith('orig_'))
+    tamanhos = [os.path.getsize(os.path.join(pasta_temp, p)) for p in pedacos]
+    total_origem = sum(tamanhos) or 1
+    # Orçamento a partir do bitrate já limitado, não do espaço bruto do alvo
+    espaco_video = bitrate_video_kbps * 1000 / 8 * duracao
+
+    limite = asyncio.Semaphore(workers)
+    threads = str(max(1, (os.cpu_count() or 1) // workers))
+    concluidos = 0
+
+    async def codificar(indice, nome, tamanho):
+        nonlocal concluidos
+        entrada = os.path.join(pasta_temp, nome)
+        saida = os.path.join(pasta_temp, f"enc_{indice:03d}.mp4")
+        duracao_pedaco = (await sondar_midia(entrada))['duracao'] or duracao_segmento
+        orcamento = espaco_video * tamanho / total_origem
+        bitrate = int(orcamento * 8 / (1000 * duracao_pedaco))
+        bitrate = max(int(bitrate_video_kbps * 0.5), min(bitrate, maxrate))
 
-        # Gerar thumbnail
-        caminho_thumbnail = os.path.join(Config.PASTA_THUMB, f"thumb_{os.path.basename(caminho_arquivo)}.jpg")
-        if os.path.exists(caminho_thumbnail):
-            os.remove(caminho_thumbnail)
+        async with limite:
+            await executar_processo([
+                'ffmpeg', '-y', '-v', 'error', '-i', entrada,
+                '-c:v', 'libx264', '-profile:v', 'main', '-pix_fmt', 'yuv420p',
+                '-b:v', f'{bitrate}k', '-maxrate', f'{maxrate}k', '-bufsize', f'{bufsize}k',
+                '-preset', Config.PRESET_CONVERSAO, '-threads', threads,
+                saida
+            ])
+        concluidos += 1
+        EDITOR_STATUS.atualizar(
+            msg_status,
+            f"🧩 Convertendo em segmentos...\n"
+            f"{criar_barra_progresso(concluidos / len(pedacos) * 100)} {concluidos}/{len(pedacos)}"
+        )
+        return saida
 
-        tempo_busca = min(30, float(duracao) - 1)
+    audio_path = os.path.join(pasta_temp, "audio.m4a")
+    tarefas = [
+        asyncio.create_task(codificar(i, nome, tamanho))
+        for i, (nome, tamanho) in enumerate(zip(pedacos, tamanhos))
+    ]
+    tarefas.append(asyncio.create_task(executar_processo([
+        'ffmpeg', '-y', '-v', 'error', '-i', origem,
+        '-vn', '-c:a', 'aac', '-b:a', f'{bitrate_audio}k', '-ac', '2',
+        audio_path
+    ])))
+    try:
+        *codificados, _ = await asyncio.gather(*tarefas)
+    except BaseException:
+        # gather não cancela os irmãos: sem isso, ffmpegs seguiriam escrevendo na pasta removida
+        for t in tarefas:
+            t.cancel()
+        await asyncio.gather(*tarefas, return_exceptions=True)
+        raise
 
-        subprocess.run([
-            'ffmpeg', '-y', '-ss', str(tempo_busca), '-i', caminho_arquivo,
-            '-vframes', '1', '-q:v', '2', caminho_thumbnail
-        ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    lista = os.path.join(pasta_temp, "lista.txt")
+    with open(lista, 'w') as f:
+        f.writelines(f"file '{os.path.abspath(caminho)}'\n" for caminho in codificados)
 
-        return {
-            'duracao': int(duracao),
-            'largura': int(dimensoes[0]),
-            'altura': int(dimensoes[1]),
-            'caminho_thumbnail': caminho_thumbnail if os.path.exists(caminho_thumbnail) else None
-        }
+    await EDITOR_STATUS.editar(msg_status, "🔗 Juntando segmentos...")
+    await executar_processo([
+        'ffmpeg', '-y', '-v', 'error',
+        '-f', 'concat', '-safe', '0', '-i', lista,
+        '-i', audio_path,
+        '-map', '0:v:0', '-map', '1:a:0?',
+        '-c', 'copy', '-movflags', '+faststart', '-f', 'mp4',
+        destino
+    ])
+    return True
 
-    except Exception as e:
-        logger.error(f"Erro ao extrair metadados: {str(e)}")
-        return None
+async def converter_para_tamanho_alvo(origem, destino, msg_status, prefixo_temp, modo=None):
+    """
+    Converte o vídeo para caber em TAMANHO_ALVO_CONVERSAO
+    - Primeiro tenta só remux (sem recodificar)
+    - Depois recodifica no modo escolhido (padrão: Config.MODO_CONVERSAO)
+    - Retorna o bitrate de vídeo usado (None quando bastou o remux)
+    """
+    modo = modo or Config.MODO_CONVERSAO
+    passlog = prefixo_temp + "_passlog"
+    pasta_segmentos = prefixo_temp + "_segmentos"
+    metadados = await sondar_midia(origem)
+    duracao_segundos = metadados['duracao']
+    if duracao_segundos <= 0:
+        raise Exception("Duração inválida do vídeo")
 
-def extrair_metadados_detalhados(video_path):
-    """Extrai metadados detalhados usando FFprobe"""
-    try:
-        cmd = [
-            'ffprobe', '-v', 'error',
-            '-show_entries', 'format=duration:stream=width,height,bit_rate',
-            '-of', 'json',
-            video_path
-        ]
-        
-        result = subprocess.run(cmd, capture_output=True, text=True)
-        data = json.loads(result.stdout)
-        
-        duration = float(data['format']['duration'])
-        video_stream = next(s for s in data['streams'] if s['codec_type'] == 'video')
-        
-        return {
-            'duration': duration,
-            'width': int(video_stream['width']),
-            'height': int(video_stream['height']),
-            'bitrate': int(video_stream.get('bit_rate', 0)) // 1000 if video_stream.get('bit_rate') else None
-        }
-    except Exception as e:
-        logger.error(f"Erro ao extrair metadados detalhados: {str(e)}")
+    await EDITOR_STATUS.editar(msg_status, "📦 Verificando se basta trocar o container...")
+    if await tentar_remux(origem, destino, metadados):
+        logger.info(f"Remux suficiente para {origem}, recodificação evitada")
         return None
 
-async def reduzir_video_adicional(input_path, current_size, duration, msg_status):
-    """Reduz ainda mais o vídeo se necessário"""
-    TAMANHO_ALVO = 1.90 * 1024 * 1024 * 1024
-    
-    # Calcular novo bitrate (reduzir 20%)
-    with open(input_path, 'rb') as f:
-        content = f.read()
-        bitrate_actual = (len(content) * 8) / (duration * 1000)  # kbps
+    # Calcular bitrate de vídeo ideal para ~1.90GB
+    BITRATE_AUDIO = 96  # kbps
+    BITRATE_AUDIO_BYTES = BITRATE_AUDIO * 1000 / 8  # bytes por segundo
     
-    new_bitrate = int(bitrate_actual * 0.8)
-    new_maxrate = int(new_bitrate * 1.4)
-    new_bufsize = int(new_bitrate * 2)
+    # Calcular espaço disponível para vídeo
+    espaco_audio = BITRATE_AUDIO_BYTES * duracao_segundos
+    espaco_video = TAMANHO_ALVO_CONVERSAO - espaco_audio
     
-    await msg_status.edit(f"⚠️ Ajustando bitrate para {new_bitrate}kbps...")
+    if espaco_video <= 0:
+        raise Exception("Vídeo muito longo para o tamanho alvo")
     
-    output_path = input_path + ".reduced.mp4"
-    
-    cmd = [
-        'ffmpeg', '-y', '-i', input_path,
-        '-c:v', 'libx264',
-        '-b:v', f'{new_bitrate}k',
-        '-maxrate', f'{new_maxrate}k',
-        '-bufsize', f'{new_bufsize}k',
-        '-preset', 'fast',
-        '-profile:v', 'main',
-        '-pix_fmt', 'yuv420p',
-        '-movflags', '+faststart',
-        '-c:a', 'aac',
-        '-b:a', '64k',  # Reduzir áudio também
-        '-ac', '2',
-        output_path
-    ]
+    # Calcular bitrate de vídeo em kbps
+    bitrate_video_kbps = int((espaco_video * 8) / (1000 * duracao_segundos))
     
-    process = await asyncio.create_subprocess_exec(*cmd)
-    await process.wait()
+    # Ajustar bitrate máximo e buffer
+    maxrate = int(bitrate_video_kbps * 1.4)  # 40% acima do bitrate médio
+    bufsize = int(bitrate_video_kbps * 2)    # Tamanho do buffer
     
-    if process.returncode == 0 and os.path.exists(output_path):
-        os.replace(output_path, input_path)
-    else:
-        raise Exception("Falha ao reduzir adicionalmente")
+    # Limites de segurança
+    bitrate_video_kbps = max(500, min(bitrate_video_kbps, 8000))  # Entre 500kbps e 8000kbps
+    maxrate = max(700, min(maxrate, 10000))
+    bufsize = max(1000, min(bufsize, 16000))
+
+    inicio = time.time()
+    try:
+        if modo == "segmentado" and await converter_em_segmentos(
+            origem, destino, duracao_segundos, bitrate_video_kbps, maxrate, bufsize,
+            BITRATE_AUDIO, msg_status, pasta_segmentos
+        ):
+            pass
+        else:
+            if modo == "segmentado":
+                modo = "dois_passos"  # Vídeo curto demais para dividir
+            comandos = montar_comandos_conversao(
+                modo, origem, destino,
+                bitrate_video_kbps, maxrate, bufsize, BITRATE_AUDIO, passlog
+            )
+            for passo, cmd in enumerate(comandos, start=1):
+                descricao = f"Convertendo vídeo (bitrate: {bitrate_video_kbps}kbps)"
+                if len(comandos) > 1:
+                    descricao += f" - passo {passo}/{len(comandos)}"
+                await EDITOR_STATUS.editar(msg_status, f"🔄 {descricao}...")
+                await executar_ffmpeg_monitorado(cmd, duracao_segundos, msg_status, descricao)
+    finally:
+        for sufixo in ("-0.log", "-0.log.mbtree"):
+            if os.path.exists(passlog + sufixo):
+                os.remove(passlog + sufixo)
+        shutil.rmtree(pasta_segmentos, ignore_errors=True)
+
+    if not os.path.exists(destino):
+        raise Exception("Falha na conversão: arquivo de saída não foi gerado")
+
+    # Registro usado para comparar os modos de conversão (tempo de parede x duração do vídeo)
+    decorrido = time.time() - inicio
+    logger.info(
+        f"Conversão concluída: modo={modo} duração={duracao_segundos:.0f}s "
+        f"tempo={decorrido:.1f}s velocidade={duracao_segundos / decorrido:.2f}x "
+        f"tamanho={converter_bytes(os.path.getsize(destino))}"
+    )
+    return bitrate_video_kbps
 
-async def enviar_video_convertido(client, mensagem, video_path, msg_status):
+async def enviar_video_convertido(client, mensagem, video_path, tarefa, origem_path=None, legenda=None):
     """Envia o vídeo convertido com os parâmetros adequados"""
-    metadados = extrair_metadados_detalhados(video_path)
+    msg_status = tarefa.mensagem_status
+    metadados = await extrair_metadados_detalhados(video_path)
     if not metadados:
         raise Exception("Não foi possível obter metadados do vídeo convertido")
     
-    # Gerar thumbnail
-    thumb_path = os.path.join(Config.PASTA_THUMB, f"thumb_{os.path.basename(video_path)}.jpg")
-    if os.path.exists(thumb_path):
-        os.remove(thumb_path)
-    
-    subprocess.run([
-        'ffmpeg', '-y', '-ss', '00:00:05', '-i', video_path,
-        '-vframes', '1', '-q:v', '2', thumb_path
-    ], check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    # Mesma imagem do original: a thumbnail dele sai do cache
+    thumb_path = await obter_thumbnail(video_path, origem_path=origem_path)
     
-    await msg_status.edit("⬆️ Enviando vídeo convertido...")
+    await EDITOR_STATUS.editar(msg_status, "⬆️ Enviando vídeo convertido...")
+    tarefa.reiniciar_cronometro()
     
     params = {
         'chat_id': mensagem.chat.id,
@@ -237,58 +1937,102 @@ async def enviar_video_convertido(client, mensagem, video_path, msg_status):
         'duration': int(metadados['duration']),
         'width': metadados['width'],
         'height': metadados['height'],
-        'thumb': thumb_path if os.path.exists(thumb_path) else None,
+        'thumb': thumb_path,
+        'caption': legenda,
         'supports_streaming': True,
         'progress': callback_progresso,
-        'progress_args': (msg_status,)
+        'progress_args': (tarefa,)
     }
     
     if mensagem.reply_to_message:
         params['reply_to_message_id'] = mensagem.reply_to_message.id
     
     await client.send_video(**params)
-    await msg_status.delete()
-
-def tratar_flood_wait(func):
-    """Decorator para tratamento de FloodWait"""
-    @wraps(func)
-    async def wrapper(*args, **kwargs):
-        try:
-            return await func(*args, **kwargs)
-        except FloodWait as e:
-            logger.warning(f"FloodWait: Esperando {e.x} segundos")
-            await asyncio.sleep(e.x)
-            return await func(*args, **kwargs)
-    return wrapper
-
-# Função modificada para executar no loop principal
-def progresso_download(d, mensagem_status):
-    """Callback de progresso do yt-dlp que executa corretamente no event loop"""
-    global DOWNLOAD_CANCELADO, TAMANHO_TOTAL_ARQUIVO, LOOP
+    await EDITOR_STATUS.apagar(msg_status)
 
-    if DOWNLOAD_CANCELADO:
+def progresso_download(d, tarefa):
+    """Callback de progresso do yt-dlp (roda na thread do download)"""
+    if tarefa.download_cancelado:
         raise Exception("Download cancelado pelo usuário")
 
+    if d['status'] in ('downloading', 'finished'):
+        # Bytes novos desde o último aviso deste arquivo (faixas de vídeo e áudio contam em separado)
+        atual = d.get('downloaded_bytes') or 0
+        anterior = tarefa.bytes_ytdlp.get(d.get('filename'), 0)
+        tarefa.bytes_ytdlp[d.get('filename')] = atual
+        if atual > anterior:
+            METRICAS.incrementar('bot_bytes_transferidos_total', atual - anterior, direcao='download')
+
     if d['status'] == 'downloading':
+        agora = time.time()
+        if agora - tarefa.ultimo_tempo_atualizacao < Config.INTERVALO_COLETA_PROGRESSO:
+            return
+        tarefa.ultimo_tempo_atualizacao = agora
+
         baixado = d.get('downloaded_bytes', 0)
-        total = d.get('total_bytes') or d.get('total_bytes_estimate') or TAMANHO_TOTAL_ARQUIVO
-        
-        if total > 0 and LOOP:
-            # Criar uma future para executar no loop principal
-            asyncio.run_coroutine_threadsafe(
-                atualizar_progresso_download(baixado, total, mensagem_status),
-                LOOP
+        total = d.get('total_bytes') or d.get('total_bytes_estimate') or tarefa.tamanho_total_arquivo
+        if total > 0:
+            # Só o estado mais recente vai para o editor, no loop principal
+            tarefa.loop.call_soon_threadsafe(
+                EDITOR_STATUS.atualizar,
+                tarefa.mensagem_status, texto_progresso_download(baixado, total, tarefa), TECLADO_CANCELAR_DOWNLOAD
             )
 
-async def baixar_com_ytdlp(url, caminho_arquivo, mensagem_status):
-    """Download usando yt-dlp com configurações especiais para XVideos e YouTube"""
-    global DOWNLOAD_CANCELADO, TAMANHO_TOTAL_ARQUIVO, LOOP
+# Sessão HTTP compartilhada por todo o processo (criada no primeiro uso, fechada no desligamento)
+SESSAO_HTTP = None
+
+def obter_sessao_http():
+    """Retorna a sessão aiohttp compartilhada (keep-alive, limite por host e cache de DNS)"""
+    global SESSAO_HTTP
+    if SESSAO_HTTP is None or SESSAO_HTTP.closed:
+        conector = aiohttp.TCPConnector(
+            limit=Config.LIMITE_CONEXOES_HTTP,
+            limit_per_host=Config.LIMITE_CONEXOES_POR_HOST,
+            ttl_dns_cache=300,
+            keepalive_timeout=60
+        )
+        SESSAO_HTTP = aiohttp.ClientSession(
+            connector=conector,
+            timeout=aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        )
+    return SESSAO_HTTP
+
+def perfil_ytdlp(url):
+    """Perfil de configuração do yt-dlp de acordo com o site"""
+    if 'xvideos.com' in url:
+        return 'xvideos'
+    if 'youtube.com' in url or 'youtu.be' in url:
+        return 'youtube'
+    return 'padrao'
 
-    # Armazenar o loop principal para uso na função de progresso
-    LOOP = asyncio.get_running_loop()
+def opcoes_ytdlp(perfil):
+    """Opções do YoutubeDL para cada perfil (sem outtmpl/hooks, que variam por tarefa)"""
+    if perfil == 'extracao':
+        return {
+            'quiet': True,
+            'no_warnings': True,
+            'geo_bypass': True,
+            'noplaylist': True,
+            'socket_timeout': 30,
+        }
+    if perfil == 'streaming':
+        return {
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': True,
+            'format': 'best[ext=mp4][protocol^=http][protocol!*=dash]',
+        }
+    if perfil == 'fallback':
+        return {'format': 'best'}
+    if perfil == 'lote':
+        return {
+            'quiet': True,
+            'no_warnings': True,
+            'noplaylist': False,
+            'socket_timeout': 30,
+        }
 
     opcoes_ydl = {
-        'outtmpl': caminho_arquivo,
         'quiet': True,
         'no_warnings': True,
         'geo_bypass': True,
@@ -298,11 +2042,10 @@ async def baixar_com_ytdlp(url, caminho_arquivo, mensagem_status):
         'fragment_retries': 3,
         'continue_dl': True,
         'socket_timeout': 30,
-        'progress_hooks': [lambda d: progresso_download(d, mensagem_status)],
     }
 
     # Configurações específicas para XVideos
-    if 'xvideos.com' in url:
+    if perfil == 'xvideos':
         opcoes_ydl.update({
             'format': 'best',
             'headers': {
@@ -318,155 +2061,937 @@ async def baixar_com_ytdlp(url, caminho_arquivo, mensagem_status):
             }
         })
     # Configurações para YouTube
-    elif 'youtube.com' in url or 'youtu.be' in url:
+    elif perfil == 'youtube':
         opcoes_ydl.update({
             'format': 'bestvideo[height<=1080][ext=mp4]+bestaudio[ext=m4a]/best[height<=1080][ext=mp4]',
             'merge_output_format': 'mp4',
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4'
-            }],
             'youtube_include_dash_manifest': False,
             'youtube_include_hls_manifest': False,
         })
-    # Configuração padrão para outros sites
+    # Configuração padrão para outros sites (container/codecs ajustados depois, em preparar_para_telegram)
     else:
         opcoes_ydl.update({
             'format': 'best[ext=mp4]/best',
-            'postprocessors': [{
-                'key': 'FFmpegVideoConvertor',
-                'preferedformat': 'mp4'
-            }]
         })
+    return opcoes_ydl
+
+class PoolYoutubeDL:
+    """
+    Instâncias de YoutubeDL reaproveitadas por perfil de site
+    - Mantém conexões, cookies e extratores já inicializados entre tarefas
+    - Cada instância é usada por uma tarefa de cada vez (outtmpl e hook trocados no empréstimo)
+    """
+    def __init__(self, maximo_por_perfil):
+        self.maximo_por_perfil = maximo_por_perfil
+        self.livres = {}
+
+    def _criar(self, perfil):
+        ydl = yt_dlp.YoutubeDL(opcoes_ytdlp(perfil))
+        ydl.gancho_atual = None
+        ydl.add_progress_hook(lambda d: ydl.gancho_atual(d) if ydl.gancho_atual else None)
+        return ydl
+
+    @contextmanager
+    def usar(self, perfil, caminho_arquivo=None, gancho=None, formato=None):
+        """Empresta uma instância; formato substitui o seletor do perfil só durante o empréstimo"""
+        livres = self.livres.setdefault(perfil, [])
+        ydl = livres.pop() if livres else self._criar(perfil)
+        ydl.gancho_atual = gancho
+        if caminho_arquivo:
+            ydl.params['outtmpl']['default'] = caminho_arquivo
+        seletor_perfil = ydl.format_selector
+        if formato:
+            ydl.format_selector = ydl.build_format_selector(formato)
+        try:
+            yield ydl
+        finally:
+            ydl.gancho_atual = None
+            ydl.format_selector = seletor_perfil
+            if len(livres) < self.maximo_por_perfil:
+                livres.append(ydl)
+            else:
+                ydl.close()
+
+    def fechar(self):
+        """Fecha todas as instâncias ociosas"""
+        for livres in self.livres.values():
+            for ydl in livres:
+                ydl.close()
+        self.livres = {}
+
+POOL_YTDL = PoolYoutubeDL(Config.LIMITE_DOWNLOADS)
+
+async def fechar_conexoes():
+    """Encerra a sessão HTTP e as instâncias do yt-dlp (chamado no desligamento)"""
+    global SESSAO_HTTP
+    if SESSAO_HTTP is not None and not SESSAO_HTTP.closed:
+        await SESSAO_HTTP.close()
+    SESSAO_HTTP = None
+    POOL_YTDL.fechar()
+
+# Info dicts do yt-dlp já extraídos: url -> (momento, info sem processamento)
+CACHE_INFO = OrderedDict()
+LIMITE_CACHE_INFO = 100
+
+async def extrair_info(url):
+    """
+    Extrai o info dict do yt-dlp uma única vez por URL
+    - Extração sem processar formatos (process=False), reaproveitada para seleção e download
+    - Cache curto (Config.TTL_CACHE_INFO), pois as URLs de mídia expiram
+    - Levanta exceção se o yt-dlp não suportar a URL
+    """
+    agora = time.time()
+    item = CACHE_INFO.get(url)
+    if item and agora - item[0] < Config.TTL_CACHE_INFO:
+        return copy.deepcopy(item[1])
+
+    with POOL_YTDL.usar('extracao') as ydl, METRICAS.cronometrar('bot_operacao_segundos', operacao='extracao'):
+        info = await asyncio.to_thread(ydl.extract_info, url, download=False, process=False)
+
+    CACHE_INFO[url] = (agora, info)
+    while CACHE_INFO and (
+        len(CACHE_INFO) > LIMITE_CACHE_INFO
+        or agora - next(iter(CACHE_INFO.values()))[0] >= Config.TTL_CACHE_INFO
+    ):
+        CACHE_INFO.popitem(last=False)
+    return copy.deepcopy(info)
+
+def formato_progressivo(formato):
+    """Formato que é um único MP4 por HTTP (sem DASH/HLS nem mesclagem de faixas)"""
+    return (
+        formato.get('url')
+        and formato.get('protocol') in ('http', 'https')
+        and formato.get('ext') == 'mp4'
+        and not formato.get('requested_formats')
+    )
+
+def tamanho_formato(formato, duracao=None):
+    """
+    Tamanho esperado de um formato do yt-dlp (0 se desconhecido)
+    - filesize, depois filesize_approx, depois bitrate (tbr) x duração
+    - Formatos mesclados somam as faixas
+    """
+    duracao = duracao or formato.get('duration')
+    tamanho = formato.get('filesize') or formato.get('filesize_approx')
+    if not tamanho and formato.get('requested_formats'):
+        partes = [tamanho_formato(f, duracao) for f in formato['requested_formats']]
+        tamanho = sum(partes) if all(partes) else 0
+    if not tamanho and formato.get('tbr') and duracao:
+        tamanho = formato['tbr'] * 1000 / 8 * duracao
+    return int(tamanho or 0)
 
+def escolher_formato_que_cabe(info, limite, mesclar):
+    """
+    Melhor formato (maior altura, depois bitrate) cuja estimativa cabe no limite
+    - mesclar: também combina vídeo sem áudio + melhor áudio m4a (perfis com merge_output_format)
+    - Retorna (especificação do formato, tamanho estimado) ou None
+    """
+    duracao = info.get('duration')
+    formatos = info.get('formats') or []
+    candidatos = [
+        (f, f['format_id'], tamanho_formato(f, duracao))
+        for f in formatos if f.get('vcodec') != 'none' and f.get('acodec') != 'none'
+    ]
+    if mesclar:
+        audios = [f for f in formatos if f.get('vcodec') == 'none' and f.get('ext') == 'm4a']
+        if audios:
+            audio = max(audios, key=lambda f: f.get('abr') or f.get('tbr') or 0)
+            tamanho_audio = tamanho_formato(audio, duracao)
+            candidatos += [
+                (f, f"{f['format_id']}+{audio['format_id']}", tamanho_formato(f, duracao) + tamanho_audio)
+                for f in formatos
+                if f.get('acodec') == 'none' and f.get('vcodec') != 'none' and f.get('ext') == 'mp4'
+                and tamanho_formato(f, duracao) and tamanho_audio
+            ]
+
+    cabem = [c for c in candidatos if 0 < c[2] <= limite]
+    if not cabem:
+        return None
+    _, especificacao, tamanho = max(cabem, key=lambda c: (c[0].get('height') or 0, c[0].get('tbr') or 0))
+    return especificacao, tamanho
+
+async def planejar_download(url, info=None, trocar_formato=True):
+    """
+    Decide pelo tamanho estimado, antes de gastar banda com o download
+    - 'baixar': cabe em TAMANHO_MAXIMO ou tamanho desconhecido ('formato' traz um formato menor, se escolhido)
+    - 'converter': nenhum formato cabe, mas o vídeo pode passar pela conversão do /conv
+    - 'rejeitar': acima de TAMANHO_MAXIMO_CONVERSAO
+    - Sem info dict, o tamanho vem do Content-Length/Content-Range do link direto
+    """
+    plano = {'decisao': 'baixar', 'tamanho': 0, 'formato': None}
+    limite = Config.TAMANHO_MAXIMO
     try:
-        with yt_dlp.YoutubeDL(opcoes_ydl) as ydl:
-            info = await asyncio.to_thread(ydl.extract_info, url, download=False)
-            TAMANHO_TOTAL_ARQUIVO = info.get('filesize') or info.get('total_bytes')
-            if TAMANHO_TOTAL_ARQUIVO is None:
-                TAMANHO_TOTAL_ARQUIVO = 0
+        if info is None:
+            plano['tamanho'], _ = await sondar_intervalos(url, _cabecalhos_para_url(url))
+        elif info.get('_type', 'video') == 'video':
+            perfil = perfil_ytdlp(url)
+            with POOL_YTDL.usar(perfil) as ydl:
+                selecionado = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), download=False)
+            limite = Config.TAMANHO_MAXIMO * Config.MARGEM_ESTIMATIVA_TAMANHO
+            plano['tamanho'] = tamanho_formato(selecionado)
+            if plano['tamanho'] > limite and trocar_formato:
+                escolhido = escolher_formato_que_cabe(selecionado, limite, 'merge_output_format' in opcoes_ytdlp(perfil))
+                if escolhido:
+                    plano['formato'], plano['tamanho'] = escolhido
+    except Exception as e:
+        logger.info(f"Tamanho do download desconhecido: {str(e)[:200]}")
+        return plano
+
+    if plano['tamanho'] > limite and not plano['formato']:
+        plano['decisao'] = 'converter' if plano['tamanho'] <= Config.TAMANHO_MAXIMO_CONVERSAO else 'rejeitar'
+    if plano['formato']:
+        logger.info(f"Formato {plano['formato']} escolhido para caber no limite ({converter_bytes(plano['tamanho'])})")
+    return plano
+
+async def baixar_com_ytdlp(url, caminho_arquivo, tarefa, info=None, formato=None):
+    """
+    Download usando yt-dlp com configurações especiais para XVideos e YouTube
+    - formato: especificação que substitui a do perfil (formato menor escolhido no planejamento)
+    """
+    gancho = lambda d: progresso_download(d, tarefa)
+
+    try:
+        # Reaproveita a extração já feita; só extrai aqui se ninguém extraiu antes
+        if info is None:
+            info = await extrair_info(url)
+
+        with POOL_YTDL.usar(perfil_ytdlp(url), caminho_arquivo, gancho, formato) as ydl:
+            # Seleção de formato é local; serve para saber o tamanho e a URL antes de baixar
+            selecionado = None
+            if info.get('_type', 'video') == 'video':
+                selecionado = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), download=False)
+                tarefa.tamanho_total_arquivo = tamanho_formato(selecionado)
+            if not tarefa.tamanho_total_arquivo:
+                tarefa.tamanho_total_arquivo = 0
                 logger.warning("Não foi possível determinar o tamanho total do arquivo antes do download.")
 
-            await asyncio.to_thread(ydl.download, [url])
+            # Formato progressivo único: baixa com o downloader segmentado no lugar do yt-dlp
+            if selecionado and formato_progressivo(selecionado):
+                if await download_arquivo_generico(selecionado['url'], caminho_arquivo, tarefa, selecionado.get('http_headers')):
+                    return True
+                if tarefa.download_cancelado:
+                    return False
+                logger.warning("Download segmentado falhou; usando o downloader do yt-dlp.")
 
-        # Verifica se o arquivo foi baixado corretamente
-        if not os.path.exists(caminho_arquivo):
-            # Tenta encontrar o arquivo pelo nome padrão do yt-dlp
-            filename = ydl.prepare_filename(info)
-            if os.path.exists(filename):
-                os.rename(filename, caminho_arquivo)
-            else:
-                return False
+            resultado = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), download=True)
+
+            # Verifica se o arquivo foi baixado corretamente
+            if not os.path.exists(caminho_arquivo):
+                # Tenta encontrar o arquivo pelo nome padrão do yt-dlp
+                filename = ydl.prepare_filename(resultado)
+                if os.path.exists(filename):
+                    os.rename(filename, caminho_arquivo)
+                else:
+                    return False
 
         return True
     except Exception as e:
         logger.error(f"Erro ao baixar com yt-dlp: {str(e)}")
         # Tentar fallback mais simples
         try:
-            with yt_dlp.YoutubeDL({'format': 'best', 'outtmpl': caminho_arquivo, 'progress_hooks': [lambda d: progresso_download(d, mensagem_status)]}) as ydl:
-                await asyncio.to_thread(ydl.download, [url])
+            with POOL_YTDL.usar('fallback', caminho_arquivo, gancho) as ydl:
+                if info is not None:
+                    await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), download=True)
+                else:
+                    await asyncio.to_thread(ydl.download, [url])
             return os.path.exists(caminho_arquivo)
         except Exception as e2:
             logger.error(f"Fallback também falhou: {str(e2)}")
             return False
 
-async def download_arquivo_generico(url, caminho_arquivo, mensagem_status):
-    """Download de qualquer tipo de arquivo genérico"""
-    global DOWNLOAD_CANCELADO, TAMANHO_TOTAL_ARQUIVO
-    baixado = 0
+async def sondar_intervalos(url, headers):
+    """
+    Verifica se o servidor aceita requisições por intervalo de bytes (Accept-Ranges)
+    - Retorna (tamanho, aceita_intervalos); tamanho 0 quando desconhecido
+    """
+    async with obter_sessao_http().get(url, headers={**headers, 'Range': 'bytes=0-0'}) as response:
+        if response.status == 206 and response.headers.get('Accept-Ranges', 'bytes') != 'none':
+            total = response.headers.get('Content-Range', '').rpartition('/')[2]
+            if total.isdigit():
+                return int(total), True
+        if response.status in (200, 206):
+            return int(response.headers.get('Content-Length', 0)), False
+        raise Exception(f"Erro HTTP {response.status} ao baixar arquivo")
+
+async def baixar_em_segmentos(url, caminho_arquivo, tamanho, headers, tarefa):
+    """
+    Baixa intervalos de bytes em conexões simultâneas direto no arquivo pré-alocado
+    - Cada segmento tenta de novo a partir do último byte gravado
+    """
+    # Intervalos [posição, fim] pendentes; na retomada vêm do diário
+    entrada = DIARIO_DOWNLOADS.obter(caminho_arquivo) or {}
+    retomando = entrada.get('tamanho') == tamanho and entrada.get('intervalos') and os.path.exists(caminho_arquivo)
+    if retomando:
+        intervalos = [[posicao, fim] for posicao, fim in entrada['intervalos'] if posicao <= fim]
+    else:
+        conexoes = max(1, min(Config.CONEXOES_POR_DOWNLOAD, tamanho // Config.TAMANHO_MINIMO_SEGMENTO_HTTP))
+        passo = math.ceil(tamanho / conexoes)
+        intervalos = [[inicio, min(inicio + passo, tamanho) - 1] for inicio in range(0, tamanho, passo)]
+    if caminho_arquivo in DIARIO_DOWNLOADS.entradas:
+        DIARIO_DOWNLOADS.registrar(caminho_arquivo, tamanho=tamanho, intervalos=intervalos)
+
+    baixado = [tamanho - sum(fim - posicao + 1 for posicao, fim in intervalos)]
+    tarefa.tamanho_total_arquivo = tamanho
+    if retomando:
+        logger.info(f"Retomando download de {caminho_arquivo} a partir de {converter_bytes(baixado[0])}")
+
+    async def baixar_intervalo(intervalo):
+        inicio, fim = intervalo
+        posicao = inicio
+        for tentativa in range(Config.TENTATIVAS_SEGMENTO_HTTP):
+            try:
+                cabecalhos = {**headers, 'Range': f'bytes={posicao}-{fim}'}
+                async with obter_sessao_http().get(url, headers=cabecalhos) as response:
+                    if response.status != 206:
+                        raise Exception(f"Erro HTTP {response.status} no segmento {inicio}-{fim}")
+                    async for chunk in response.content.iter_chunked(1024*1024):
+                        if tarefa.download_cancelado:
+                            raise Exception("Download cancelado pelo usuário")
+                        os.pwrite(fd, chunk, posicao)
+                        METRICAS.incrementar('bot_bytes_transferidos_total', len(chunk), direcao='download')
+                        posicao += len(chunk)
+                        baixado[0] += len(chunk)
+                        intervalo[0] = posicao
+                        DIARIO_DOWNLOADS.salvar(forcar=False)
+                        await atualizar_progresso_download(baixado[0], tamanho, tarefa)
+                if posicao > fim:
+                    return
+                raise Exception(f"Segmento {inicio}-{fim} interrompido em {posicao}")
+            except Exception as e:
+                if tarefa.download_cancelado or tentativa == Config.TENTATIVAS_SEGMENTO_HTTP - 1:
+                    raise
+                logger.warning(f"Segmento {inicio}-{fim} falhou ({e}); retomando de {posicao}")
+                await asyncio.sleep(2 ** tentativa)
+
+    fd = os.open(caminho_arquivo, os.O_WRONLY | os.O_CREAT | (0 if retomando else os.O_TRUNC), 0o644)
     try:
-        headers = {'User-Agent': Config.USER_AGENT}
-        if 'xvideos.com' in url:
-            headers.update({
-                'Referer': 'https://www.xvideos.com/',
-                'Accept': '*/*'
-            })
-
-        async with aiohttp.ClientSession(headers=headers) as session:
-            async with session.get(url) as response:
-                if response.status == 200:
-                    TAMANHO_TOTAL_ARQUIVO = int(response.headers.get('Content-Length', 0))
-                    with open(caminho_arquivo, 'wb') as f:
-                        async for chunk in response.content.iter_chunked(1024*1024):  # 1MB chunks
-                            if DOWNLOAD_CANCELADO:
-                                logger.info("Download cancelado pelo usuário.")
-                                return False
-                            f.write(chunk)
-                            baixado += len(chunk)
-                            await atualizar_progresso_download(baixado, TAMANHO_TOTAL_ARQUIVO, mensagem_status)
-                    return True
-                else:
-                    logger.error(f"Erro HTTP {response.status} ao baixar arquivo")
+        # Sem fallocate nativo a glibc grava bloco a bloco: fora do event loop
+        await asyncio.to_thread(preallocar, fd, tamanho)
+        workers = [asyncio.create_task(baixar_intervalo(intervalo)) for intervalo in intervalos]
+        try:
+            await asyncio.gather(*workers)
+        finally:
+            # Nenhum segmento pode continuar gravando depois que o descritor for fechado
+            for worker in workers:
+                worker.cancel()
+            await asyncio.gather(*workers, return_exceptions=True)
+            DIARIO_DOWNLOADS.salvar()
+    finally:
+        os.close(fd)
+
+async def baixar_conexao_unica(url, caminho_arquivo, headers, tarefa):
+    """Download sequencial em uma única conexão (servidores sem suporte a Range)"""
+    baixado = 0
+    async with obter_sessao_http().get(url, headers=headers) as response:
+        if response.status != 200:
+            logger.error(f"Erro HTTP {response.status} ao baixar arquivo")
+            return False
+        tarefa.tamanho_total_arquivo = int(response.headers.get('Content-Length', 0))
+        with open(caminho_arquivo, 'wb') as f:
+            async for chunk in response.content.iter_chunked(1024*1024):  # 1MB chunks
+                if tarefa.download_cancelado:
+                    logger.info("Download cancelado pelo usuário.")
                     return False
+                f.write(chunk)
+                METRICAS.incrementar('bot_bytes_transferidos_total', len(chunk), direcao='download')
+                baixado += len(chunk)
+                await atualizar_progresso_download(baixado, tarefa.tamanho_total_arquivo, tarefa)
+    return True
+
+async def download_arquivo_generico(url, caminho_arquivo, tarefa, headers=None):
+    """
+    Download de qualquer tipo de arquivo genérico
+    - Servidor com suporte a Range: vários intervalos em conexões simultâneas
+    - Sem suporte: uma única conexão
+    """
+    try:
+        headers = headers or _cabecalhos_para_url(url)
+        tamanho, aceita_intervalos = await sondar_intervalos(url, headers)
+
+        if aceita_intervalos and Config.CONEXOES_POR_DOWNLOAD > 1 and tamanho >= 2 * Config.TAMANHO_MINIMO_SEGMENTO_HTTP:
+            inicio = time.time()
+            await baixar_em_segmentos(url, caminho_arquivo, tamanho, headers, tarefa)
+            duracao = time.time() - inicio
+            logger.info(
+                f"Download segmentado: {converter_bytes(tamanho)} em {duracao:.1f}s "
+                f"({converter_bytes(tamanho / duracao if duracao > 0 else 0)}/s)"
+            )
+            return True
+
+        return await baixar_conexao_unica(url, caminho_arquivo, headers, tarefa)
     except Exception as e:
         logger.error(f"Erro ao baixar arquivo: {e}")
         return False
 
-@tratar_flood_wait
-async def atualizar_progresso_download(baixado, total, mensagem):
-    """Atualiza a mensagem de progresso do download"""
-    global ULTIMO_TEMPO_ATUALIZACAO, TEMPO_INICIO
+def _cabecalhos_para_url(url):
+    """Cabeçalhos HTTP padrão usados nos downloads diretos"""
+    headers = {'User-Agent': Config.USER_AGENT}
+    if 'xvideos.com' in url:
+        headers.update({
+            'Referer': 'https://www.xvideos.com/',
+            'Accept': '*/*'
+        })
+    return headers
 
-    agora = time.time()
-    if agora - ULTIMO_TEMPO_ATUALIZACAO < Config.INTERVALO_ATUALIZACAO:
-        return
+async def sondar_url_ffprobe(url_midia, headers):
+    """Lê codecs, dimensões e duração direto da URL, sem baixar o arquivo inteiro"""
+    cabecalhos = "".join(f"{chave}: {valor}\r\n" for chave, valor in headers.items())
+    cmd = [
+        'ffprobe', '-v', 'error',
+        '-headers', cabecalhos,
+        '-show_entries', 'format=duration:stream=codec_type,codec_name,width,height',
+        '-of', 'json',
+        url_midia
+    ]
+    try:
+        stdout = await executar_processo(cmd, timeout=Config.TIMEOUT_FFPROBE)
+        data = json.loads(stdout)
+        video = next(s for s in data['streams'] if s['codec_type'] == 'video')
+        audio = next((s for s in data['streams'] if s['codec_type'] == 'audio'), None)
+        return {
+            'duracao': float(data['format']['duration']),
+            'largura': int(video['width']),
+            'altura': int(video['height']),
+            'codec_video': video.get('codec_name'),
+            'codec_audio': audio.get('codec_name') if audio else None,
+        }
+    except Exception as e:
+        logger.info(f"Não foi possível sondar a URL com ffprobe: {str(e)}")
+        return None
+
+async def resolver_fonte_streaming(url, info=None):
+    """
+    Verifica se a URL pode ser enviada em streaming (download e upload simultâneos)
+    - Só aceita fontes progressivas HTTP em MP4/H.264 com tamanho conhecido
+    - O moov precisa vir antes do mdat (faststart); senão o player do Telegram não toca
+      até o fim do download e o arquivo vai para o disco, onde o remux resolve
+    - Usa o info dict já extraído (info); sem ele, trata a URL como link direto
+    - Retorna None quando o arquivo precisa ir para o disco (remux, conversão, HLS/DASH)
+    """
+    if not Config.STREAMING_ATIVO:
+        return None
+
+    headers = _cabecalhos_para_url(url)
+    url_midia = url
+    tamanho = 0
+    fonte = {}
+
+    if info is not None:
+        try:
+            with POOL_YTDL.usar('streaming') as ydl:
+                info = await asyncio.to_thread(ydl.process_ie_result, copy.deepcopy(info), download=False)
+        except Exception as e:
+            logger.info(f"Fonte sem formato progressivo no yt-dlp: {str(e)}")
+            return None
+        if info.get('requested_formats') or info.get('protocol') not in ('http', 'https'):
+            return None
+        url_midia = info['url']
+        headers = info.get('http_headers') or headers
+        tamanho = info.get('filesize') or 0
+        fonte['nome'] = f"{info.get('id', 'video')}.mp4"
+    else:
+        fonte['nome'] = os.path.basename(url.split('?')[0]) or "video.mp4"
 
-    ULTIMO_TEMPO_ATUALIZACAO = agora
-    percentual = (baixado / total) * 100 if total > 0 else 0
-    tempo_decorrido = agora - TEMPO_INICIO
-    velocidade = baixado / tempo_decorrido if tempo_decorrido > 0 else 0
-    tempo_restante = (total - baixado) / velocidade if velocidade > 0 else 0
+    if not tamanho:
+        try:
+            async with obter_sessao_http().head(url_midia, headers=headers, allow_redirects=True) as response:
+                if response.status != 200:
+                    return None
+                tamanho = int(response.headers.get('Content-Length', 0))
+        except Exception as e:
+            logger.info(f"Falha no HEAD da fonte de streaming: {str(e)}")
+            return None
+
+    # Arquivos pequenos não compensam; acima do limite o upload falharia
+    if tamanho <= Config.TAMANHO_MINIMO_STREAMING or tamanho > Config.TAMANHO_MAXIMO:
+        return None
 
     try:
-        texto = (
-            f"⬇️ **Progresso do Download**\n"
-            f"📦 Tamanho Total: {converter_bytes(total)}\n"
-            f"{criar_barra_progresso(percentual)} {percentual:.1f}%\n"
-            f"⚡ {converter_bytes(velocidade)}/s\n"
-            f"⏱️ {tempo_restante:.0f}s restantes"
-        )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data="cancelar_download")]])
-        await mensagem.edit(texto, reply_markup=keyboard)
-    except MessageNotModified:
-        pass
+        if not await moov_no_inicio_url(url_midia, headers, tamanho):
+            logger.info(f"Fonte sem faststart, streaming descartado: {url_midia[:100]}")
+            return None
     except Exception as e:
-        logger.warning(f"Falha ao atualizar progresso do download: {e}")
+        logger.info(f"Falha ao verificar faststart da fonte: {str(e)}")
+        return None
+
+    metadados = await sondar_url_ffprobe(url_midia, headers)
+    if not metadados or metadados['codec_video'] != 'h264' or metadados['codec_audio'] not in ('aac', None):
+        return None
 
-@tratar_flood_wait
-async def callback_progresso(atual, total, mensagem):
-    """Callback de progresso com controle de flood"""
-    global ULTIMO_TEMPO_ATUALIZACAO, UPLOAD_CANCELADO
+    fonte.update(metadados)
+    fonte.update({'url': url_midia, 'headers': headers, 'tamanho': tamanho})
+    return fonte
 
-    if UPLOAD_CANCELADO:
-        raise Exception("Upload cancelado pelo usuário")
+class PoolSessoesMidia:
+    """
+    Sessões de mídia já autorizadas, mantidas abertas entre transferências
+    - Até Config.SESSOES_MIDIA_POR_DC por DC; cada transferência usa a menos ocupada
+    - O ping do próprio Session mantém a conexão viva; sessões ociosas além das aquecidas são fechadas
+    """
+    def __init__(self, por_dc, aquecidas, ociosidade):
+        self.por_dc = por_dc
+        self.aquecidas = aquecidas
+        self.ociosidade = ociosidade
+        self.sessoes = {}  # dc_id -> [{'sessao', 'em_uso', 'ultimo_uso', 'pronta'}]
+        self.trava = asyncio.Lock()
+        self.tarefa_limpeza = None
 
-    agora = time.time()
-    if agora - ULTIMO_TEMPO_ATUALIZACAO < Config.INTERVALO_ATUALIZACAO:
-        return
+    async def _criar(self, client, dc_id):
+        """Conecta ao DC de mídia (com autorização exportada, se não for o DC da conta)"""
+        inicio = time.time()
+        dc_principal = await client.storage.dc_id()
+        test_mode = await client.storage.test_mode()
+        if dc_id == dc_principal:
+            auth_key = await client.storage.auth_key()
+        else:
+            auth_key = await Auth(client, dc_id, test_mode).create()
 
-    ULTIMO_TEMPO_ATUALIZACAO = agora
-    percentual = (atual / total) * 100
-    tempo_decorrido = agora - TEMPO_INICIO
-    velocidade = atual / tempo_decorrido if tempo_decorrido > 0 else 0
-    tempo_restante = (total - atual) / velocidade if velocidade > 0 else 0
+        sessao = Session(client, dc_id, auth_key, test_mode, is_media=True)
+        await sessao.start()
+        if dc_id != dc_principal:
+            exportada = await client.invoke(raw.functions.auth.ExportAuthorization(dc_id=dc_id))
+            await sessao.invoke(raw.functions.auth.ImportAuthorization(id=exportada.id, bytes=exportada.bytes))
+        logger.info(f"Sessão de mídia aberta no DC {dc_id} em {time.time() - inicio:.2f}s")
+        return sessao
+
+    async def emprestar(self, client, dc_id=None):
+        """
+        Reserva a sessão menos ocupada do DC, abrindo outra se todas estiverem em uso
+        - Só a vaga da sessão nova é reservada sob a trava; conexão e autorização rodam fora dela
+        - Quem pega uma sessão ainda abrindo espera por ela (e tenta de novo se a abertura falhar)
+        """
+        dc_id = dc_id or await client.storage.dc_id()
+        while True:
+            async with self.trava:
+                entradas = self.sessoes.setdefault(dc_id, [])
+                entrada = min(entradas, key=lambda e: e['em_uso'], default=None)
+                criar = entrada is None or (entrada['em_uso'] and len(entradas) < self.por_dc)
+                if criar:
+                    entrada = {'sessao': None, 'em_uso': 0, 'ultimo_uso': time.time(), 'pronta': asyncio.Event()}
+                    entradas.append(entrada)
+                entrada['em_uso'] += 1
+                if self.tarefa_limpeza is None:
+                    self.tarefa_limpeza = asyncio.create_task(self._limpar_ociosas(client))
+
+            if criar:
+                try:
+                    entrada['sessao'] = await self._criar(client, dc_id)
+                except BaseException:
+                    if entrada in entradas:
+                        entradas.remove(entrada)
+                    raise
+                finally:
+                    entrada['pronta'].set()
+                return entrada
+
+            await entrada['pronta'].wait()
+            if entrada['sessao'] is not None:
+                return entrada
+            entrada['em_uso'] -= 1
+
+    def devolver(self, entrada):
+        entrada['em_uso'] -= 1
+        entrada['ultimo_uso'] = time.time()
+
+    async def aquecer(self, client):
+        """Abre as sessões do DC principal antes da primeira transferência"""
+        dc_id = await client.storage.dc_id()
+        try:
+            entradas = [await self.emprestar(client, dc_id) for _ in range(self.aquecidas)]
+        except Exception as e:
+            logger.warning(f"Falha ao aquecer sessões de mídia: {str(e)}")
+            return
+        for entrada in entradas:
+            self.devolver(entrada)
+
+    async def _limpar_ociosas(self, client):
+        dc_principal = await client.storage.dc_id()
+        while True:
+            await asyncio.sleep(60)
+            agora = time.time()
+            async with self.trava:
+                for dc_id, entradas in self.sessoes.items():
+                    manter = self.aquecidas if dc_id == dc_principal else 0
+                    for entrada in list(entradas):
+                        if len(entradas) <= manter:
+                            break
+                        if not entrada['em_uso'] and agora - entrada['ultimo_uso'] > self.ociosidade:
+                            entradas.remove(entrada)
+                            await entrada['sessao'].stop()
+                            logger.info(f"Sessão de mídia ociosa fechada no DC {dc_id}")
+
+    async def fechar(self):
+        if self.tarefa_limpeza:
+            self.tarefa_limpeza.cancel()
+            await asyncio.gather(self.tarefa_limpeza, return_exceptions=True)
+            self.tarefa_limpeza = None
+        for entradas in self.sessoes.values():
+            for entrada in entradas:
+                if entrada['sessao'] is not None:
+                    await entrada['sessao'].stop()
+        self.sessoes = {}
+
+POOL_MIDIA = PoolSessoesMidia(
+    Config.SESSOES_MIDIA_POR_DC, Config.SESSOES_MIDIA_AQUECIDAS, Config.OCIOSIDADE_SESSAO_MIDIA
+)
+
+async def baixar_arquivo_telegram(client, file_id, file_size=0, limit=0, offset=0, progress=None, progress_args=()):
+    """
+    GetFile em blocos de 1MB por uma sessão do pool
+    - Redirecionamento para CDN volta para a implementação do Pyrogram
+    """
+    if file_id.file_type == FileType.PHOTO:
+        location = raw.types.InputPhotoFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+    else:
+        location = raw.types.InputDocumentFileLocation(
+            id=file_id.media_id,
+            access_hash=file_id.access_hash,
+            file_reference=file_id.file_reference,
+            thumb_size=file_id.thumbnail_size
+        )
+
+    tamanho_bloco = 1024 * 1024
+    posicao = abs(offset) * tamanho_bloco
+    limite_blocos = abs(limit) or (1 << 31) - 1
+    blocos = 0
+    redirecionado = False
 
+    entrada = await POOL_MIDIA.emprestar(client, file_id.dc_id)
     try:
-        texto = (
-            f"📤 **Progresso do Upload**\n"
-            f"📦 Tamanho Total: {converter_bytes(total)}\n"
-            f"{criar_barra_progresso(percentual)} {percentual:.1f}%\n"
-            f"⚡ {converter_bytes(velocidade)}/s\n"
-            f"⏱️ {tempo_restante:.0f}s restantes"
+        while blocos < limite_blocos:
+            r = await entrada['sessao'].invoke(
+                raw.functions.upload.GetFile(location=location, offset=posicao, limit=tamanho_bloco),
+                sleep_threshold=30
+            )
+            if isinstance(r, raw.types.upload.FileCdnRedirect):
+                redirecionado = True
+                break
+
+            METRICAS.incrementar('bot_bytes_transferidos_total', len(r.bytes), direcao='download')
+            yield r.bytes
+            blocos += 1
+            posicao += tamanho_bloco
+
+            if progress:
+                resultado = progress(min(posicao, file_size) if file_size else posicao, file_size, *progress_args)
+                if inspect.isawaitable(resultado):
+                    await resultado
+
+            if len(r.bytes) < tamanho_bloco:
+                break
+    finally:
+        POOL_MIDIA.devolver(entrada)
+
+    if redirecionado:
+        async for bloco in Client.get_file(
+            client, file_id, file_size, limit and limit - blocos, posicao // tamanho_bloco, progress, progress_args
+        ):
+            yield bloco
+
+class EnvioEmPartes:
+    """
+    Envio de um arquivo ao Telegram em partes, com workers paralelos
+    - Cada parte tem até Config.TENTATIVAS_PARTE_UPLOAD tentativas
+    - Ao final registra MB/s, repetições e o tempo gasto esperando o DC de mídia
+    - file_id/parte_inicial: reenvio de partes de um envio anterior (FilePartMissing)
+    """
+    def __init__(self, client, tamanho, nome, workers=None, tamanho_fila=None, file_id=None, parte_inicial=0):
+        self.client = client
+        self.tamanho = tamanho
+        self.nome = nome
+        self.eh_grande = tamanho > TAMANHO_MINIMO_ARQUIVO_GRANDE
+        self.reenvio = file_id is not None
+        self.file_id = file_id if self.reenvio else client.rnd_id()
+        self.tamanho_parte = tamanho_parte_upload(tamanho)
+        self.total_partes = math.ceil(tamanho / self.tamanho_parte)
+        if self.total_partes > MAXIMO_PARTES_UPLOAD:
+            raise ValueError(f"Arquivo grande demais para o Telegram ({converter_bytes(tamanho)})")
+        self.quantidade_workers = max(1, min(workers or Config.WORKERS_UPLOAD, self.total_partes))
+        self.md5 = None if self.eh_grande or self.reenvio else hashlib.md5()
+        self.fila = asyncio.Queue(tamanho_fila or self.quantidade_workers * 2)
+        self.parte = parte_inicial
+        self.erros = []
+        self.repeticoes = 0
+        self.tempo_conexao = 0
+        self.tempo_no_dc = 0
+        self.workers = []
+
+    async def __aenter__(self):
+        self.inicio = time.time()
+        self.entrada_pool = await POOL_MIDIA.emprestar(self.client)
+        self.sessao = self.entrada_pool['sessao']
+        self.tempo_conexao = time.time() - self.inicio
+        self.workers = [asyncio.create_task(self._worker()) for _ in range(self.quantidade_workers)]
+        return self
+
+    async def _worker(self):
+        while True:
+            rpc = await self.fila.get()
+            if rpc is None:
+                return
+            falhas = 0
+            while True:
+                inicio = time.time()
+                try:
+                    await self.sessao.invoke(rpc)
+                    self.tempo_no_dc += time.time() - inicio
+                    METRICAS.incrementar('bot_bytes_transferidos_total', len(rpc.bytes), direcao='upload')
+                    break
+                except FloodWait as e:
+                    # FloodWait não gasta tentativa; só desiste se a espera passar do limite
+                    self.tempo_no_dc += time.time() - inicio
+                    self.repeticoes += 1
+                    METRICAS.incrementar('bot_floodwait_total', metodo=type(rpc).__name__)
+                    METRICAS.incrementar('bot_floodwait_segundos_total', e.value, metodo=type(rpc).__name__)
+                    if e.value > Config.ESPERA_MAXIMA_FLOOD:
+                        self.erros.append(e)
+                        logger.error(f"FloodWait de {e.value}s ao enviar parte {rpc.file_part} de {self.nome}")
+                        break
+                    await asyncio.sleep(e.value)
+                except Exception as e:
+                    self.tempo_no_dc += time.time() - inicio
+                    falhas += 1
+                    if falhas == Config.TENTATIVAS_PARTE_UPLOAD:
+                        self.erros.append(e)
+                        logger.error(f"Falha ao enviar parte {rpc.file_part} de {self.nome}: {str(e)}")
+                        break
+                    self.repeticoes += 1
+                    await asyncio.sleep(0.5 * falhas)
+
+    async def enviar_parte(self, dados):
+        """Enfileira a próxima parte (espera se os workers estiverem ocupados)"""
+        if self.erros:
+            raise self.erros[0]
+        if self.eh_grande:
+            rpc = raw.functions.upload.SaveBigFilePart(
+                file_id=self.file_id,
+                file_part=self.parte,
+                file_total_parts=self.total_partes,
+                bytes=dados
+            )
+        else:
+            if self.md5:
+                self.md5.update(dados)
+            rpc = raw.functions.upload.SaveFilePart(file_id=self.file_id, file_part=self.parte, bytes=dados)
+        await self.fila.put(rpc)
+        self.parte += 1
+
+    async def reenviar_parte(self, parte, dados):
+        """Reenvia uma parte que o Telegram não encontrou (FilePartMissing), com o mesmo file_id e tamanho de parte"""
+        async with EnvioEmPartes(self.client, self.tamanho, self.nome, workers=1,
+                                 file_id=self.file_id, parte_inicial=parte) as envio:
+            await envio.enviar_parte(dados)
+
+    async def __aexit__(self, tipo_erro, erro, traceback):
+        for _ in self.workers:
+            await self.fila.put(None)
+        await asyncio.gather(*self.workers)
+        POOL_MIDIA.devolver(self.entrada_pool)
+        if tipo_erro is None and self.erros:
+            raise self.erros[0]
+        if tipo_erro is None and not self.reenvio:
+            duracao = time.time() - self.inicio
+            logger.info(
+                f"Upload de {self.nome}: {converter_bytes(self.tamanho)} em {duracao:.1f}s "
+                f"({converter_bytes(self.tamanho / duracao if duracao > 0 else 0)}/s) | "
+                f"{self.total_partes} partes, {self.quantidade_workers} workers, {self.repeticoes} repetições | "
+                f"conexão ao DC de mídia {self.tempo_conexao:.2f}s, "
+                f"espera média por parte {self.tempo_no_dc / max(self.total_partes, 1) * 1000:.0f}ms"
+            )
+        return False
+
+    def arquivo(self):
+        """InputFile para usar no envio da mídia"""
+        if self.eh_grande:
+            return raw.types.InputFileBig(id=self.file_id, parts=self.total_partes, name=self.nome)
+        return raw.types.InputFile(
+            id=self.file_id, parts=self.total_partes, name=self.nome, md5_checksum=self.md5.hexdigest()
         )
-        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar", callback_data="cancelar_upload")]])
-        await mensagem.edit(texto, reply_markup=keyboard)
-    except MessageNotModified:
-        pass
-    except Exception as e:
-        logger.warning(f"Falha ao atualizar progresso: {e}")
+
+async def enviar_arquivo_em_partes(client, path, progress=None, progress_args=()):
+    """Lê o arquivo (caminho ou objeto binário) e o envia pelo EnvioEmPartes"""
+    fp = open(path, "rb") if isinstance(path, (str, os.PathLike)) else path
+    try:
+        nome = os.path.basename(getattr(fp, "name", "file.jpg"))
+        tamanho = fp.seek(0, os.SEEK_END)
+        fp.seek(0)
+        if tamanho == 0:
+            raise ValueError("File size equals to 0 B")
+
+        enviado = 0
+        async with EnvioEmPartes(client, tamanho, nome) as envio:
+            while True:
+                dados = await asyncio.to_thread(fp.read, envio.tamanho_parte)
+                if not dados:
+                    break
+                await envio.enviar_parte(dados)
+                enviado += len(dados)
+                if progress:
+                    resultado = progress(enviado, tamanho, *progress_args)
+                    if inspect.isawaitable(resultado):
+                        await resultado
+        return envio.arquivo()
+    finally:
+        if fp is not path:
+            fp.close()
+
+async def reenviar_parte_do_arquivo(client, path, file_id, file_part):
+    """Lê do arquivo (caminho ou objeto binário) a parte que o Telegram pediu de novo e a reenvia"""
+    fp = open(path, "rb") if isinstance(path, (str, os.PathLike)) else path
+    try:
+        nome = os.path.basename(getattr(fp, "name", "file.jpg"))
+        tamanho = fp.seek(0, os.SEEK_END)
+        envio = EnvioEmPartes(client, tamanho, nome, workers=1, file_id=file_id, parte_inicial=file_part)
+        fp.seek(file_part * envio.tamanho_parte)
+        dados = await asyncio.to_thread(fp.read, envio.tamanho_parte)
+        async with envio:
+            await envio.enviar_parte(dados)
+    finally:
+        if fp is not path:
+            fp.close()
+
+async def reenviar_parte_da_fonte(envio, fonte, parte):
+    """Parte perdida num envio em streaming: nada ficou no disco, então ela é baixada de novo por Range"""
+    inicio = parte * envio.tamanho_parte
+    fim = min(inicio + envio.tamanho_parte, fonte['tamanho']) - 1
+    cabecalhos = {**fonte['headers'], 'Range': f'bytes={inicio}-{fim}'}
+    async with obter_sessao_http().get(fonte['url'], headers=cabecalhos) as response:
+        if response.status != 206:
+            raise Exception(f"Parte {parte} perdida pelo Telegram e a fonte não aceita Range (HTTP {response.status})")
+        dados = await response.read()
+    await envio.reenviar_parte(parte, dados)
+
+async def enviar_video_em_streaming(client, fonte, tarefa, chat_id, caption=None, reply_to_message_id=None):
+    """
+    Baixa a fonte e envia as partes ao Telegram ao mesmo tempo
+    - O buffer em memória é limitado a Config.BUFFER_STREAMING_PARTES partes
+    - Nada é gravado no disco além da thumbnail, extraída da URL em paralelo
+    """
+    tamanho = fonte['tamanho']
+    enviado = 0
+    tarefa_thumbnail = asyncio.create_task(obter_thumbnail_url(fonte))
+
+    try:
+        async with EnvioEmPartes(client, tamanho, fonte['nome'], tamanho_fila=Config.BUFFER_STREAMING_PARTES) as envio:
+            async with obter_sessao_http().get(fonte['url'], headers=fonte['headers']) as response:
+                if response.status != 200:
+                    raise Exception(f"Erro HTTP {response.status} na fonte de streaming")
+
+                buffer = bytearray()
+                tamanho_parte = envio.tamanho_parte
+                async for chunk in response.content.iter_chunked(tamanho_parte):
+                    if tarefa.download_cancelado:
+                        raise Exception("Download cancelado pelo usuário")
+
+                    buffer.extend(chunk)
+                    while len(buffer) >= tamanho_parte or (buffer and enviado + len(buffer) == tamanho):
+                        dados = bytes(buffer[:tamanho_parte])
+                        del buffer[:tamanho_parte]
+                        await envio.enviar_parte(dados)
+                        enviado += len(dados)
+                        await callback_progresso(enviado, tamanho, tarefa)
+
+            if enviado != tamanho:
+                raise Exception(f"Fonte encerrou antes do fim ({converter_bytes(enviado)} de {converter_bytes(tamanho)})")
+
+        try:
+            caminho_thumbnail = await tarefa_thumbnail
+        except Exception as e:
+            logger.warning(f"Thumbnail da fonte de streaming indisponível: {str(e)[:200]}")
+            caminho_thumbnail = None
+    finally:
+        tarefa_thumbnail.cancel()
+
+    media = raw.types.InputMediaUploadedDocument(
+        mime_type="video/mp4",
+        file=envio.arquivo(),
+        thumb=await client.save_file(caminho_thumbnail) if caminho_thumbnail else None,
+        attributes=[
+            raw.types.DocumentAttributeVideo(
+                supports_streaming=True,
+                duration=int(fonte['duracao']),
+                w=fonte['largura'],
+                h=fonte['altura']
+            ),
+            raw.types.DocumentAttributeFilename(file_name=fonte['nome'])
+        ]
+    )
+    for tentativa in range(Config.TENTATIVAS_PARTE_UPLOAD + 1):
+        try:
+            r = await client.invoke(
+                raw.functions.messages.SendMedia(
+                    peer=await client.resolve_peer(chat_id),
+                    media=media,
+                    reply_to_msg_id=reply_to_message_id,
+                    random_id=client.rnd_id(),
+                    **await utils.parse_text_entities(client, caption, None, None)
+                )
+            )
+            break
+        except FilePartMissing as e:
+            if tentativa == Config.TENTATIVAS_PARTE_UPLOAD:
+                raise
+            logger.warning(f"Telegram não encontrou a parte {e.value} de {fonte['nome']}; reenviando")
+            await reenviar_parte_da_fonte(envio, fonte, e.value)
+    for update in r.updates:
+        if isinstance(update, (raw.types.UpdateNewMessage, raw.types.UpdateNewChannelMessage)):
+            return await Message._parse(
+                client, update.message,
+                {u.id: u for u in r.users},
+                {c.id: c for c in r.chats}
+            )
+
+def texto_progresso(titulo, atual, total, tarefa):
+    """Texto padrão de progresso (tamanho, barra, velocidade e ETA)"""
+    percentual = (atual / total) * 100 if total > 0 else 0
+    tempo_decorrido = time.time() - tarefa.tempo_inicio
+    velocidade = atual / tempo_decorrido if tempo_decorrido > 0 else 0
+    tempo_restante = (total - atual) / velocidade if velocidade > 0 else 0
+    return (
+        f"{titulo}\n"
+        f"📦 Tamanho Total: {converter_bytes(total)}\n"
+        f"{criar_barra_progresso(percentual)} {percentual:.1f}%\n"
+        f"⚡ {converter_bytes(velocidade)}/s\n"
+        f"⏱️ {tempo_restante:.0f}s restantes"
+    )
+
+def texto_progresso_download(baixado, total, tarefa):
+    return texto_progresso("⬇️ **Progresso do Download**", baixado, total, tarefa)
+
+async def atualizar_progresso_download(baixado, total, tarefa):
+    """Repassa o progresso do download ao editor de status"""
+    if tarefa.download_cancelado:
+        raise Exception("Download cancelado pelo usuário")
+
+    agora = time.time()
+    if agora - tarefa.ultimo_tempo_atualizacao < Config.INTERVALO_COLETA_PROGRESSO:
+        return
+    tarefa.ultimo_tempo_atualizacao = agora
+    EDITOR_STATUS.atualizar(
+        tarefa.mensagem_status, texto_progresso_download(baixado, total, tarefa), TECLADO_CANCELAR_DOWNLOAD
+    )
+
+async def callback_progresso(atual, total, tarefa):
+    """Repassa o progresso do upload ao editor de status"""
+    if tarefa.upload_cancelado:
+        raise Exception("Upload cancelado pelo usuário")
+
+    agora = time.time()
+    if agora - tarefa.ultimo_tempo_atualizacao < Config.INTERVALO_COLETA_PROGRESSO:
+        return
+    tarefa.ultimo_tempo_atualizacao = agora
+    EDITOR_STATUS.atualizar(
+        tarefa.mensagem_status,
+        texto_progresso("📤 **Progresso do Upload**", atual, total, tarefa),
+        TECLADO_CANCELAR_UPLOAD
+    )
 
 @app.on_message(filters.command(["start", "help"]))
-@tratar_flood_wait
 async def comando_start(client, mensagem: Message):
     """Handler do comando /start e /help"""
     await mensagem.reply(
@@ -476,21 +3001,18 @@ async def comando_start(client, mensagem: Message):
         "• Ou use /up <URL>\n"
         "• Para legenda direta: /leg <URL> <texto>\n"
         "• Para adicionar legenda depois: responda com /leg <texto>\n"
-        "• Para converter vídeos grandes: /conv <URL> ou responda um vídeo com /conv\n\n"
+        "• Para converter vídeos grandes: /conv <URL> ou responda um vídeo com /conv\n"
+        "• Para vídeos longos, /conv -s converte em segmentos paralelos\n"
+        "• Para reenviar um link já baixado do zero: /limparcache <URL>\n"
+        "• Para ver as tarefas pendentes: /fila\n"
+        "• Para várias URLs ou uma playlist de uma vez: /lote <URLs>\n\n"
         "💡 **Suporte a:** YouTube, XVideos e centenas de outros sites\n"
         "💡 **Em canais:** Responda a postagens com os comandos para enviar como comentário"
     )
 
 @app.on_message(filters.command(["up", "leg"]))
-@tratar_flood_wait
 async def comando_upload(client, mensagem: Message):
     """Manipula os comandos /up e /leg"""
-    global TEMPO_INICIO, DOWNLOAD_CANCELADO, UPLOAD_CANCELADO, TAMANHO_TOTAL_ARQUIVO
-    TEMPO_INICIO = time.time()
-    DOWNLOAD_CANCELADO = False
-    UPLOAD_CANCELADO = False
-    TAMANHO_TOTAL_ARQUIVO = 0
-
     eh_resposta = mensagem.reply_to_message is not None
     mensagem_original = mensagem.reply_to_message if eh_resposta else None
 
@@ -531,6 +3053,7 @@ async def comando_upload(client, mensagem: Message):
         return
 
     msg_status = await mensagem.reply("🔍 Iniciando processamento...")
+    tarefa = registrar_tarefa(msg_status)
 
     # Determinar extensão baseada na URL ou tipo de conteúdo
     extensao = '.mp4'  # Padrão para vídeos
@@ -538,62 +3061,153 @@ async def comando_upload(client, mensagem: Message):
         extensao = os.path.splitext(url.split('?')[0])[1].lower()
 
     caminho_arquivo = os.path.join(Config.PASTA_DOWNLOAD, f"dl_{mensagem.id}{extensao}")
+    fonte_streaming = None
+    preparo = None  # (modo, metadados) decidido no download
+    chaves_cache = [chave_url(url)]
 
-    try:
-        # Limpar arquivos antigos com o mesmo nome
-        if os.path.exists(caminho_arquivo):
-            os.remove(caminho_arquivo)
+    async def enviado_do_cache():
+        if not await responder_do_cache(client, mensagem, chaves_cache, legenda,
+                                        mensagem_original.id if eh_resposta else None):
+            return False
+        await EDITOR_STATUS.apagar(msg_status)
+        await apagar_url_se_permitido(client, mensagem, eh_resposta)
+        return True
+
+    async def etapa_download():
+        nonlocal fonte_streaming, preparo
+        if await enviado_do_cache():
+            return False
 
-        await msg_status.edit("⬇️ Baixando arquivo...")
+        anterior = iniciar_no_diario(
+            caminho_arquivo, url=url, etapa='download', chat_id=mensagem.chat.id, mensagem_id=mensagem.id
+        )
+        if anterior and anterior.get('etapa') == 'upload' and os.path.exists(caminho_arquivo):
+            # Download já concluído antes do reinício: segue direto para o envio
+            # (reserva o espaço da cópia que o preparo pode gravar)
+            await ESPACO_TRABALHO.reservar(tarefa, 2 * os.path.getsize(caminho_arquivo), [caminho_arquivo])
+            if extensao == '.mp4':
+                preparo = await rotear_preparo(tarefa, caminho_arquivo)
+            else:
+                AGENDADOR.direcionar_proxima_etapa(tarefa, None)
+            return
 
-        # Tentar primeiro com yt-dlp para qualquer URL - MODIFICAÇÃO PRINCIPAL
+        # Extração única do yt-dlp, reaproveitada no cache, no streaming e no download
         try:
-            # Testar se o yt-dlp reconhece a URL como site compatível
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info_dict = await asyncio.to_thread(ydl.extract_info, url, download=False, process=False)
-            
-            # Se chegou aqui, é compatível com yt-dlp
-            sucesso = await baixar_com_ytdlp(url, caminho_arquivo, msg_status)
+            info_dict = await extrair_info(url)
         except Exception as e:
             logger.info(f"URL não compatível com yt-dlp: {str(e)}")
-            # Se falhar, usar o método genérico para URLs diretas
-            sucesso = await download_arquivo_generico(url, caminho_arquivo, msg_status)
+            info_dict = None
+
+        if info_dict:
+            chaves_cache.append(chave_extrator(info_dict))
+            if await enviado_do_cache():
+                return False
+
+        # Fontes MP4 progressivas são baixadas durante o próprio upload
+        if extensao == '.mp4':
+            fonte_streaming = await resolver_fonte_streaming(url, info_dict)
+            if fonte_streaming:
+                AGENDADOR.direcionar_proxima_etapa(tarefa, None)
+                return
+
+        # Decide pelo tamanho antes de baixar: formato menor, conversão (/conv) ou recusa
+        plano = await planejar_download(url, info_dict)
+        if plano['decisao'] == 'converter' and extensao == '.mp4':
+            await EDITOR_STATUS.apagar(msg_status)
+            tarefa.id_fila = None  # A linha da fila passa para a tarefa de conversão
+            await submeter_conversao(client, mensagem, url, legenda=legenda)
+            return False
+        if plano['decisao'] != 'baixar':
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande ({converter_bytes(plano['tamanho'])})")
+            return False
+
+        # Arquivo baixado + cópia gravada pelo preparo (remux/transcodificação)
+        tamanho_estimado = plano['tamanho'] or Config.RESERVA_TAMANHO_DESCONHECIDO
+        await ESPACO_TRABALHO.reservar(tarefa, 2 * tamanho_estimado, [caminho_arquivo])
+
+        await EDITOR_STATUS.editar(msg_status, "⬇️ Baixando arquivo...")
+        tarefa.reiniciar_cronometro()
+
+        if info_dict:
+            sucesso = await baixar_com_ytdlp(url, caminho_arquivo, tarefa, info=info_dict, formato=plano['formato'])
+        else:
+            # URL não compatível com yt-dlp: usar o método genérico para URLs diretas
+            sucesso = await download_arquivo_generico(url, caminho_arquivo, tarefa)
 
         if not sucesso or not os.path.exists(caminho_arquivo):
-            await msg_status.edit("❌ Falha no download do arquivo")
-            return
+            await EDITOR_STATUS.editar(msg_status, "❌ Falha no download do arquivo")
+            return False
 
         tamanho_arquivo = os.path.getsize(caminho_arquivo)
         if tamanho_arquivo > Config.TAMANHO_MAXIMO:
             os.remove(caminho_arquivo)
-            await msg_status.edit(f"❌ Arquivo muito grande ({converter_bytes(tamanho_arquivo)})")
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande ({converter_bytes(tamanho_arquivo)})")
+            return False
+
+        # Mesmo conteúdo vindo de outra URL: reaproveita o envio anterior
+        chaves_cache.append(await asyncio.to_thread(calcular_hash_arquivo, caminho_arquivo))
+        if await enviado_do_cache():
+            return False
+
+        DIARIO_DOWNLOADS.registrar(caminho_arquivo, etapa='upload', intervalos=None)
+        # Só o que precisa de preparo passa pelas filas de preparo/transcodificação
+        if extensao == '.mp4':
+            preparo = await rotear_preparo(tarefa, caminho_arquivo)
+        else:
+            AGENDADOR.direcionar_proxima_etapa(tarefa, None)
+
+    async def etapa_preparacao():
+        try:
+            await preparar_para_telegram(caminho_arquivo, msg_status, *preparo)
+        except Exception as e:
+            logger.warning(f"Preparo do vídeo falhou, enviando como foi baixado: {str(e)[:200]}")
+            return
+
+        tamanho_arquivo = os.path.getsize(caminho_arquivo)
+        if tamanho_arquivo > Config.TAMANHO_MAXIMO:
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande após a conversão ({converter_bytes(tamanho_arquivo)})")
+            return False
+
+    async def etapa_upload():
+        if fonte_streaming:
+            await EDITOR_STATUS.editar(msg_status, "⬆️ Enviando arquivo em streaming...")
+            tarefa.reiniciar_cronometro()
+            enviada = await enviar_video_em_streaming(
+                client, fonte_streaming, tarefa, mensagem.chat.id,
+                caption=legenda,
+                reply_to_message_id=mensagem_original.id if eh_resposta else None
+            )
+            registrar_no_cache(chaves_cache, enviada)
+            await EDITOR_STATUS.apagar(msg_status)
+            await apagar_url_se_permitido(client, mensagem, eh_resposta)
             return
 
-        await msg_status.edit("📊 Processando vídeo...")
+        await EDITOR_STATUS.editar(msg_status, "📊 Processando vídeo...")
 
         # Preparar parâmetros de envio
         params = {
             'caption': legenda,
             'progress': callback_progresso,
-            'progress_args': (msg_status,)
+            'progress_args': (tarefa,)
         }
 
         if eh_resposta:
             params['reply_to_message_id'] = mensagem_original.id
 
-        await msg_status.edit("⬆️ Enviando arquivo...")
+        await EDITOR_STATUS.editar(msg_status, "⬆️ Enviando arquivo...")
+        tarefa.reiniciar_cronometro()
 
         # Verificar tipo de arquivo e enviar
         if extensao in ['.jpg', '.jpeg', '.png', '.gif', '.bmp', '.webp']:
-            await client.send_photo(
+            enviada = await client.send_photo(
                 chat_id=mensagem.chat.id,
                 photo=caminho_arquivo,
                 **params
             )
         elif extensao in ['.mp4', '.mkv', '.avi', '.mov', '.webm']:
-            metadados = extrair_metadados_video(caminho_arquivo)
+            metadados = await extrair_metadados_video(caminho_arquivo)
             if metadados:
-                await client.send_video(
+                enviada = await client.send_video(
                     chat_id=mensagem.chat.id,
                     video=caminho_arquivo,
                     duration=metadados['duracao'],
@@ -604,84 +3218,134 @@ async def comando_upload(client, mensagem: Message):
                     **params
                 )
             else:
-                await client.send_document(
+                enviada = await client.send_document(
                     chat_id=mensagem.chat.id,
                     document=caminho_arquivo,
                     **params
                 )
         else:
-            await client.send_document(
+            enviada = await client.send_document(
                 chat_id=mensagem.chat.id,
                 document=caminho_arquivo,
                 **params
             )
 
-        await msg_status.delete()
+        registrar_no_cache(chaves_cache, enviada)
+        await EDITOR_STATUS.apagar(msg_status)
         await apagar_url_se_permitido(client, mensagem, eh_resposta)
 
-    except Exception as e:
+    async def tratar_erro(e):
         logger.error(f"Erro no processamento: {str(e)}")
-        await msg_status.edit(f"⚠️ Erro: {str(e)[:200]}")
-    finally:
+        await EDITOR_STATUS.editar(msg_status, f"⚠️ Erro: {str(e)[:200]}")
+
+    async def limpar():
+        remover_tarefa(tarefa)
         # Limpeza de arquivos temporários
-        if os.path.exists(caminho_arquivo):
-            os.remove(caminho_arquivo)
-        thumb_path = os.path.join(Config.PASTA_THUMB, f"thumb_{os.path.basename(caminho_arquivo)}.jpg")
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+        descartar_download(caminho_arquivo)
+        await ESPACO_TRABALHO.liberar(tarefa)
+
+    await AGENDADOR.submeter(
+        tarefa,
+        [
+            ("download", etapa_download),
+            ("preparo", etapa_preparacao),
+            ("upload", etapa_upload)
+        ],
+        tratar_erro,
+        limpar,
+        origem=(mensagem, mensagem.command[0])
+    )
 
 @app.on_message(filters.command("conv"))
-@tratar_flood_wait
 async def comando_converter_avancado(client, mensagem: Message):
     """Handler avançado para o comando /conv com cálculo dinâmico de bitrate"""
-    global TEMPO_INICIO, DOWNLOAD_CANCELADO, UPLOAD_CANCELADO
-    
-    if len(mensagem.command) < 2 and not mensagem.reply_to_message:
-        await mensagem.reply("❌ Use /conv <URL> ou responda a um vídeo com /conv")
+
+    # /conv -s <URL> usa a conversão paralela por segmentos
+    segmentado = len(mensagem.command) > 1 and mensagem.command[1] == "-s"
+    argumentos = mensagem.command[2:] if segmentado else mensagem.command[1:]
+
+    if not argumentos and not mensagem.reply_to_message:
+        await mensagem.reply("❌ Use /conv [-s] <URL> ou responda a um vídeo com /conv [-s]")
         return
 
-    TEMPO_INICIO = time.time()
-    DOWNLOAD_CANCELADO = False
-    UPLOAD_CANCELADO = False
-    
+    url = None if mensagem.reply_to_message else argumentos[0]
+    await submeter_conversao(client, mensagem, url, segmentado)
+
+async def submeter_conversao(client, mensagem: Message, url=None, segmentado=False, legenda=None):
+    """
+    Coloca a conversão para o tamanho alvo no pipeline
+    - url None: converte a mídia da mensagem respondida
+    - Também recebe os links que o /up e o modo automático não conseguem enviar sem converter
+      (com a legenda do /leg); a URL fica na fila persistente para a retomada
+    """
     msg_status = await mensagem.reply("🔍 Analisando vídeo...")
-    original_path = None
-    converted_path = None
-    
-    try:
+    tarefa = registrar_tarefa(msg_status)
+    # Caminhos fixos desde o início: a limpeza funciona mesmo se a tarefa falhar antes do download
+    original_path = os.path.join(Config.PASTA_DOWNLOAD, f"orig_{mensagem.id}.mp4")
+    converted_path = os.path.join(Config.PASTA_DOWNLOAD, f"conv_{mensagem.id}.mp4")
+    caminho_envio = None
+
+    async def reservar_espaco(tamanho_original):
+        # Original + saída da conversão + segmentos ou cópia reduzida
+        tamanho_original = tamanho_original or Config.RESERVA_TAMANHO_DESCONHECIDO
+        tamanho_saida = min(tamanho_original, TAMANHO_ALVO_CONVERSAO)
+        await ESPACO_TRABALHO.reservar(tarefa, tamanho_original + 2 * tamanho_saida, [original_path, converted_path])
+
+    async def etapa_download():
+        tarefa.reiniciar_cronometro()
+
         # Obter o arquivo de origem (URL ou resposta)
-        if mensagem.reply_to_message:
-            if mensagem.reply_to_message.video:
-                file_id = mensagem.reply_to_message.video.file_id
-            elif mensagem.reply_to_message.document:
-                file_id = mensagem.reply_to_message.document.file_id
-            else:
-                await msg_status.edit("❌ Responda a um vídeo ou arquivo para converter")
-                return
-            
-            original_path = await client.download_media(
-                file_id,
-                file_name=os.path.join(Config.PASTA_DOWNLOAD, f"orig_{mensagem.id}.mp4"),
-                progress=progresso_download,
-                progress_args=(msg_status,)
+        if url is None:
+            midia = mensagem.reply_to_message.video or mensagem.reply_to_message.document
+            if not midia:
+                await EDITOR_STATUS.editar(msg_status, "❌ Responda a um vídeo ou arquivo para converter")
+                return False
+
+            await reservar_espaco(midia.file_size)
+            # O Pyrogram devolve None em vez de propagar erro ou cancelamento
+            baixado = await client.download_media(
+                midia.file_id,
+                file_name=original_path,
+                progress=atualizar_progresso_download,
+                progress_args=(tarefa,)
             )
+            if not baixado or not os.path.exists(original_path):
+                if tarefa.download_cancelado:
+                    raise Exception("Download cancelado pelo usuário")
+                raise Exception("Falha no download")
         else:
-            url = mensagem.text.split(maxsplit=1)[1]
-            original_path = os.path.join(Config.PASTA_DOWNLOAD, f"orig_{mensagem.id}.mp4")
-            sucesso = await baixar_com_ytdlp(url, original_path, msg_status) or \
-                     await download_arquivo_generico(url, original_path, msg_status)
+            try:
+                info_dict = await extrair_info(url)
+            except Exception as e:
+                logger.info(f"URL não compatível com yt-dlp: {str(e)}")
+                info_dict = None
+
+            plano = await planejar_download(url, info_dict, trocar_formato=False)
+            if plano['decisao'] == 'rejeitar':
+                await EDITOR_STATUS.editar(
+                    msg_status,
+                    f"❌ Arquivo muito grande ({converter_bytes(plano['tamanho'])}); "
+                    f"o limite para conversão é {converter_bytes(Config.TAMANHO_MAXIMO_CONVERSAO)}"
+                )
+                return False
+            await reservar_espaco(plano['tamanho'])
+            sucesso = (info_dict and await baixar_com_ytdlp(url, original_path, tarefa, info=info_dict)) or \
+                     await download_arquivo_generico(url, original_path, tarefa)
             if not sucesso:
                 raise Exception("Falha no download")
 
+    async def etapa_transcodificacao():
+        nonlocal caminho_envio
+
         # Verificar tamanho original
         tamanho_original = os.path.getsize(original_path)
         if tamanho_original <= Config.TAMANHO_MAXIMO:
-            await msg_status.edit("ℹ️ O vídeo já está dentro do tamanho máximo. Enviando original...")
-            await enviar_video_convertido(client, mensagem, original_path, msg_status)
+            await EDITOR_STATUS.editar(msg_status, "ℹ️ O vídeo já está dentro do tamanho máximo. Enviando original...")
+            caminho_envio = original_path
             return
 
         # Extrair metadados detalhados
-        metadados = extrair_metadados_detalhados(original_path)
+        metadados = await extrair_metadados_detalhados(original_path)
         if not metadados:
             raise Exception("Falha ao extrair metadados")
 
@@ -689,118 +3353,375 @@ async def comando_converter_avancado(client, mensagem: Message):
         if duracao_segundos <= 0:
             raise Exception("Duração inválida do vídeo")
 
-        # Calcular bitrate de vídeo ideal para ~1.90GB
-        TAMANHO_ALVO = 1.90 * 1024 * 1024 * 1024  # ~1.90GB
-        BITRATE_AUDIO = 96  # kbps
-        BITRATE_AUDIO_BYTES = BITRATE_AUDIO * 1000 / 8  # bytes por segundo
-        
-        # Calcular espaço disponível para vídeo
-        espaco_audio = BITRATE_AUDIO_BYTES * duracao_segundos
-        espaco_video = TAMANHO_ALVO - espaco_audio
-        
-        if espaco_video <= 0:
-            raise Exception("Vídeo muito longo para o tamanho alvo")
-        
-        # Calcular bitrate de vídeo em kbps
-        bitrate_video_kbps = int((espaco_video * 8) / (1000 * duracao_segundos))
-        
-        # Ajustar bitrate máximo e buffer
-        maxrate = int(bitrate_video_kbps * 1.4)  # 40% acima do bitrate médio
-        bufsize = int(bitrate_video_kbps * 2)    # Tamanho do buffer
-        
-        # Limites de segurança
-        bitrate_video_kbps = max(500, min(bitrate_video_kbps, 8000))  # Entre 500kbps e 8000kbps
-        maxrate = max(700, min(maxrate, 10000))
-        bufsize = max(1000, min(bufsize, 16000))
-        
-        await msg_status.edit(f"🔄 Convertendo vídeo (bitrate: {bitrate_video_kbps}kbps)...")
-        
         # Preparar caminhos
-        converted_path = os.path.join(Config.PASTA_DOWNLOAD, f"conv_{mensagem.id}.mp4")
-        
-        # Comando FFmpeg otimizado
-        cmd = [
-            'ffmpeg', '-y', '-i', original_path,
-            '-c:v', 'libx264', 
-            '-b:v', f'{bitrate_video_kbps}k',
-            '-maxrate', f'{maxrate}k',
-            '-bufsize', f'{bufsize}k',
-            '-preset', 'slow',
-            '-profile:v', 'main',
-            '-pix_fmt', 'yuv420p',
-            '-movflags', '+faststart',
-            '-c:a', 'aac',
-            '-b:a', f'{BITRATE_AUDIO}k',
-            '-ac', '2',
-            '-f', 'mp4',
-            converted_path
-        ]
-        
-        # Executar conversão
-        process = await asyncio.create_subprocess_exec(
-            *cmd,
-            stdout=asyncio.subprocess.PIPE,
-            stderr=asyncio.subprocess.PIPE
-        )
-        
-        # Monitorar progresso
-        last_update = time.time()
-        while True:
-            await asyncio.sleep(2)
-            
-            if process.returncode is not None:
-                break
-                
-            if time.time() - last_update > Config.INTERVALO_ATUALIZACAO:
-                if os.path.exists(converted_path):
-                    current_size = os.path.getsize(converted_path)
-                    percent = (current_size / TAMANHO_ALVO) * 100
-                    await msg_status.edit(
-                        f"🔄 Convertendo vídeo...\n"
-                        f"🎞️ Bitrate: {bitrate_video_kbps}kbps\n"
-                        f"📊 Progresso: {percent:.1f}%\n"
-                        f"📦 Tamanho estimado: ~1.90GB"
-                    )
-                last_update = time.time()
+        prefixo_temp = os.path.join(Config.PASTA_DOWNLOAD, f"tmp_{mensagem.id}")
 
-        # Verificar resultado
-        if process.returncode != 0 or not os.path.exists(converted_path):
-            stderr = await process.stderr.read()
-            raise Exception(f"Falha na conversão: {stderr.decode()[:200]}")
+        bitrate_video_kbps = await converter_para_tamanho_alvo(
+            original_path, converted_path, msg_status, prefixo_temp,
+            modo="segmentado" if segmentado else None
+        )
         
         # Verificar tamanho final
         tamanho_final = os.path.getsize(converted_path)
         if tamanho_final > Config.TAMANHO_MAXIMO:
             # Se ainda for grande, tentar reduzir mais
-            await reduzir_video_adicional(converted_path, tamanho_final, duracao_segundos, msg_status)
-        
-        # Enviar vídeo convertido
-        await enviar_video_convertido(client, mensagem, converted_path, msg_status)
+            await reduzir_video_adicional(
+                converted_path, duracao_segundos, msg_status,
+                bitrate_anterior=bitrate_video_kbps, origem_path=original_path
+            )
 
-    except Exception as e:
+        caminho_envio = converted_path
+
+    async def etapa_upload():
+        # Enviar vídeo convertido (ou o original, se já estava dentro do limite)
+        await enviar_video_convertido(client, mensagem, caminho_envio, tarefa, origem_path=original_path, legenda=legenda)
+
+    async def tratar_erro(e):
         logger.error(f"Erro na conversão avançada: {str(e)}")
-        await msg_status.edit(f"❌ Erro: {str(e)[:200]}")
-        
-    finally:
-        # Limpeza
+        await EDITOR_STATUS.editar(msg_status, f"❌ Erro: {str(e)[:200]}")
+
+    async def limpar():
+        remover_tarefa(tarefa)
+        # Limpeza (inclui parciais e a cópia .reduced.mp4)
         for path in [original_path, converted_path]:
-            if path and os.path.exists(path):
-                os.remove(path)
-        
-        thumb_path = os.path.join(Config.PASTA_THUMB, f"thumb_{os.path.basename(original_path)}.jpg")
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+            descartar_download(path)
+        await ESPACO_TRABALHO.liberar(tarefa)
+
+    await AGENDADOR.submeter(
+        tarefa,
+        [
+            ("download", etapa_download),
+            ("transcodificacao", etapa_transcodificacao),
+            ("upload", etapa_upload)
+        ],
+        tratar_erro,
+        limpar,
+        origem=(mensagem, 'conv', {'url': url, 'legenda': legenda})
+    )
+
+@app.on_message(filters.command("limparcache") & filters.user(Config.DONO_ID))
+async def comando_limpar_cache(client, mensagem: Message):
+    """Invalida o cache de file_id (inteiro ou apenas de uma URL)"""
+    if len(mensagem.command) > 1:
+        url = mensagem.text.split(maxsplit=1)[1].strip()
+        removidas = CACHE_FILE_ID.invalidar(chave_url(url))
+    else:
+        removidas = CACHE_FILE_ID.invalidar()
+    await mensagem.reply(f"🗑️ Cache de file_id limpo ({removidas} chaves removidas)")
+
+@app.on_message(filters.command("fila"))
+async def comando_fila(client, mensagem: Message):
+    """Lista as tarefas pendentes (todas para o dono, as do chat para os demais)"""
+    chat_id = None if mensagem.from_user and mensagem.from_user.id == Config.DONO_ID else mensagem.chat.id
+    resumo = await FILA_PERSISTENTE.resumo(chat_id)
+    if not resumo:
+        await mensagem.reply("📭 Nenhuma tarefa na fila")
+        return
+
+    linhas = await FILA_PERSISTENTE.listar(chat_id, Config.LIMITE_LISTAGEM_FILA)
+    agora = time.time()
+    texto = (
+        f"📋 **Fila de tarefas** ({sum(resumo.values())})\n"
+        + " | ".join(f"{etapa}: {total}" for etapa, total in sorted(resumo.items()))
+        + "\n\n"
+        + "\n".join(
+            f"• #{linha['id']} {'link' if linha['comando'] == 'auto' else '/' + linha['comando']} — {linha['etapa']} "
+            f"({agora - linha['criada_em']:.0f}s)"
+            + (f" 🔁{linha['tentativas']}" if linha['tentativas'] else "")
+            for linha in linhas
+        )
+    )
+    await mensagem.reply(texto)
+
+TECLADO_CANCELAR_LOTE = InlineKeyboardMarkup([[InlineKeyboardButton("Cancelar lote", callback_data="cancelar_lote")]])
+
+LOTES_ATIVOS = {}  # (chat_id, id da mensagem de status) -> Lote
+
+class LinhaLote:
+    """
+    Destino de status de um item de /lote
+    - Ocupa o lugar da mensagem de status na Tarefa; o EditorStatus repassa os textos ao lote
+    """
+    def __init__(self, lote, indice):
+        self.lote = lote
+        self.indice = indice
+        self.chat = lote.mensagem_status.chat
+        self.id = f"lote_{lote.mensagem_status.id}_{indice}"
+
+    def atualizar(self, texto):
+        self.lote.atualizar_linha(self.indice, texto)
+
+class Lote:
+    """Estado agregado de um /lote, mostrado numa única mensagem de status"""
+    def __init__(self, mensagem_status):
+        self.mensagem_status = mensagem_status
+        self.total = 0
+        self.expansao_concluida = False
+        self.enviados = 0
+        self.falhas = []  # (índice, motivo)
+        self.linhas = {}  # índice -> linha de status do item em andamento
+        self.tarefas = {}  # índice -> Tarefa do item em andamento
+        self.cancelado = False
+        self.execucao = None
+
+    def atualizar_linha(self, indice, texto):
+        if texto is None:
+            self.linhas.pop(indice, None)
+        else:
+            # Título e linha do percentual bastam; o resto do texto de progresso fica de fora
+            partes = [linha.replace('**', '').strip() for linha in texto.splitlines() if linha.strip()]
+            resumo = partes[:1] + [linha for linha in partes[1:] if '%' in linha]
+            self.linhas[indice] = " · ".join(resumo)[:100]
+        self.publicar()
+
+    def texto(self):
+        total = f"{self.total}" if self.expansao_concluida else f"{self.total}+"
+        texto = f"📦 **Lote**: {self.enviados}/{total} enviados"
+        if self.falhas:
+            texto += f" · {len(self.falhas)} falhas"
+        for indice in sorted(self.linhas):
+            texto += f"\n#{indice} {self.linhas[indice]}"
+        return texto
+
+    def publicar(self):
+        EDITOR_STATUS.atualizar(self.mensagem_status, self.texto(), TECLADO_CANCELAR_LOTE)
+
+    def cancelar(self):
+        self.cancelado = True
+        for tarefa in self.tarefas.values():
+            tarefa.download_cancelado = True
+            tarefa.upload_cancelado = True
+
+def _entradas_playlist(entradas):
+    """Itera as entradas de uma playlist sem buscar todas de uma vez (PagedList é lido por páginas)"""
+    if isinstance(entradas, yt_dlp.utils.PagedList):
+        inicio = 0
+        while pagina := entradas.getslice(inicio, inicio + 50):
+            yield from pagina
+            inicio += 50
+    else:
+        yield from entradas or []
+
+async def expandir_lote(urls):
+    """
+    Gera as URLs de um /lote sob demanda
+    - Playlists são expandidas entrada a entrada, conforme o lote pede mais itens
+    - URLs que o yt-dlp não reconhece seguem como links diretos
+    """
+    for url in urls:
+        with POOL_YTDL.usar('lote') as ydl:
+            try:
+                info = await asyncio.to_thread(ydl.extract_info, url, download=False, process=False)
+            except Exception as e:
+                logger.info(f"URL do lote não reconhecida pelo yt-dlp, tratada como link direto: {str(e)[:200]}")
+                info = None
+            if not info or info.get('_type') not in ('playlist', 'multi_video'):
+                if info:
+                    CACHE_INFO[url] = (time.time(), info)  # Evita extrair de novo no download do item
+                yield url
+                continue
+
+            entradas = _entradas_playlist(info.get('entries'))
+            while True:
+                entrada = await asyncio.to_thread(next, entradas, None)
+                if entrada is None:
+                    break
+                url_entrada = entrada.get('webpage_url') or entrada.get('url')
+                if url_entrada:
+                    yield url_entrada
+
+async def executar_lote(client, mensagem: Message, lote, urls):
+    """
+    Processa os itens do lote com no máximo LIMITE_LOTE em andamento
+    - Download e preparo de cada item passam pelo Agendador, em paralelo com os demais
+    - Os envios saem um de cada vez, na ordem das URLs
+    - O espaço em disco é reservado na mesma ordem: um item só reserva depois do anterior,
+      senão itens posteriores prontos prenderiam o espaço que o primeiro aguarda para ser enviado
+    """
+    vagas = asyncio.Semaphore(Config.LIMITE_LOTE)
+    fila = asyncio.Queue()
+    ultima_reserva = asyncio.Event()
+    ultima_reserva.set()
+
+    def criar_item(indice, url):
+        nonlocal ultima_reserva
+        linha = LinhaLote(lote, indice)
+        tarefa = Tarefa(linha)
+        item = {
+            'indice': indice, 'url': url, 'tarefa': tarefa, 'pronto': asyncio.Event(),
+            'vez_de_reservar': ultima_reserva, 'reservado': asyncio.Event(),
+            'caminho': os.path.join(Config.PASTA_DOWNLOAD, f"dl_{mensagem.id}_{indice}.mp4"),
+            'chaves': [chave_url(url)], 'em_cache': False, 'erro': None, 'preparo': None,
+        }
+
+        async def etapa_download():
+            if lote.cancelado:
+                raise Exception("Lote cancelado")
+            try:
+                info_dict = await extrair_info(url)
+            except Exception as e:
+                logger.info(f"URL não compatível com yt-dlp: {str(e)}")
+                info_dict = None
+            if info_dict:
+                item['chaves'].append(chave_extrator(info_dict))
+            if CACHE_FILE_ID.obter(*item['chaves']):
+                item['em_cache'] = True
+                return False
+
+            plano = await planejar_download(url, info_dict)
+            if plano['decisao'] != 'baixar':
+                sugestao = " — use /conv" if plano['decisao'] == 'converter' else ""
+                raise Exception(f"Arquivo muito grande ({converter_bytes(plano['tamanho'])}){sugestao}")
+            await item['vez_de_reservar'].wait()
+            await ESPACO_TRABALHO.reservar(
+                tarefa, 2 * (plano['tamanho'] or Config.RESERVA_TAMANHO_DESCONHECIDO), [item['caminho']]
+            )
+            item['reservado'].set()
+
+            linha.atualizar("⬇️ Baixando...")
+            tarefa.reiniciar_cronometro()
+            if info_dict:
+                sucesso = await baixar_com_ytdlp(url, item['caminho'], tarefa, info=info_dict, formato=plano['formato'])
+            else:
+                sucesso = await download_arquivo_generico(url, item['caminho'], tarefa)
+            if not sucesso or not os.path.exists(item['caminho']):
+                raise Exception("Falha no download")
+            tamanho_arquivo = os.path.getsize(item['caminho'])
+            if tamanho_arquivo > Config.TAMANHO_MAXIMO:
+                raise Exception(f"Arquivo muito grande ({converter_bytes(tamanho_arquivo)})")
+
+            item['chaves'].append(await asyncio.to_thread(calcular_hash_arquivo, item['caminho']))
+            if CACHE_FILE_ID.obter(*item['chaves']):
+                item['em_cache'] = True
+                return False
+            item['preparo'] = await rotear_preparo(tarefa, item['caminho'])
+
+        async def etapa_preparacao():
+            try:
+                await preparar_para_telegram(item['caminho'], linha, *item['preparo'])
+            except Exception as e:
+                logger.warning(f"Preparo do vídeo falhou, enviando como foi baixado: {str(e)[:200]}")
+                return
+            tamanho_arquivo = os.path.getsize(item['caminho'])
+            if tamanho_arquivo > Config.TAMANHO_MAXIMO:
+                raise Exception(f"Arquivo muito grande após a conversão ({converter_bytes(tamanho_arquivo)})")
+
+        async def registrar_erro(e):
+            item['erro'] = str(e)[:100]
+
+        async def concluir():
+            item['reservado'].set()  # Item encerrado sem reservar (erro ou cache) libera o próximo
+            item['pronto'].set()
+
+        item['etapas'] = [("download", etapa_download), ("preparo", etapa_preparacao)]
+        item['registrar_erro'] = registrar_erro
+        item['concluir'] = concluir
+        ultima_reserva = item['reservado']
+        return item
+
+    async def enviar(item):
+        tarefa = item['tarefa']
+        if item['em_cache'] and await responder_do_cache(client, mensagem, item['chaves'], reply_to_message_id=mensagem.id):
+            return
+        if item['em_cache']:
+            raise Exception("file_id em cache inválido")
 
-@app.on_message(filters.text & ~filters.command(["start", "help", "up", "leg", "conv"]))
-@tratar_flood_wait
+        metadados = await extrair_metadados_video(item['caminho'])
+        if not metadados:
+            raise Exception("Falha ao extrair metadados do vídeo")
+        tarefa.mensagem_status.atualizar("⬆️ Enviando...")
+        tarefa.reiniciar_cronometro()
+        enviada = await client.send_video(
+            chat_id=mensagem.chat.id,
+            video=item['caminho'],
+            duration=metadados['duracao'],
+            width=metadados['largura'],
+            height=metadados['altura'],
+            thumb=metadados['caminho_thumbnail'] or None,
+            supports_streaming=True,
+            reply_to_message_id=mensagem.id,
+            progress=callback_progresso,
+            progress_args=(tarefa,)
+        )
+        registrar_no_cache(item['chaves'], enviada)
+
+    async def alimentar():
+        try:
+            indice = 0
+            async for url in expandir_lote(urls):
+                if lote.cancelado or indice >= Config.LIMITE_ITENS_LOTE:
+                    break
+                await vagas.acquire()
+                indice += 1
+                item = criar_item(indice, url)
+                lote.total = indice
+                lote.tarefas[indice] = item['tarefa']
+                item['tarefa'].mensagem_status.atualizar("⏳ Na fila...")
+                await AGENDADOR.submeter(item['tarefa'], item['etapas'], item['registrar_erro'], item['concluir'])
+                await fila.put(item)
+        except Exception as e:
+            logger.error(f"Falha ao expandir o lote: {str(e)}")
+            lote.falhas.append((lote.total + 1, f"Expansão interrompida: {str(e)[:100]}"))
+        finally:
+            lote.expansao_concluida = True
+            lote.publicar()
+            await fila.put(None)
+
+    alimentador = asyncio.create_task(alimentar())
+    try:
+        while (item := await fila.get()) is not None:
+            await item['pronto'].wait()
+            try:
+                if not item['erro'] and not lote.cancelado:
+                    # Envio pelo Agendador: respeita o limite global de uploads
+                    item['pronto'].clear()
+                    item['etapas'] = [("upload", lambda item=item: enviar(item))]
+                    await AGENDADOR.submeter(item['tarefa'], item['etapas'], item['registrar_erro'], item['concluir'])
+                    await item['pronto'].wait()
+                if lote.cancelado and not item['erro']:
+                    item['erro'] = "Lote cancelado"
+                if item['erro']:
+                    lote.falhas.append((item['indice'], item['erro']))
+                else:
+                    lote.enviados += 1
+            finally:
+                descartar_download(item['caminho'])
+                await ESPACO_TRABALHO.liberar(item['tarefa'])
+                lote.tarefas.pop(item['indice'], None)
+                lote.linhas.pop(item['indice'], None)
+                vagas.release()
+                lote.publicar()
+    finally:
+        alimentador.cancel()
+        await asyncio.gather(alimentador, return_exceptions=True)
+        LOTES_ATIVOS.pop((lote.mensagem_status.chat.id, lote.mensagem_status.id), None)
+
+    texto = f"✅ **Lote concluído**: {lote.enviados}/{lote.total} enviados"
+    if lote.cancelado:
+        texto = f"❌ **Lote cancelado**: {lote.enviados}/{lote.total} enviados"
+    if lote.falhas:
+        texto += "\n" + "\n".join(f"#{indice}: {motivo}" for indice, motivo in lote.falhas[:20])
+    await EDITOR_STATUS.editar(lote.mensagem_status, texto)
+
+@app.on_message(filters.command("lote"))
+async def comando_lote(client, mensagem: Message):
+    """Manipula o /lote: várias URLs (ou playlists) no texto ou na mensagem respondida"""
+    textos = [mensagem.text]
+    if mensagem.reply_to_message:
+        textos.append(mensagem.reply_to_message.text or mensagem.reply_to_message.caption or "")
+    urls = [url for texto in textos for url in re.findall(r'https?://\S+', texto)]
+    if not urls:
+        await mensagem.reply("❌ Use /lote <URL> [URL...] ou responda uma mensagem com links usando /lote")
+        return
+
+    msg_status = await mensagem.reply(f"📦 Preparando lote com {len(urls)} links...")
+    lote = Lote(msg_status)
+    LOTES_ATIVOS[(msg_status.chat.id, msg_status.id)] = lote
+    lote.execucao = asyncio.create_task(executar_lote(client, mensagem, lote, list(dict.fromkeys(urls))))
+
+@app.on_message(filters.text & ~filters.command(["start", "help", "up", "leg", "conv", "limparcache", "fila", "lote"]))
 async def lidar_com_links_automaticos(client, mensagem: Message):
     """Handler para links automáticos (sem comando)"""
-    global TEMPO_INICIO, DOWNLOAD_CANCELADO, UPLOAD_CANCELADO, TAMANHO_TOTAL_ARQUIVO
-    TEMPO_INICIO = time.time()
-    DOWNLOAD_CANCELADO = False
-    UPLOAD_CANCELADO = False
-    TAMANHO_TOTAL_ARQUIVO = 0
-
     eh_resposta = mensagem.reply_to_message is not None
     mensagem_original = mensagem.reply_to_message if eh_resposta else None
 
@@ -809,45 +3730,129 @@ async def lidar_com_links_automaticos(client, mensagem: Message):
         return
 
     msg_status = await mensagem.reply("🔍 Processando link automaticamente...")
+    tarefa = registrar_tarefa(msg_status)
     caminho_arquivo = os.path.join(Config.PASTA_DOWNLOAD, f"dl_{mensagem.id}.mp4")
+    fonte_streaming = None
+    preparo = None  # (modo, metadados) decidido no download
+    chaves_cache = [chave_url(url)]
 
-    try:
-        if os.path.exists(caminho_arquivo):
-            os.remove(caminho_arquivo)
+    async def enviado_do_cache():
+        if not await responder_do_cache(client, mensagem, chaves_cache,
+                                        reply_to_message_id=mensagem_original.id if eh_resposta else None):
+            return False
+        await EDITOR_STATUS.apagar(msg_status)
+        await apagar_url_se_permitido(client, mensagem, eh_resposta)
+        return True
+
+    async def etapa_download():
+        nonlocal fonte_streaming, preparo
+        if await enviado_do_cache():
+            return False
 
-        await msg_status.edit("⬇️ Baixando vídeo...")
+        anterior = iniciar_no_diario(
+            caminho_arquivo, url=url, etapa='download', chat_id=mensagem.chat.id, mensagem_id=mensagem.id
+        )
+        if anterior and anterior.get('etapa') == 'upload' and os.path.exists(caminho_arquivo):
+            # Download já concluído antes do reinício: segue direto para o envio
+            # (reserva o espaço da cópia que o preparo pode gravar)
+            await ESPACO_TRABALHO.reservar(tarefa, 2 * os.path.getsize(caminho_arquivo), [caminho_arquivo])
+            preparo = await rotear_preparo(tarefa, caminho_arquivo)
+            return
 
-        # Tentar primeiro com yt-dlp para qualquer URL - MODIFICAÇÃO PRINCIPAL
+        # Extração única do yt-dlp, reaproveitada no cache, no streaming e no download
         try:
-            # Testar se o yt-dlp reconhece a URL como site compatível
-            with yt_dlp.YoutubeDL({'quiet': True}) as ydl:
-                info_dict = await asyncio.to_thread(ydl.extract_info, url, download=False, process=False)
-            
-            # Se chegou aqui, é compatível com yt-dlp
-            sucesso = await baixar_com_ytdlp(url, caminho_arquivo, msg_status)
+            info_dict = await extrair_info(url)
         except Exception as e:
             logger.info(f"URL não compatível com yt-dlp: {str(e)}")
-            # Se falhar, usar o método genérico para URLs diretas
-            sucesso = await download_arquivo_generico(url, caminho_arquivo, msg_status)
+            info_dict = None
 
-        if not sucesso or not os.path.exists(caminho_arquivo):
-            await msg_status.edit("❌ Falha no download do vídeo")
+        if info_dict:
+            chaves_cache.append(chave_extrator(info_dict))
+            if await enviado_do_cache():
+                return False
+
+        # Fontes MP4 progressivas são baixadas durante o próprio upload
+        fonte_streaming = await resolver_fonte_streaming(url, info_dict)
+        if fonte_streaming:
+            AGENDADOR.direcionar_proxima_etapa(tarefa, None)
             return
 
+        # Decide pelo tamanho antes de baixar: formato menor, conversão (/conv) ou recusa
+        plano = await planejar_download(url, info_dict)
+        if plano['decisao'] == 'converter':
+            await EDITOR_STATUS.apagar(msg_status)
+            tarefa.id_fila = None  # A linha da fila passa para a tarefa de conversão
+            await submeter_conversao(client, mensagem, url)
+            return False
+        if plano['decisao'] != 'baixar':
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande ({converter_bytes(plano['tamanho'])})")
+            return False
+
+        # Arquivo baixado + cópia gravada pelo preparo (remux/transcodificação)
+        tamanho_estimado = plano['tamanho'] or Config.RESERVA_TAMANHO_DESCONHECIDO
+        await ESPACO_TRABALHO.reservar(tarefa, 2 * tamanho_estimado, [caminho_arquivo])
+
+        await EDITOR_STATUS.editar(msg_status, "⬇️ Baixando vídeo...")
+        tarefa.reiniciar_cronometro()
+
+        if info_dict:
+            sucesso = await baixar_com_ytdlp(url, caminho_arquivo, tarefa, info=info_dict, formato=plano['formato'])
+        else:
+            # URL não compatível com yt-dlp: usar o método genérico para URLs diretas
+            sucesso = await download_arquivo_generico(url, caminho_arquivo, tarefa)
+
+        if not sucesso or not os.path.exists(caminho_arquivo):
+            await EDITOR_STATUS.editar(msg_status, "❌ Falha no download do vídeo")
+            return False
+
         tamanho_arquivo = os.path.getsize(caminho_arquivo)
         if tamanho_arquivo > Config.TAMANHO_MAXIMO:
             os.remove(caminho_arquivo)
-            await msg_status.edit(f"❌ Arquivo muito grande ({converter_bytes(tamanho_arquivo)})")
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande ({converter_bytes(tamanho_arquivo)})")
+            return False
+
+        # Mesmo conteúdo vindo de outra URL: reaproveita o envio anterior
+        chaves_cache.append(await asyncio.to_thread(calcular_hash_arquivo, caminho_arquivo))
+        if await enviado_do_cache():
+            return False
+
+        DIARIO_DOWNLOADS.registrar(caminho_arquivo, etapa='upload', intervalos=None)
+        # Só o que precisa de preparo passa pelas filas de preparo/transcodificação
+        preparo = await rotear_preparo(tarefa, caminho_arquivo)
+
+    async def etapa_preparacao():
+        try:
+            await preparar_para_telegram(caminho_arquivo, msg_status, *preparo)
+        except Exception as e:
+            logger.warning(f"Preparo do vídeo falhou, enviando como foi baixado: {str(e)[:200]}")
+            return
+
+        tamanho_arquivo = os.path.getsize(caminho_arquivo)
+        if tamanho_arquivo > Config.TAMANHO_MAXIMO:
+            await EDITOR_STATUS.editar(msg_status, f"❌ Arquivo muito grande após a conversão ({converter_bytes(tamanho_arquivo)})")
+            return False
+
+    async def etapa_upload():
+        if fonte_streaming:
+            await EDITOR_STATUS.editar(msg_status, "⬆️ Enviando vídeo em streaming...")
+            tarefa.reiniciar_cronometro()
+            enviada = await enviar_video_em_streaming(
+                client, fonte_streaming, tarefa, mensagem.chat.id,
+                reply_to_message_id=mensagem_original.id if eh_resposta else None
+            )
+            registrar_no_cache(chaves_cache, enviada)
+            await EDITOR_STATUS.apagar(msg_status)
+            await apagar_url_se_permitido(client, mensagem, eh_resposta)
             return
 
-        await msg_status.edit("📊 Processando vídeo...")
-        metadados = extrair_metadados_video(caminho_arquivo)
+        await EDITOR_STATUS.editar(msg_status, "📊 Processando vídeo...")
+        metadados = await extrair_metadados_video(caminho_arquivo)
         if not metadados:
-            await msg_status.edit("❌ Falha ao extrair metadados do vídeo")
+            await EDITOR_STATUS.editar(msg_status, "❌ Falha ao extrair metadados do vídeo")
             os.remove(caminho_arquivo)
-            return
+            return False
 
-        await msg_status.edit("⬆️ Enviando vídeo...")
+        await EDITOR_STATUS.editar(msg_status, "⬆️ Enviando vídeo...")
 
         params = {
             'chat_id': mensagem.chat.id,
@@ -858,66 +3863,218 @@ async def lidar_com_links_automaticos(client, mensagem: Message):
             'thumb': metadados['caminho_thumbnail'] or None,
             'supports_streaming': True,
             'progress': callback_progresso,
-            'progress_args': (msg_status,)
+            'progress_args': (tarefa,)
         }
 
         if eh_resposta:
             params['reply_to_message_id'] = mensagem_original.id
 
-        await client.send_video(**params)
+        tarefa.reiniciar_cronometro()
+        enviada = await client.send_video(**params)
+        registrar_no_cache(chaves_cache, enviada)
 
-        await msg_status.delete()
+        await EDITOR_STATUS.apagar(msg_status)
         await apagar_url_se_permitido(client, mensagem, eh_resposta)
 
-    except Exception as e:
+    async def tratar_erro(e):
         logger.error(f"Erro no processamento automático: {str(e)}")
-        await msg_status.edit(f"⚠️ Erro: {str(e)[:200]}")
-    finally:
-        if os.path.exists(caminho_arquivo):
-            os.remove(caminho_arquivo)
-        thumb_path = os.path.join(Config.PASTA_THUMB, f"thumb_{os.path.basename(caminho_arquivo)}.jpg")
-        if os.path.exists(thumb_path):
-            os.remove(thumb_path)
+        await EDITOR_STATUS.editar(msg_status, f"⚠️ Erro: {str(e)[:200]}")
+
+    async def limpar():
+        remover_tarefa(tarefa)
+        descartar_download(caminho_arquivo)
+        await ESPACO_TRABALHO.liberar(tarefa)
         try:
-            await msg_status.delete()
+            await EDITOR_STATUS.apagar(msg_status)
         except:
             pass
 
+    await AGENDADOR.submeter(
+        tarefa,
+        [
+            ("download", etapa_download),
+            ("preparo", etapa_preparacao),
+            ("upload", etapa_upload)
+        ],
+        tratar_erro,
+        limpar,
+        origem=(mensagem, 'auto')
+    )
+
+
 @app.on_callback_query(filters.regex("cancelar_download"))
 async def cancelar_download_callback(client, callback_query):
     """Cancela o download quando o botão é clicado"""
-    global DOWNLOAD_CANCELADO
-    DOWNLOAD_CANCELADO = True
+    tarefa = obter_tarefa(callback_query.message)
+    if not tarefa:
+        await callback_query.answer("Nenhuma tarefa ativa para esta mensagem.")
+        return
+    tarefa.download_cancelado = True
+    logger.info(f"Download cancelado para tarefa {tarefa.chave}")
     await callback_query.answer("Download cancelado.")
     try:
-        await callback_query.edit_message_text("❌ Download cancelado pelo usuário.")
+        await EDITOR_STATUS.editar(callback_query.message, "❌ Download cancelado pelo usuário.")
     except:
         pass
 
+@app.on_callback_query(filters.regex("cancelar_lote"))
+async def cancelar_lote_callback(client, callback_query):
+    """Cancela todos os itens de um /lote"""
+    lote = LOTES_ATIVOS.get((callback_query.message.chat.id, callback_query.message.id))
+    if not lote:
+        await callback_query.answer("Nenhum lote ativo para esta mensagem.")
+        return
+    lote.cancelar()
+    logger.info(f"Lote {callback_query.message.id} cancelado")
+    await callback_query.answer("Lote cancelado.")
+
 @app.on_callback_query(filters.regex("cancelar_upload"))
 async def cancelar_upload_callback(client, callback_query):
     """Cancela o upload quando o botão é clicado"""
-    global UPLOAD_CANCELADO
-    UPLOAD_CANCELADO = True
+    tarefa = obter_tarefa(callback_query.message)
+    if not tarefa:
+        await callback_query.answer("Nenhuma tarefa ativa para esta mensagem.")
+        return
+    tarefa.upload_cancelado = True
+    logger.info(f"Upload cancelado para tarefa {tarefa.chave}")
     await callback_query.answer("Upload cancelado.")
     try:
-        await callback_query.edit_message_text("❌ Upload cancelado pelo usuário.")
+        await EDITOR_STATUS.editar(callback_query.message, "❌ Upload cancelado pelo usuário.")
     except:
         pass
 
+async def retomar_tarefas():
+    """
+    Recoloca no pipeline as tarefas que estavam na fila ou em andamento quando o bot parou
+    - Cada retomada conta uma tentativa; acima de MAX_TENTATIVAS_TAREFA a tarefa é descartada
+    - Downloads do diário sem tarefa correspondente são apagados
+    """
+    linhas = await FILA_PERSISTENTE.listar()
+
+    # Busca as mensagens de origem em lotes por chat (até 200 por chamada)
+    mensagens = {}
+    por_chat = {}
+    for linha in linhas:
+        por_chat.setdefault(linha['chat_id'], []).append(linha['mensagem_id'])
+    for chat_id, ids in por_chat.items():
+        for inicio in range(0, len(ids), 200):
+            lote = ids[inicio:inicio + 200]
+            try:
+                for mensagem_id, mensagem in zip(lote, await app.get_messages(chat_id, lote)):
+                    mensagens[(chat_id, mensagem_id)] = mensagem
+            except Exception as e:
+                logger.warning(f"Falha ao buscar mensagens do chat {chat_id} para retomada: {str(e)}")
+
+    retomadas = set()
+    for linha in linhas:
+        chave = (linha['chat_id'], linha['mensagem_id'])
+        mensagem = mensagens.get(chave)
+        if not mensagem or mensagem.empty or not mensagem.text:
+            logger.info(f"Tarefa {linha['id']} descartada: mensagem de origem indisponível")
+            await FILA_PERSISTENTE.remover(linha['id'])
+            continue
+        if linha['tentativas'] >= Config.MAX_TENTATIVAS_TAREFA:
+            logger.warning(f"Tarefa {linha['id']} descartada após {linha['tentativas']} retomadas")
+            await FILA_PERSISTENTE.remover(linha['id'])
+            continue
+
+        await FILA_PERSISTENTE.contar_tentativa(linha['id'])
+        if linha['status_id']:
+            try:
+                await app.delete_messages(linha['chat_id'], linha['status_id'])
+            except Exception:
+                pass
+
+        logger.info(f"Retomando tarefa {linha['id']}: {linha['comando']} (etapa: {linha['etapa']})")
+        retomadas.add(chave)
+        try:
+            if linha['comando'] == 'auto':
+                await lidar_com_links_automaticos(app, mensagem)
+                continue
+            # Mensagens buscadas não passam pelo filtro de comando, que preenche .command
+            mensagem.command = [linha['comando']] + mensagem.text.split()[1:]
+            if linha['comando'] == 'conv' and linha['url']:
+                # URL guardada: vale também para links de /up, /leg ou automáticos redirecionados ao /conv,
+                # cuja mensagem pode ser uma resposta a outro post
+                segmentado = mensagem.command[1:2] == ["-s"]
+                await submeter_conversao(app, mensagem, linha['url'], segmentado, legenda=linha['legenda'])
+            elif linha['comando'] == 'conv':
+                await comando_converter_avancado(app, mensagem)
+            else:
+                await comando_upload(app, mensagem)
+        except Exception as e:
+            logger.error(f"Falha ao retomar tarefa {linha['id']}: {str(e)}")
+
+    for caminho_arquivo, entrada in list(DIARIO_DOWNLOADS.entradas.items()):
+        if (entrada.get('chat_id'), entrada.get('mensagem_id')) not in retomadas:
+            descartar_download(caminho_arquivo)
+
+def uso_pasta_download():
+    """Bytes ocupados em PASTA_DOWNLOAD (inclui subpastas de segmentos da conversão)"""
+    total = 0
+    for raiz, _, arquivos in os.walk(Config.PASTA_DOWNLOAD):
+        for arquivo in arquivos:
+            try:
+                total += os.path.getsize(os.path.join(raiz, arquivo))
+            except OSError:
+                pass
+    return total
+
+def cpu_subprocessos():
+    """CPU de ffmpeg/ffprobe (e demais subprocessos já encerrados), em segundos"""
+    uso = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {(('modo', 'usuario'),): uso.ru_utime, (('modo', 'sistema'),): uso.ru_stime}
+
+METRICAS.medidor(
+    'bot_tarefas_ativas', "Tarefas sendo executadas por etapa",
+    lambda: {(('etapa', etapa),): ocupados for etapa, ocupados in AGENDADOR.ocupados.items()}
+)
+METRICAS.medidor(
+    'bot_tarefas_na_fila', "Tarefas aguardando por etapa",
+    lambda: {(('etapa', etapa),): fila.qsize() for etapa, fila in AGENDADOR.filas.items()}
+)
+METRICAS.medidor('bot_tarefas_registradas', "Tarefas com mensagem de status ativa", lambda: len(STATUS_PROCESSOS))
+METRICAS.medidor('bot_lotes_ativos', "Execuções de /lote em andamento", lambda: len(LOTES_ATIVOS))
+METRICAS.medidor('bot_cpu_subprocessos_segundos_total', "CPU gasta por ffmpeg/ffprobe", cpu_subprocessos, tipo='counter')
+METRICAS.medidor('bot_disco_livre_bytes', "Espaço livre no disco de PASTA_DOWNLOAD",
+                 lambda: shutil.disk_usage(Config.PASTA_DOWNLOAD).free)
+METRICAS.medidor('bot_disco_reservado_bytes', "Bytes reservados pelas tarefas em PASTA_DOWNLOAD",
+                 lambda: sum(reserva['bytes'] for reserva in list(ESPACO_TRABALHO.reservas.values())))
+METRICAS.medidor('bot_pasta_download_bytes', "Bytes ocupados em PASTA_DOWNLOAD", uso_pasta_download)
+METRICAS.medidor('bot_atraso_loop_segundos', "Último atraso medido do event loop",
+                 lambda: ESTATISTICAS_LOOP['ultimo_atraso'])
+METRICAS.medidor('bot_atraso_loop_maximo_segundos', "Maior atraso do event loop desde o início",
+                 lambda: ESTATISTICAS_LOOP['maior_atraso'])
+METRICAS.medidor('bot_bloqueios_loop_total', "Atrasos do event loop acima de LIMITE_BLOQUEIO_LOOP",
+                 lambda: ESTATISTICAS_LOOP['bloqueios'], tipo='counter')
+
+async def iniciar_servidor_metricas():
+    """Serve /metrics no formato do Prometheus; retorna o runner do aiohttp (None se desligado)"""
+    if not Config.PORTA_METRICAS:
+        return None
+
+    async def responder(request):
+        # A coleta percorre PASTA_DOWNLOAD: fica fora do event loop
+        texto = await asyncio.to_thread(METRICAS.texto)
+        return web.Response(body=texto.encode(), headers={'Content-Type': 'text/plain; version=0.0.4; charset=utf-8'})
+
+    servidor = web.Application()
+    servidor.router.add_get('/metrics', responder)
+    runner = web.AppRunner(servidor, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, Config.HOST_METRICAS, Config.PORTA_METRICAS).start()
+    logger.info(f"Métricas em http://{Config.HOST_METRICAS}:{Config.PORTA_METRICAS}/metrics")
+    return runner
+
 if __name__ == "__main__":
     # Garante que as pastas existam
     os.makedirs(Config.PASTA_DOWNLOAD, exist_ok=True)
     os.makedirs(Config.PASTA_THUMB, exist_ok=True)
 
-    # Limpa arquivos temporários antigos
-    for file in os.listdir(Config.PASTA_DOWNLOAD):
-        if file.startswith('dl_'):
-            try:
-                os.remove(os.path.join(Config.PASTA_DOWNLOAD, file))
-            except:
-                pass
+    # Limpa arquivos temporários antigos (downloads no diário são retomados)
+    limpar_downloads_orfaos()
 
+    # Thumbnails do formato antigo (por nome de arquivo); as atuais são cache por conteúdo
     for file in os.listdir(Config.PASTA_THUMB):
         if file.startswith('thumb_'):
             try:
@@ -925,5 +4082,25 @@ if __name__ == "__main__":
             except:
                 pass
 
+    async def principal():
+        await app.start()
+        await POOL_MIDIA.aquecer(app)
+        AGENDADOR.iniciar()
+        servidor_metricas = await iniciar_servidor_metricas()
+        monitor = asyncio.create_task(monitorar_bloqueio_loop())
+        await retomar_tarefas()
+        await idle()
+        monitor.cancel()
+        for lote in list(LOTES_ATIVOS.values()):
+            lote.execucao.cancel()
+        await AGENDADOR.parar()
+        await EDITOR_STATUS.parar()
+        await POOL_MIDIA.fechar()
+        FILA_PERSISTENTE.fechar()
+        await fechar_conexoes()
+        if servidor_metricas:
+            await servidor_metricas.cleanup()
+        await app.stop()
+
     logger.info("----- Bot Iniciado -----")
-    app.run()
+    app.run(principal())